@@ -4,6 +4,7 @@ from fastapi.responses import RedirectResponse
 from app.api.ehr_ingestion_tasks_api import router as ehr_ingestion_tasks_api
 from app.api.ehr_context_items_api import router as ehr_context_items_api
 from app.api.ehr_query_api import router as ehr_query_api
+from app.api.metrics_api import router as metrics_api
 
 
 def setup_api(app: FastAPI) -> None:
@@ -35,3 +36,6 @@ def setup_api(app: FastAPI) -> None:
     )
 
     app.include_router(api)
+
+    # Where Prometheus scrapes by default, outside of the API
+    app.include_router(metrics_api, prefix="/metrics", tags=["Metrics"])
@@ -1,6 +1,8 @@
-from typing import Generic, Sequence, TypeVar
+from typing import Any, Generic, Optional, TypeVar
 from uuid import UUID
 
+import orjson
+from fastapi import Response
 from pydantic import BaseModel
 
 T = TypeVar("T", bound=BaseModel)
@@ -11,5 +13,29 @@ class CreatedResourceResponse(BaseModel):
 
 
 class ListedResourcesResponse(BaseModel, Generic[T]):
-    items: Sequence[T]
+    # A list rather than a Sequence, which pydantic serializes much slower
+    items: list[T]
     total: int
+
+
+class PaginatedResourcesResponse(ListedResourcesResponse[T], Generic[T]):
+    # Opaque, passed back as the cursor to get the next page. None on the last
+    # page.
+    next_cursor: Optional[str] = None
+
+
+def model_json_response(model: BaseModel) -> Response:
+    """Serializes the model straight to the response body. Unlike returning it
+    to FastAPI, the model is not validated again against the response_model."""
+
+    return Response(content=model.model_dump_json(), media_type="application/json")
+
+
+def orjson_response(content: Any) -> Response:
+    """Serializes plain values, e.g. straight from database rows, without
+    building models. Dates and UUIDs are written as pydantic writes them."""
+
+    return Response(
+        content=orjson.dumps(content, option=orjson.OPT_UTC_Z, default=str),
+        media_type="application/json",
+    )
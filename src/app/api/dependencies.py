@@ -1,20 +1,48 @@
+from contextlib import asynccontextmanager
 import asyncpg
 from fastapi import Depends, Request
 from typing import cast
 
 from app.core.app_settings import get_app_settings
+from app.core.timing import timed
+from app.domain.ehr_ingestion.ehr_contexts_cache import EHRContextsCache
 from app.domain.ehr_ingestion.ehr_contexts_service import EHRContextsService
-from app.domain.ehr_ingestion.ehr_contexts_repository import EhrContextsRepository
+from app.domain.ehr_ingestion.ehr_contexts_repository import (
+    EhrContextsRepository,
+    EhrContextsRepositoryFactory,
+)
 
-from typing import AsyncGenerator
+from app.domain.ehr_ingestion.ehr_ingestion_tasks_repository import (
+    EhrIngestionTasksRepository,
+)
+from app.domain.ehr_ingestion.ehr_ingestion_tasks_service import (
+    EHRIngestionTasksService,
+)
+from app.domain.ehr_ingestion.ehr_ingestion_workers import EHRIngestionWorkers
 
+from typing import AsyncGenerator, AsyncIterator, Optional
+
+from app.domain.ehr_query.ehr_answer_cache import EHRAnswerCache
+from app.domain.ehr_query.ehr_contexts_prefilter import EHRContextsPrefilter
+from app.domain.ehr_query.ehr_lexical_ranker import LexicalEHRContextsPrefilter
 from app.domain.ehr_query.ehr_query_service import EHRQueryService
+from app.domain.ehr_query.ehr_type_router import EHRContextTypeRouter
+from app.domain.ehr_query.ehr_vector_retriever import VectorEHRContextsPrefilter
+from app.domain.llm.embedding_client import EmbeddingClient
+from app.domain.llm.caching_llm_client import CachingLLMClient
 from app.domain.llm.llm_client import LLMClient
-from app.infrastructure.llm.openai_llm_client import OpenAILLMClient
+from app.domain.llm.llm_rate_limiter import LLMRateLimiter
+from app.domain.llm.llm_response_cache import LLMResponseCache
+from app.domain.llm.rate_limited_llm_client import RateLimitedLLMClient
+
+
+def get_db_pool(request: Request) -> asyncpg.Pool:
+    return cast(asyncpg.Pool, request.app.state.pool)
 
 
-async def get_db_conn(request: Request) -> AsyncGenerator[asyncpg.Connection, None]:
-    pool: asyncpg.Pool = request.app.state.pool
+async def get_db_conn(
+    pool: asyncpg.Pool = Depends(get_db_pool),
+) -> AsyncGenerator[asyncpg.Connection, None]:
     async with pool.acquire() as connection:
         yield cast(asyncpg.Connection, connection)
 
@@ -25,24 +53,144 @@ async def get_ehr_contexts_repository(
     return EhrContextsRepository(conn=conn)
 
 
+def get_ehr_contexts_repository_factory(
+    pool: asyncpg.Pool = Depends(get_db_pool),
+) -> EhrContextsRepositoryFactory:
+    # Unlike get_ehr_contexts_repository, no connection is checked out for the
+    # whole request: each use of the factory acquires one and gives it back.
+    @asynccontextmanager
+    async def ehr_contexts_repository() -> AsyncIterator[EhrContextsRepository]:
+        with timed("db_pool_acquire"):
+            connection = await pool.acquire()
+        try:
+            yield EhrContextsRepository(conn=cast(asyncpg.Connection, connection))
+        finally:
+            await pool.release(connection)
+
+    return ehr_contexts_repository
+
+
+def get_ehr_contexts_cache(request: Request) -> EHRContextsCache:
+    return cast(EHRContextsCache, request.app.state.ehr_contexts_cache)
+
+
+def get_embedding_client(request: Request) -> Optional[EmbeddingClient]:
+    return cast(Optional[EmbeddingClient], request.app.state.embedding_client)
+
+
 async def get_ehr_contexts_service(
     ehr_contexts_repository: EhrContextsRepository = Depends(
         get_ehr_contexts_repository
     ),
+    ehr_contexts_cache: EHRContextsCache = Depends(get_ehr_contexts_cache),
+    embedding_client: Optional[EmbeddingClient] = Depends(get_embedding_client),
 ) -> EHRContextsService:
-    return EHRContextsService(ehr_contexts_repository=ehr_contexts_repository)
+    return EHRContextsService(
+        ehr_contexts_repository=ehr_contexts_repository,
+        ehr_contexts_cache=ehr_contexts_cache,
+        embedding_client=(
+            embedding_client if get_app_settings().embeds_context_items else None
+        ),
+    )
+
+
+def get_ehr_ingestion_workers(request: Request) -> EHRIngestionWorkers:
+    return cast(EHRIngestionWorkers, request.app.state.ehr_ingestion_workers)
+
+
+async def get_ehr_ingestion_tasks_service(
+    conn: asyncpg.Connection = Depends(get_db_conn),
+    ehr_ingestion_workers: EHRIngestionWorkers = Depends(get_ehr_ingestion_workers),
+) -> EHRIngestionTasksService:
+    return EHRIngestionTasksService(
+        ehr_ingestion_tasks_repository=EhrIngestionTasksRepository(conn=conn),
+        ehr_ingestion_workers=ehr_ingestion_workers,
+    )
+
 
+def get_openai_llm_client(request: Request) -> LLMClient:
+    return cast(LLMClient, request.app.state.openai_llm_client)
 
-def get_llm_client() -> LLMClient:
+
+def get_llm_rate_limiter(request: Request) -> LLMRateLimiter:
+    return cast(LLMRateLimiter, request.app.state.llm_rate_limiter)
+
+
+def get_llm_response_cache(request: Request) -> Optional[LLMResponseCache]:
+    return cast(Optional[LLMResponseCache], request.app.state.llm_response_cache)
+
+
+def get_llm_client(
+    openai_llm_client: LLMClient = Depends(get_openai_llm_client),
+    llm_rate_limiter: LLMRateLimiter = Depends(get_llm_rate_limiter),
+    llm_response_cache: Optional[LLMResponseCache] = Depends(get_llm_response_cache),
+) -> LLMClient:
+    # Cache hits do not count against the rate limits
+    llm_client: LLMClient = RateLimitedLLMClient(
+        llm_client=openai_llm_client, limiter=llm_rate_limiter
+    )
+    if llm_response_cache is None:
+        return llm_client
+
+    return CachingLLMClient(llm_client=llm_client, cache=llm_response_cache)
+
+
+def get_ehr_contexts_prefilter(
+    embedding_client: Optional[EmbeddingClient] = Depends(get_embedding_client),
+) -> Optional[EHRContextsPrefilter]:
     settings = get_app_settings()
-    return OpenAILLMClient(api_key=settings.openai_api_key)
+    if settings.query_prefilter == "lexical":
+        return LexicalEHRContextsPrefilter(
+            top_k=settings.query_prefilter_top_k,
+            bypass_max_items=settings.query_prefilter_bypass_max_items,
+        )
+    if settings.query_prefilter == "vector":
+        # Created at startup, when the vector prefilter is enabled
+        assert embedding_client is not None
+        return VectorEHRContextsPrefilter(
+            embedding_client=embedding_client,
+            top_k=settings.query_prefilter_top_k,
+            bypass_max_items=settings.query_prefilter_bypass_max_items,
+        )
+    return None
+
+
+def get_ehr_context_type_router(request: Request) -> EHRContextTypeRouter:
+    return cast(EHRContextTypeRouter, request.app.state.ehr_context_type_router)
+
+
+def get_ehr_answer_cache(request: Request) -> Optional[EHRAnswerCache]:
+    return cast(Optional[EHRAnswerCache], request.app.state.ehr_answer_cache)
 
 
 async def get_ehr_query_service(
-    ehr_contexts_repository: EhrContextsRepository = Depends(
-        get_ehr_contexts_repository
+    ehr_contexts_repository_factory: EhrContextsRepositoryFactory = Depends(
+        get_ehr_contexts_repository_factory
+    ),
+    llm_client: LLMClient = Depends(get_llm_client),
+    ehr_contexts_cache: EHRContextsCache = Depends(get_ehr_contexts_cache),
+    ehr_contexts_prefilter: Optional[EHRContextsPrefilter] = Depends(
+        get_ehr_contexts_prefilter
     ),
+    ehr_context_type_router: EHRContextTypeRouter = Depends(
+        get_ehr_context_type_router
+    ),
+    ehr_answer_cache: Optional[EHRAnswerCache] = Depends(get_ehr_answer_cache),
 ) -> EHRQueryService:
+    settings = get_app_settings()
     return EHRQueryService(
-        ehr_contexts_repository=ehr_contexts_repository, llm_client=get_llm_client()
+        ehr_contexts_repository_factory=ehr_contexts_repository_factory,
+        llm_client=llm_client,
+        ehr_contexts_cache=ehr_contexts_cache,
+        ehr_contexts_prefilter=ehr_contexts_prefilter,
+        ehr_context_type_router=(
+            ehr_context_type_router if settings.query_type_routing else None
+        ),
+        prompt_token_budget=settings.prompt_token_budget,
+        prompt_item_max_tokens=settings.prompt_item_max_tokens,
+        batch_query_concurrency=settings.query_batch_concurrency,
+        query_mode=settings.query_mode,
+        single_call_max_tokens=settings.query_single_call_max_tokens,
+        skip_selection_below_tokens=settings.query_skip_selection_below_tokens,
+        ehr_answer_cache=ehr_answer_cache,
     )
@@ -1,26 +1,128 @@
+import base64
+from datetime import date
 from http import HTTPStatus
+from typing import Optional
+from uuid import UUID
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 
-from app.api.api_response_models import ListedResourcesResponse
-from app.api.dependencies import get_ehr_contexts_service
-from app.domain.ehr_ingestion.ehr_context_models import EHRContextItem
+from app.api.api_response_models import (
+    PaginatedResourcesResponse,
+    model_json_response,
+    orjson_response,
+)
+from app.api.dependencies import get_ehr_contexts_cache, get_ehr_contexts_service
+from app.domain.ehr_ingestion.ehr_context_models import (
+    EHRContextItem,
+    EHRContextItemField,
+    EHRContextItemKey,
+    EHRContextItemsFilter,
+    EHRContextType,
+)
+from app.domain.ehr_ingestion.ehr_contexts_cache import (
+    EHRContextsCache,
+    EHRContextsCacheStats,
+)
 from app.domain.ehr_ingestion.ehr_contexts_service import EHRContextsService
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
 router = APIRouter()
 
 
 @router.get(
     status_code=HTTPStatus.OK,
     path="",
-    response_model=ListedResourcesResponse[EHRContextItem],
+    response_model=PaginatedResourcesResponse[EHRContextItem],
 )
 async def get_ehr_context_items(
     patient_id: str,
+    cursor: Optional[str] = Query(
+        default=None, description="next_cursor of the previous page"
+    ),
+    limit: Optional[int] = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+    types: Optional[list[EHRContextType]] = Query(default=None, alias="type"),
+    recorded_from: Optional[date] = Query(default=None),
+    recorded_to: Optional[date] = Query(default=None),
+    fields: Optional[list[EHRContextItemField]] = Query(
+        default=None, description="Only return these fields of the items"
+    ),
     ehr_contexts_service: EHRContextsService = Depends(get_ehr_contexts_service),
-) -> ListedResourcesResponse[EHRContextItem]:
-    items = await ehr_contexts_service.list_ehr_contexts_by_patient(
-        patient_id=patient_id
+) -> Response:
+    """Lists the patient's items, in pages ordered by source.recorded_at and id
+    as soon as any parameter besides patient_id is given. Without them every
+    item is returned, from the patient's snapshot, or through the contexts
+    cache for patients without one yet."""
+
+    if (cursor, limit, types, recorded_from, recorded_to, fields) == (None,) * 6:
+        serialized = await ehr_contexts_service.get_serialized_ehr_contexts_by_patient(
+            patient_id=patient_id
+        )
+        if serialized is not None:
+            # The items go into the body as the snapshot holds them
+            return Response(
+                content=b"".join(
+                    [
+                        b'{"items":',
+                        serialized.json,
+                        b',"total":%d,"next_cursor":null}' % serialized.total,
+                    ]
+                ),
+                media_type="application/json",
+            )
+
+        items = await ehr_contexts_service.list_ehr_contexts_by_patient(
+            patient_id=patient_id
+        )
+        return model_json_response(
+            PaginatedResourcesResponse[EHRContextItem].model_construct(
+                items=items, total=len(items)
+            )
+        )
+
+    page = await ehr_contexts_service.list_ehr_contexts_page_by_patient(
+        patient_id=patient_id,
+        filter=EHRContextItemsFilter(
+            types=types, recorded_from=recorded_from, recorded_to=recorded_to
+        ),
+        limit=limit or DEFAULT_PAGE_SIZE,
+        after=_decode_cursor(cursor) if cursor is not None else None,
+        fields=fields,
+    )
+
+    # Items are already in their serialized shape
+    return orjson_response(
+        {
+            "items": page.items,
+            "total": page.total,
+            "next_cursor": _encode_cursor(page.next_key) if page.next_key else None,
+        }
     )
 
-    return ListedResourcesResponse(items=items, total=len(items))
+
+@router.get(
+    status_code=HTTPStatus.OK,
+    path="/cache/stats",
+    response_model=EHRContextsCacheStats,
+)
+async def get_ehr_context_items_cache_stats(
+    ehr_contexts_cache: EHRContextsCache = Depends(get_ehr_contexts_cache),
+) -> EHRContextsCacheStats:
+    return ehr_contexts_cache.stats()
+
+
+def _encode_cursor(key: EHRContextItemKey) -> str:
+    recorded_at = key.recorded_at.isoformat() if key.recorded_at else ""
+    return base64.urlsafe_b64encode(f"{recorded_at}|{key.id}".encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> EHRContextItemKey:
+    try:
+        recorded_at, item_id = base64.urlsafe_b64decode(cursor).decode().split("|")
+        return EHRContextItemKey(
+            recorded_at=date.fromisoformat(recorded_at) if recorded_at else None,
+            id=UUID(item_id),
+        )
+    except ValueError:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Invalid cursor")
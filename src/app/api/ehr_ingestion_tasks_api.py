@@ -1,26 +1,94 @@
 from http import HTTPStatus
-from uuid import uuid4
+from uuid import UUID
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Request
 
 from app.api.api_response_models import CreatedResourceResponse
-from app.api.dependencies import get_ehr_contexts_service
+from app.api.dependencies import (
+    get_ehr_contexts_service,
+    get_ehr_ingestion_tasks_service,
+)
+from app.api.ndjson import iter_ndjson_lines
+from app.core.app_settings import get_app_settings
 from app.domain.ehr_ingestion.ehr_contexts_service import EHRContextsService
+from app.domain.ehr_ingestion.ehr_ingestion_models import (
+    EHRBulkIngestionResult,
+    EHRIngestionTask,
+    EHRIngestionTaskStats,
+)
+from app.domain.ehr_ingestion.ehr_ingestion_tasks_service import (
+    EHRIngestionTasksService,
+)
 from app.domain.ehr_ingestion.ehr_models import ElectronicPatientRecord
 
 router = APIRouter()
 
 
 @router.post(
-    status_code=HTTPStatus.CREATED, path="", response_model=CreatedResourceResponse
+    status_code=HTTPStatus.ACCEPTED, path="", response_model=CreatedResourceResponse
 )
 async def create_ehr_ingestion_task(
     ehr: ElectronicPatientRecord,
-    ehr_contexts_service: EHRContextsService = Depends(get_ehr_contexts_service),
+    ehr_ingestion_tasks_service: EHRIngestionTasksService = Depends(
+        get_ehr_ingestion_tasks_service
+    ),
 ) -> CreatedResourceResponse:
-    # Mocking a task id, this could eventually run as a background task, right now I will just generate a UUID
-    task_id = uuid4()
+    # The EHR is ingested by a background worker, poll the task for its status
+    task = await ehr_ingestion_tasks_service.create_task(ehr=ehr)
 
-    await ehr_contexts_service.ingest_ehr(ehr=ehr)
+    return CreatedResourceResponse(id=task.id)
+
+
+@router.post(
+    status_code=HTTPStatus.OK,
+    path="/bulk",
+    response_model=EHRBulkIngestionResult,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "description": "One ElectronicPatientRecord JSON document per line",
+            "content": {"application/x-ndjson": {"schema": {"type": "string"}}},
+        }
+    },
+)
+async def create_ehr_bulk_ingestion_task(
+    request: Request,
+    ehr_contexts_service: EHRContextsService = Depends(get_ehr_contexts_service),
+) -> EHRBulkIngestionResult:
+    return await ehr_contexts_service.ingest_ehr_ndjson(
+        lines=iter_ndjson_lines(request.stream()),
+        batch_size=get_app_settings().bulk_ingestion_batch_size,
+    )
+
+
+@router.get(
+    status_code=HTTPStatus.OK,
+    path="/stats",
+    response_model=EHRIngestionTaskStats,
+)
+async def get_ehr_ingestion_task_stats(
+    ehr_ingestion_tasks_service: EHRIngestionTasksService = Depends(
+        get_ehr_ingestion_tasks_service
+    ),
+) -> EHRIngestionTaskStats:
+    return await ehr_ingestion_tasks_service.get_stats()
+
+
+@router.get(
+    status_code=HTTPStatus.OK,
+    path="/{task_id}",
+    response_model=EHRIngestionTask,
+)
+async def get_ehr_ingestion_task(
+    task_id: UUID,
+    ehr_ingestion_tasks_service: EHRIngestionTasksService = Depends(
+        get_ehr_ingestion_tasks_service
+    ),
+) -> EHRIngestionTask:
+    task = await ehr_ingestion_tasks_service.get_task(task_id)
+    if task is None:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Ingestion task not found"
+        )
 
-    return CreatedResourceResponse(id=task_id)
+    return task
@@ -1,14 +1,61 @@
+import logging
+from contextlib import aclosing
 from http import HTTPStatus
+from typing import AsyncIterator, Optional
 
-from fastapi import APIRouter, Body, Depends, Path
+from fastapi import APIRouter, Body, Depends, Path, Query, Response
+from fastapi.responses import StreamingResponse
 
-from app.api.dependencies import get_ehr_query_service
-from app.domain.ehr_query.ehr_query_models import EHRQuery, EHRQueryOutput
-from app.domain.ehr_query.ehr_query_service import EHRQueryService
+from app.api.dependencies import (
+    get_ehr_context_type_router,
+    get_ehr_query_service,
+    get_llm_rate_limiter,
+)
+from app.api.ndjson import NDJSON_MEDIA_TYPE, format_ndjson_line
+from app.api.sse import SSE_MEDIA_TYPE, format_sse_event
+from app.core.app_settings import get_app_settings
+from app.domain.ehr_query.ehr_prompt_utils import record_prompt_tokens
+from app.domain.ehr_query.ehr_query_models import (
+    EHRBatchQuery,
+    EHRBatchQueryOutput,
+    EHRPatientsQuery,
+    EHRQuery,
+    EHRQueryAnswerDelta,
+    EHRQueryMode,
+    EHRQueryOutput,
+    EHRQueryReferences,
+    EHRQueryStreamError,
+)
+from app.domain.ehr_query.ehr_query_service import (
+    ContextSelection,
+    EHRQueryService,
+    record_context_selections,
+)
+from app.domain.ehr_query.ehr_type_router import (
+    EHRContextTypeRouter,
+    EHRContextTypeRoutingStats,
+)
+from app.domain.llm.llm_rate_limiter import LLMRateLimiter, LLMRateLimiterStats
+from app.domain.llm.llm_response_cache import record_llm_cache_statuses
 
 
 router = APIRouter()
 
+LLM_CACHE_HEADER = "X-LLM-Cache"
+PROMPT_TOKENS_HEADER = "X-Prompt-Tokens"
+CONTEXT_SELECTION_HEADER = "X-Context-Selection"
+
+logger = logging.getLogger(__name__)
+
+
+def format_context_selections(selections: list[ContextSelection]) -> str:
+    # Whether the contexts were selected, and the candidates' approximate
+    # tokens, e.g. "skipped;tokens=412"
+    return ", ".join(
+        f"{selection.decision};tokens={selection.candidate_tokens}"
+        for selection in selections
+    )
+
 
 @router.post(
     path="/{patient_id}/query",
@@ -16,8 +63,184 @@ router = APIRouter()
     response_model=EHRQueryOutput,
 )
 async def query_ehr(
+    response: Response,
     patient_id: str = Path(..., description="EHR Patient Id"),
     ehr_query: EHRQuery = Body(...),
+    mode: Optional[EHRQueryMode] = Query(
+        default=None,
+        description=(
+            "single_call to select the contexts and answer in one LLM call,"
+            " two_calls to make a call for each. As QUERY_MODE by default."
+        ),
+    ),
     ehr_query_service: EHRQueryService = Depends(get_ehr_query_service),
 ) -> EHRQueryOutput:
-    return await ehr_query_service.query(patient_id=patient_id, ehr_query=ehr_query)
+    with (
+        record_llm_cache_statuses() as llm_cache_statuses,
+        record_prompt_tokens() as prompt_tokens,
+        record_context_selections() as context_selections,
+    ):
+        output = await ehr_query_service.query(
+            patient_id=patient_id, ehr_query=ehr_query, mode=mode
+        )
+
+    # One status per cached LLM call, in call order, e.g. "hit, miss"
+    if llm_cache_statuses:
+        response.headers[LLM_CACHE_HEADER] = ", ".join(llm_cache_statuses)
+    # Approximate tokens of the selection and answer prompts, e.g. "812, 240",
+    # or of the one prompt of a single call
+    response.headers[PROMPT_TOKENS_HEADER] = ", ".join(map(str, prompt_tokens))
+    response.headers[CONTEXT_SELECTION_HEADER] = format_context_selections(
+        context_selections
+    )
+
+    return output
+
+
+@router.post(
+    path="/{patient_id}/batch-query",
+    status_code=HTTPStatus.OK,
+    response_model=EHRBatchQueryOutput,
+)
+async def batch_query_ehr(
+    response: Response,
+    patient_id: str = Path(..., description="EHR Patient Id"),
+    ehr_batch_query: EHRBatchQuery = Body(...),
+    ehr_query_service: EHRQueryService = Depends(get_ehr_query_service),
+) -> EHRBatchQueryOutput:
+    with (
+        record_llm_cache_statuses() as llm_cache_statuses,
+        record_prompt_tokens() as prompt_tokens,
+        record_context_selections() as context_selections,
+    ):
+        output = await ehr_query_service.batch_query(
+            patient_id=patient_id, ehr_batch_query=ehr_batch_query
+        )
+
+    # As for a single query, with answers in completion order
+    if llm_cache_statuses:
+        response.headers[LLM_CACHE_HEADER] = ", ".join(llm_cache_statuses)
+    response.headers[PROMPT_TOKENS_HEADER] = ", ".join(map(str, prompt_tokens))
+    response.headers[CONTEXT_SELECTION_HEADER] = format_context_selections(
+        context_selections
+    )
+
+    return output
+
+
+@router.post(
+    path="/patients-query",
+    status_code=HTTPStatus.OK,
+    response_class=StreamingResponse,
+    responses={
+        HTTPStatus.OK: {
+            "description": (
+                "One EHRPatientQueryResult JSON document per line, per patient,"
+                " in completion order"
+            ),
+            "content": {NDJSON_MEDIA_TYPE: {"schema": {"type": "string"}}},
+        }
+    },
+)
+async def query_ehr_patients(
+    ehr_patients_query: EHRPatientsQuery = Body(...),
+    ehr_query_service: EHRQueryService = Depends(get_ehr_query_service),
+) -> StreamingResponse:
+    # All the patients share the service's pool-backed repository factory and
+    # its LLM client
+    results = ehr_query_service.query_patients(
+        ehr_patients_query,
+        concurrency=get_app_settings().query_patients_concurrency,
+    )
+
+    async def lines() -> AsyncIterator[bytes]:
+        # Closing the results, e.g. when the client disconnects, cancels the
+        # queries still running
+        async with aclosing(results):
+            async for result in results:
+                yield format_ndjson_line(result)
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE)
+
+
+@router.post(
+    path="/{patient_id}/query/stream",
+    status_code=HTTPStatus.OK,
+    response_class=StreamingResponse,
+    responses={
+        HTTPStatus.OK: {
+            "description": (
+                "Server-sent events: one `references` event with the selected"
+                " contexts, `answer_delta` events with the answer text as it is"
+                " generated, then `done` (or `error`)"
+            ),
+            "content": {SSE_MEDIA_TYPE: {"schema": {"type": "string"}}},
+        }
+    },
+)
+async def stream_query_ehr(
+    patient_id: str = Path(..., description="EHR Patient Id"),
+    ehr_query: EHRQuery = Body(...),
+    ehr_query_service: EHRQueryService = Depends(get_ehr_query_service),
+) -> StreamingResponse:
+    # Selection runs before the response starts, so that its failures are still
+    # reported with an error status
+    with (
+        record_prompt_tokens() as prompt_tokens,
+        record_context_selections() as context_selections,
+    ):
+        references = await ehr_query_service.select_references(
+            patient_id=patient_id, ehr_query=ehr_query
+        )
+        answer_deltas = ehr_query_service.stream_answer(ehr_query, references)
+
+    async def events() -> AsyncIterator[bytes]:
+        yield format_sse_event("references", EHRQueryReferences(references=references))
+
+        try:
+            async for delta in answer_deltas:
+                yield format_sse_event("answer_delta", EHRQueryAnswerDelta(delta=delta))
+        except Exception:
+            logger.exception("Streaming the answer for patient %s failed", patient_id)
+            yield format_sse_event(
+                "error", EHRQueryStreamError(detail="Answer generation failed")
+            )
+            return
+
+        yield format_sse_event("done")
+
+    return StreamingResponse(
+        events(),
+        media_type=SSE_MEDIA_TYPE,
+        # Proxies must not buffer the events
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            PROMPT_TOKENS_HEADER: ", ".join(map(str, prompt_tokens)),
+            CONTEXT_SELECTION_HEADER: format_context_selections(context_selections),
+        },
+    )
+
+
+@router.get(
+    path="/routing/stats",
+    status_code=HTTPStatus.OK,
+    response_model=EHRContextTypeRoutingStats,
+)
+async def get_ehr_query_routing_stats(
+    ehr_context_type_router: EHRContextTypeRouter = Depends(
+        get_ehr_context_type_router
+    ),
+) -> EHRContextTypeRoutingStats:
+    return ehr_context_type_router.stats()
+
+
+@router.get(
+    path="/llm/stats",
+    status_code=HTTPStatus.OK,
+    response_model=LLMRateLimiterStats,
+)
+async def get_ehr_query_llm_stats(
+    llm_rate_limiter: LLMRateLimiter = Depends(get_llm_rate_limiter),
+) -> LLMRateLimiterStats:
+    return llm_rate_limiter.stats()
@@ -0,0 +1,109 @@
+from http import HTTPStatus
+
+import asyncpg
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+
+from app.api.dependencies import (
+    get_db_pool,
+    get_ehr_contexts_cache,
+    get_llm_rate_limiter,
+)
+from app.core.metrics import (
+    ANSWER_CACHE_REQUESTS,
+    LLM_CACHE_REQUESTS,
+    QUERY_CANDIDATE_TOKENS,
+    QUERY_CONTEXT_SELECTIONS,
+    STAGE_DURATION_SECONDS,
+    format_metric,
+)
+from app.domain.ehr_ingestion.ehr_contexts_cache import EHRContextsCache
+from app.domain.llm.llm_rate_limiter import LLMRateLimiter
+
+PROMETHEUS_MEDIA_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+router = APIRouter()
+
+
+@router.get(
+    path="",
+    status_code=HTTPStatus.OK,
+    response_class=PlainTextResponse,
+)
+async def get_metrics(
+    pool: asyncpg.Pool = Depends(get_db_pool),
+    ehr_contexts_cache: EHRContextsCache = Depends(get_ehr_contexts_cache),
+    llm_rate_limiter: LLMRateLimiter = Depends(get_llm_rate_limiter),
+) -> PlainTextResponse:
+    """Metrics of this process in the Prometheus text format."""
+    pool_size = pool.get_size()
+    pool_idle = pool.get_idle_size()
+    contexts_cache = ehr_contexts_cache.stats()
+    llm = llm_rate_limiter.stats()
+
+    lines = [
+        *STAGE_DURATION_SECONDS.render(),
+        *format_metric(
+            "ehr_db_pool_connections",
+            "gauge",
+            "Open database pool connections, by state.",
+            [
+                ((("state", "in_use"),), pool_size - pool_idle),
+                ((("state", "idle"),), pool_idle),
+            ],
+        ),
+        *format_metric(
+            "ehr_db_pool_max_connections",
+            "gauge",
+            "Maximum size of the database pool.",
+            [((), pool.get_max_size())],
+        ),
+        *format_metric(
+            "ehr_contexts_cache_requests_total",
+            "counter",
+            "Patient context reads looked up in the contexts cache, by result.",
+            [
+                ((("result", "hit"),), contexts_cache.hits),
+                ((("result", "miss"),), contexts_cache.misses),
+            ],
+        ),
+        *format_metric(
+            "ehr_contexts_cache_patients",
+            "gauge",
+            "Patients in the contexts cache.",
+            [((), contexts_cache.size)],
+        ),
+        *LLM_CACHE_REQUESTS.render(),
+        *format_metric(
+            "ehr_llm_requests_total",
+            "counter",
+            "LLM calls made to the API (response cache misses).",
+            [((), llm.requests)],
+        ),
+        *format_metric(
+            "ehr_llm_tokens_total",
+            "counter",
+            "Approximate tokens of the LLM calls made, by kind.",
+            [
+                ((("kind", "prompt"),), llm.prompt_tokens),
+                ((("kind", "output"),), llm.output_tokens),
+            ],
+        ),
+        *format_metric(
+            "ehr_llm_queue_wait_seconds_total",
+            "counter",
+            "Time LLM calls waited for the concurrency and rate limits.",
+            [((), llm.wait_seconds_total)],
+        ),
+        *format_metric(
+            "ehr_llm_in_flight",
+            "gauge",
+            "LLM calls in flight.",
+            [((), llm.in_flight)],
+        ),
+        *QUERY_CONTEXT_SELECTIONS.render(),
+        *QUERY_CANDIDATE_TOKENS.render(),
+        *ANSWER_CACHE_REQUESTS.render(),
+    ]
+
+    return PlainTextResponse("\n".join(lines) + "\n", media_type=PROMETHEUS_MEDIA_TYPE)
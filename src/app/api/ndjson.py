@@ -0,0 +1,27 @@
+from typing import AsyncIterable, AsyncIterator
+
+from pydantic import BaseModel
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+async def iter_ndjson_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """Splits a stream of body chunks into NDJSON lines without reading the whole
+    body in memory. Line endings are stripped and the last line does not need a
+    trailing newline."""
+
+    pending = bytearray()
+    async for chunk in chunks:
+        *lines, rest = chunk.split(b"\n")
+        for line in lines:
+            pending += line
+            yield bytes(pending).rstrip(b"\r")
+            pending.clear()
+        pending += rest
+
+    if pending:
+        yield bytes(pending).rstrip(b"\r")
+
+
+def format_ndjson_line(data: BaseModel) -> bytes:
+    return data.model_dump_json().encode() + b"\n"
@@ -0,0 +1,46 @@
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core.timing import TimingSpan, record_timing_spans
+
+SERVER_TIMING_HEADER = "Server-Timing"
+
+
+def format_server_timing(spans: list[TimingSpan]) -> str:
+    """One metric per stage, in first-completion order, with its durations
+    summed, e.g. "db_read;dur=3.1, llm_selection;dur=812.4"."""
+    durations: dict[str, float] = {}
+    for span in spans:
+        durations[span.stage] = durations.get(span.stage, 0.0) + span.seconds
+
+    return ", ".join(
+        f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in durations.items()
+    )
+
+
+class ServerTimingMiddleware:
+    """Reports the stages timed while handling a request in its Server-Timing
+    header. Streamed responses only report the stages done before their first
+    byte, e.g. not the streamed answer."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with record_timing_spans() as spans:
+
+            async def send_with_server_timing(message: Message) -> None:
+                if message["type"] == "http.response.start" and spans:
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (
+                            SERVER_TIMING_HEADER.lower().encode(),
+                            format_server_timing(spans).encode(),
+                        ),
+                    ]
+                await send(message)
+
+            await self.app(scope, receive, send_with_server_timing)
@@ -0,0 +1,12 @@
+from typing import Optional
+
+from pydantic import BaseModel
+
+SSE_MEDIA_TYPE = "text/event-stream"
+
+
+def format_sse_event(event: str, data: Optional[BaseModel] = None) -> bytes:
+    """A server-sent event whose data is the JSON of the model (an empty object
+    without one), on a single line so that it needs no multi-line framing."""
+    payload = data.model_dump_json() if data is not None else "{}"
+    return f"event: {event}\ndata: {payload}\n\n".encode()
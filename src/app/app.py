@@ -1,10 +1,36 @@
-from contextlib import asynccontextmanager
-from typing import AsyncGenerator
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, AsyncGenerator, Optional
 import asyncpg
+import orjson
 from fastapi import FastAPI
 
 from app.api.api import setup_api
+from app.api.server_timing import ServerTimingMiddleware
 from app.core.app_settings import get_app_settings
+from app.domain.ehr_ingestion.ehr_contexts_cache import (
+    EHRContextsCache,
+    EHRContextsInvalidationListener,
+)
+from app.domain.ehr_ingestion.ehr_ingestion_workers import EHRIngestionWorkers
+from app.domain.ehr_query.ehr_answer_cache import EHRAnswerCache
+from app.domain.ehr_query.ehr_type_router import (
+    EHRContextTypeRouter,
+    EmbeddingEHRContextTypeClassifier,
+)
+from app.domain.llm.embedding_client import EmbeddingClient
+from app.domain.llm.llm_rate_limiter import LLMRateLimiter
+from app.domain.llm.llm_response_cache import (
+    InMemoryLLMResponseCache,
+    LLMResponseCache,
+)
+from app.infrastructure.ehr_query.postgres_ehr_answer_store import (
+    PostgresEHRAnswerStore,
+)
+from app.infrastructure.llm.hashing_embedding_client import HashingEmbeddingClient
+from app.infrastructure.llm.openai_llm_client import OpenAILLMClient
+from app.infrastructure.llm.postgres_llm_response_cache import (
+    PostgresLLMResponseCache,
+)
 
 CREATE_EHR_CONTEXT_TABLE = """
 CREATE TABLE IF NOT EXISTS ehr_patient_context (
@@ -25,25 +51,245 @@ CREATE INDEX IF NOT EXISTS idx_ehr_context_patient
 CREATE INDEX IF NOT EXISTS idx_ehr_context_patient_type
     ON ehr_patient_context (patient_id, type);
 
+ALTER TABLE ehr_patient_context
+    ADD COLUMN IF NOT EXISTS item_key TEXT,
+    ADD COLUMN IF NOT EXISTS content_hash TEXT,
+    ADD COLUMN IF NOT EXISTS embedding BYTEA,
+    ADD COLUMN IF NOT EXISTS prompt_fragment TEXT,
+    ADD COLUMN IF NOT EXISTS prompt_tokens INTEGER,
+    ADD COLUMN IF NOT EXISTS prompt_fragment_version INTEGER;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_ehr_context_patient_item_key
+    ON ehr_patient_context (patient_id, item_key);
+
+-- Keyset pagination of listings, see EhrContextsRepository.list_page_by_patient
+CREATE INDEX IF NOT EXISTS idx_ehr_context_patient_recorded_at
+    ON ehr_patient_context (
+        patient_id, (COALESCE(source_recorded_at, '-infinity'::date)), id
+    );
+
+-- Every item of a patient in one row, see EhrContextsRepository.write_snapshots.
+-- The payloads are large enough to be compressed by TOAST.
+CREATE TABLE IF NOT EXISTS ehr_patient_context_snapshot (
+    patient_id TEXT PRIMARY KEY,
+    version BIGINT NOT NULL,
+    item_count INTEGER NOT NULL,
+    items BYTEA NOT NULL, -- JSON array, as the items are listed
+    prompt_fragments BYTEA NOT NULL, -- JSON array, in the order of items
+    embeddings BYTEA, -- float32, in the order of items
+    updated_at TIMESTAMPTZ NOT NULL
+);
+
+-- Embeddings barely compress, uncompressed they are read faster
+ALTER TABLE ehr_patient_context_snapshot
+    ALTER COLUMN embeddings SET STORAGE EXTERNAL;
+
 """
 
+CREATE_EHR_INGESTION_TASK_TABLE = """
+CREATE TABLE IF NOT EXISTS ehr_ingestion_task (
+    id UUID PRIMARY KEY,
+    patient_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    payload JSON NOT NULL, -- not JSONB, key order shapes the context contents
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMPTZ NOT NULL,
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_ehr_ingestion_task_pending
+    ON ehr_ingestion_task (created_at)
+    WHERE status = 'pending';
+
+-- Start of the current claim, running tasks whose lease expired are claimed
+-- again, see EhrIngestionTasksRepository.claim_next
+ALTER TABLE ehr_ingestion_task
+    ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_ehr_ingestion_task_running
+    ON ehr_ingestion_task (claimed_at)
+    WHERE status = 'running';
+
+"""
+
+CREATE_LLM_RESPONSE_CACHE_TABLE = """
+CREATE TABLE IF NOT EXISTS llm_response_cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_llm_response_cache_created_at
+    ON llm_response_cache (created_at);
+
+"""
+
+CREATE_EHR_QUERY_ANSWER_CACHE_TABLE = """
+CREATE TABLE IF NOT EXISTS ehr_query_answer_cache (
+    patient_id TEXT NOT NULL,
+    context_version BIGINT NOT NULL,
+    question_hash TEXT NOT NULL,
+    value BYTEA NOT NULL, -- EHRQueryOutput as JSON
+    created_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (patient_id, context_version, question_hash)
+);
+
+CREATE INDEX IF NOT EXISTS idx_ehr_query_answer_cache_created_at
+    ON ehr_query_answer_cache (created_at);
+
+"""
+
+
+def _encode_jsonb(value: Any) -> bytes:
+    # Binary format of jsonb, which COPY requires: a version byte followed by
+    # the JSON text. Dates are written in ISO format, anything else unknown as
+    # its str().
+    return b"\x01" + orjson.dumps(value, default=str)
+
+
+def _decode_jsonb(data: bytes) -> Any:
+    return orjson.loads(memoryview(data)[1:])
+
+
+async def init_connection(conn: asyncpg.Connection) -> None:
+    """Decodes JSONB columns to Python objects, and encodes them back, with
+    orjson rather than leaving JSON text to parse for every row."""
+
+    await conn.set_type_codec(
+        "jsonb",
+        schema="pg_catalog",
+        encoder=_encode_jsonb,
+        decoder=_decode_jsonb,
+        format="binary",
+    )
+
 
 async def bootstrap_schema(pool: asyncpg.Pool) -> None:
     async with pool.acquire() as conn:
         await conn.execute(CREATE_EHR_CONTEXT_TABLE)
+        await conn.execute(CREATE_EHR_INGESTION_TASK_TABLE)
+        await conn.execute(CREATE_LLM_RESPONSE_CACHE_TABLE)
+        await conn.execute(CREATE_EHR_QUERY_ANSWER_CACHE_TABLE)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     app_settings = get_app_settings()
 
-    try:
-        pool = await asyncpg.create_pool(dsn=app_settings.database_url)
+    # Resources are released in reverse order, e.g. workers stop before the pool
+    # they use is closed
+    async with AsyncExitStack() as resources:
+        pool = await asyncpg.create_pool(
+            dsn=app_settings.database_url, init=init_connection
+        )
+        resources.push_async_callback(pool.close)
         await bootstrap_schema(pool)
         app.state.pool = pool
+
+        ehr_contexts_cache = EHRContextsCache(
+            max_patients=app_settings.context_cache_max_patients,
+            ttl_seconds=app_settings.context_cache_ttl_seconds,
+        )
+        app.state.ehr_contexts_cache = ehr_contexts_cache
+
+        if app_settings.context_cache_listen_notify:
+            invalidation_listener = EHRContextsInvalidationListener(
+                dsn=app_settings.database_url, ehr_contexts_cache=ehr_contexts_cache
+            )
+            await invalidation_listener.start()
+            resources.push_async_callback(invalidation_listener.stop)
+
+        # Only the vector prefilter and the type classifier embed texts
+        embedding_client: Optional[EmbeddingClient] = None
+        if (
+            app_settings.query_prefilter == "vector"
+            or app_settings.query_type_routing_classifier
+        ):
+            embedding_client = HashingEmbeddingClient(
+                dimensions=app_settings.embedding_dimensions
+            )
+        app.state.embedding_client = embedding_client
+
+        # Lives with the app so that its routing stats cover every query
+        app.state.ehr_context_type_router = EHRContextTypeRouter(
+            classifier=(
+                EmbeddingEHRContextTypeClassifier(
+                    embedding_client=embedding_client,
+                    min_similarity=app_settings.query_type_routing_min_similarity,
+                )
+                if app_settings.query_type_routing_classifier
+                and embedding_client is not None
+                else None
+            )
+        )
+
+        llm_response_cache: Optional[LLMResponseCache] = None
+        if app_settings.llm_cache == "memory":
+            llm_response_cache = InMemoryLLMResponseCache(
+                max_entries=app_settings.llm_cache_max_entries,
+                ttl_seconds=app_settings.llm_cache_ttl_seconds,
+            )
+        elif app_settings.llm_cache == "postgres":
+            llm_response_cache = PostgresLLMResponseCache(
+                pool=pool,
+                max_entries=app_settings.llm_cache_max_entries,
+                ttl_seconds=app_settings.llm_cache_ttl_seconds,
+            )
+        app.state.llm_response_cache = llm_response_cache
+
+        ehr_answer_cache: Optional[EHRAnswerCache] = None
+        if app_settings.answer_cache != "none":
+            ehr_answer_cache = EHRAnswerCache(
+                max_entries=app_settings.answer_cache_max_entries,
+                ttl_seconds=app_settings.answer_cache_ttl_seconds,
+                store=(
+                    PostgresEHRAnswerStore(
+                        pool=pool,
+                        max_entries=app_settings.answer_cache_max_entries,
+                        ttl_seconds=app_settings.answer_cache_ttl_seconds,
+                    )
+                    if app_settings.answer_cache == "postgres"
+                    else None
+                ),
+            )
+            # Also invalidated by the ingestions of other processes
+            ehr_contexts_cache.add_invalidation_listener(ehr_answer_cache.invalidate)
+            ehr_contexts_cache.add_clear_listener(ehr_answer_cache.clear)
+        app.state.ehr_answer_cache = ehr_answer_cache
+
+        openai_llm_client = OpenAILLMClient(
+            api_key=app_settings.openai_api_key,
+            max_connections=app_settings.llm_max_connections,
+            max_keepalive_connections=app_settings.llm_max_keepalive_connections,
+            base_url=app_settings.openai_base_url,
+        )
+        resources.push_async_callback(openai_llm_client.close)
+        app.state.openai_llm_client = openai_llm_client
+
+        app.state.llm_rate_limiter = LLMRateLimiter(
+            max_concurrency=app_settings.llm_max_concurrency,
+            requests_per_minute=app_settings.llm_requests_per_minute,
+            tokens_per_minute=app_settings.llm_tokens_per_minute,
+        )
+
+        ehr_ingestion_workers = EHRIngestionWorkers(
+            pool=pool,
+            concurrency=app_settings.ingestion_workers,
+            poll_interval_seconds=app_settings.ingestion_poll_interval_seconds,
+            lease_seconds=app_settings.ingestion_task_lease_seconds,
+            max_attempts=app_settings.ingestion_task_max_attempts,
+            ehr_contexts_cache=ehr_contexts_cache,
+            embedding_client=(
+                embedding_client if app_settings.embeds_context_items else None
+            ),
+        )
+        ehr_ingestion_workers.start()
+        resources.push_async_callback(ehr_ingestion_workers.stop)
+        app.state.ehr_ingestion_workers = ehr_ingestion_workers
+
         yield
-    finally:
-        await app.state.pool.close()
 
 
 def create_app() -> FastAPI:
@@ -56,5 +302,6 @@ def create_app() -> FastAPI:
     )
 
     setup_api(app)
+    app.add_middleware(ServerTimingMiddleware)
 
     return app
@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings
 
 
@@ -9,6 +11,103 @@ class Settings(BaseSettings):
     db_password: str | None = None
 
     openai_api_key: str
+    # Alternative OpenAI-compatible endpoint, e.g. the local stand-in used for
+    # load tests (python -m tools.fake_openai_server)
+    openai_base_url: str | None = None
+
+    # Records written per COPY when streaming bulk NDJSON ingestions
+    bulk_ingestion_batch_size: int = 500
+
+    # In-process workers running queued ingestion tasks, and how often they poll
+    # for tasks queued by other processes
+    ingestion_workers: int = 4
+    ingestion_poll_interval_seconds: float = 1.0
+    # Running tasks not finished within the lease, e.g. of a process that
+    # crashed, are claimed again, up to MAX_ATTEMPTS claims, then failed
+    ingestion_task_lease_seconds: float = 600
+    ingestion_task_max_attempts: int = 3
+
+    # Per-patient cache of context items (0 patients disables it). With
+    # LISTEN/NOTIFY enabled, ingestions in other processes invalidate it too.
+    context_cache_max_patients: int = 1000
+    context_cache_ttl_seconds: float = 300
+    context_cache_listen_notify: bool = True
+
+    # Prefilter of the contexts sent to the LLM selection step, lexical (BM25)
+    # or by embedding similarity: keeps the top K matches, patients with up to
+    # BYPASS_MAX_ITEMS items are not filtered. Disabled by default, it may leave
+    # out contexts the LLM would have selected.
+    query_prefilter: Literal["none", "lexical", "vector"] = "none"
+    query_prefilter_top_k: int = 40
+    query_prefilter_bypass_max_items: int = 60
+
+    # Approximate token budget of the LLM selection prompt: past it, the items
+    # least related to the question are left out. Longer items are cut in the
+    # selection prompt, the answer prompt always has the selected items whole.
+    # Disabled by default, they may leave out contexts the LLM would have used.
+    prompt_token_budget: int | None = None
+    prompt_item_max_tokens: int | None = None
+
+    # How single queries use the LLM: a selection call then an answer call
+    # (two_calls), one structured call that answers and cites the contexts
+    # (single_call), or single_call as long as its prompt is of up to
+    # QUERY_SINGLE_CALL_MAX_TOKENS and two_calls past it (auto). Requests can
+    # pick the mode themselves.
+    query_mode: Literal["two_calls", "single_call", "auto"] = "two_calls"
+    query_single_call_max_tokens: int = 3000
+
+    # Queries whose candidates add up to fewer approximate tokens are answered
+    # from all of them, without a selection call (0, the default, always
+    # selects). Decisions and candidate sizes are exposed in /metrics to tune it.
+    query_skip_selection_below_tokens: int = 0
+
+    # Answers generated at once for the questions of one batch query
+    query_batch_concurrency: int = 4
+
+    # Patients queried at once by a multi-patient query
+    query_patients_concurrency: int = 16
+
+    # Routing of questions to the types of context they are about (keywords,
+    # then optionally an embedding classifier), so that only those types are
+    # read and sent to the LLM. Questions that match nothing see every type.
+    # Disabled by default, it may leave out contexts the LLM would have used.
+    query_type_routing: bool = False
+    query_type_routing_classifier: bool = False
+    query_type_routing_min_similarity: float = 0.25
+
+    # Cache of LLM responses to identical prompts, per process (memory) or
+    # shared by every process (postgres). Disabled by default, a cached response
+    # is served for up to the TTL.
+    llm_cache: Literal["none", "memory", "postgres"] = "none"
+    llm_cache_max_entries: int = 10000
+    llm_cache_ttl_seconds: float = 3600
+
+    # Cache of whole query answers by patient context version and normalized
+    # question, so that repeated questions make no LLM call until the patient
+    # changes: per process (memory), or also shared by every process and kept
+    # across restarts (postgres). Disabled by default, a cached answer is served
+    # for up to the TTL.
+    answer_cache: Literal["none", "memory", "postgres"] = "none"
+    answer_cache_max_entries: int = 10000
+    answer_cache_ttl_seconds: float = 86400
+
+    # LLM client shared by the process: HTTP connections kept to the API, and
+    # limits on the calls in flight and per minute (0 disables the per-minute
+    # ones, meant to be set to the account's limits). Calls past a limit queue.
+    llm_max_connections: int = 100
+    llm_max_keepalive_connections: int = 20
+    llm_max_concurrency: int = 32
+    llm_requests_per_minute: float = 0
+    llm_tokens_per_minute: float = 0
+
+    # Size of the local embeddings of the vector prefilter, computed for every
+    # context item at ingestion while it is enabled, and of the type classifier
+    embedding_dimensions: int = 256
+
+    @property
+    def embeds_context_items(self) -> bool:
+        # Stored item embeddings are only read by the vector prefilter
+        return self.query_prefilter == "vector"
 
     @property
     def database_url(self) -> str:
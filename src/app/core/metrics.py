@@ -0,0 +1,167 @@
+import math
+from bisect import bisect_left
+from typing import Iterable, Sequence
+
+# Upper bounds, in seconds, of the latency histogram buckets: from a cached
+# read (about a millisecond) to a slow LLM answer
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+# Upper bounds of the prompt size histogram buckets, in approximate tokens
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_metric(
+    name: str,
+    type: str,
+    help: str,
+    samples: Iterable[tuple[Labels, float]],
+) -> list[str]:
+    """The lines of one metric in the Prometheus text exposition format."""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+    lines.extend(
+        f"{name}{_format_labels(labels)} {_format_value(value)}"
+        for labels, value in samples
+    )
+    return lines
+
+
+class Counter:
+    """Monotonic count per combination of label values."""
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self._label_names = tuple(label_names)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple((name, labels[name]) for name in self._label_names)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        return format_metric(self.name, "counter", self.help, self._values.items())
+
+
+class HistogramChild:
+    """The histogram of one combination of label values."""
+
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self._buckets = buckets
+        # Observations per bucket, the last one being +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self._buckets, value)] += 1
+        self.sum += value
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observations per combination
+    of label values, as Prometheus histograms expose them."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self._label_names = tuple(label_names)
+        self._buckets = tuple(buckets)
+        self._children: dict[Labels, HistogramChild] = {}
+
+    def labels(self, **labels: str) -> HistogramChild:
+        """The histogram of the label values, to observe into. Hot paths keep
+        it rather than looking it up on each observation."""
+        key = tuple((name, labels[name]) for name in self._label_names)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = HistogramChild(self._buckets)
+        return child
+
+    def observe(self, value: float, **labels: str) -> None:
+        self.labels(**labels).observe(value)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip((*self._buckets, math.inf), child.counts):
+                cumulative += count
+                labels = _format_labels((*key, ("le", _format_value(bound))))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+# Process-wide, like the default registry of Prometheus client libraries:
+# stages run in requests and in the ingestion workers alike.
+STAGE_DURATION_SECONDS = Histogram(
+    "ehr_stage_duration_seconds",
+    "Duration of the stages of queries and ingestions.",
+    label_names=["stage"],
+)
+LLM_CACHE_REQUESTS = Counter(
+    "ehr_llm_cache_requests_total",
+    "LLM calls looked up in the response cache, by result.",
+    label_names=["result"],
+)
+QUERY_CONTEXT_SELECTIONS = Counter(
+    "ehr_query_context_selections_total",
+    "Context selections of queries, by decision: made by the LLM, or skipped"
+    " for candidates small enough to all be answered from.",
+    label_names=["decision"],
+)
+QUERY_CANDIDATE_TOKENS = Histogram(
+    "ehr_query_candidate_tokens",
+    "Approximate tokens of the candidate contexts of queries, by selection"
+    " decision.",
+    label_names=["decision"],
+    buckets=TOKEN_BUCKETS,
+)
+ANSWER_CACHE_REQUESTS = Counter(
+    "ehr_answer_cache_requests_total",
+    "Query answers looked up in the answer cache, by tier and result: every"
+    " lookup in memory, and those missed in memory in the store.",
+    label_names=["tier", "result"],
+)
@@ -0,0 +1,69 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from types import TracebackType
+from typing import Iterator, NamedTuple, Optional
+
+from app.core.metrics import STAGE_DURATION_SECONDS, HistogramChild
+
+
+class TimingSpan(NamedTuple):
+    stage: str
+    seconds: float
+
+
+_timing_spans: ContextVar[Optional[list[TimingSpan]]] = ContextVar(
+    "timing_spans", default=None
+)
+
+_stage_durations: dict[str, HistogramChild] = {}
+
+
+@contextmanager
+def record_timing_spans() -> Iterator[list[TimingSpan]]:
+    """Collects the spans of every stage timed within the block, in completion
+    order, e.g. to report them in a Server-Timing header."""
+    spans: list[TimingSpan] = []
+    token = _timing_spans.set(spans)
+    try:
+        yield spans
+    finally:
+        _timing_spans.reset(token)
+
+
+class _TimedStage:
+    # A plain class rather than a generator based context manager: stages are
+    # timed on every query, so this is kept to a couple of microseconds
+    __slots__ = ("_stage", "_started")
+
+    def __init__(self, stage: str) -> None:
+        self._stage = stage
+        self._started = 0.0
+
+    def __enter__(self) -> None:
+        self._started = time.perf_counter()
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        seconds = time.perf_counter() - self._started
+
+        durations = _stage_durations.get(self._stage)
+        if durations is None:
+            durations = _stage_durations[self._stage] = STAGE_DURATION_SECONDS.labels(
+                stage=self._stage
+            )
+        durations.observe(seconds)
+
+        spans = _timing_spans.get()
+        if spans is not None:
+            spans.append(TimingSpan(self._stage, seconds))
+
+
+def timed(stage: str) -> _TimedStage:
+    """Times the block as a stage: observed in the stage duration histogram,
+    and reported to the spans being recorded, if any."""
+    return _TimedStage(stage)
@@ -1,8 +1,8 @@
 from datetime import date, datetime
-from typing import Any, Dict, Optional
+from typing import Any, Dict, NamedTuple, Optional
 from uuid import UUID
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from enum import StrEnum, auto
 
 
@@ -28,6 +28,17 @@ class EHRContextSource(BaseModel):
     recorded_by: Optional[str]
 
 
+class EHRPromptFragment(NamedTuple):
+    """An item as rendered in prompts, stored at ingestion so that queries do
+    not render it again."""
+
+    text: str
+    # Approximate, see count_tokens
+    tokens: int
+    # Of the renderer, fragments of another version are rendered again
+    version: int
+
+
 class EHRContextItem(BaseModel):
     id: UUID
     patient_id: str
@@ -36,3 +47,78 @@ class EHRContextItem(BaseModel):
     data: Optional[Dict[str, Any]] = None
     source: EHRContextSource
     created_at: datetime  # for audit, not to be used as part of context
+
+    # Storage bookkeeping for incremental re-ingestion, never serialized.
+    # item_key identifies the same fact across ingestions of a patient and
+    # content_hash tells whether it changed.
+    item_key: Optional[str] = Field(default=None, exclude=True)
+    content_hash: Optional[str] = Field(default=None, exclude=True)
+
+    # Float32 bytes of the item's search text embedding, computed at ingestion
+    embedding: Optional[bytes] = Field(default=None, exclude=True, repr=False)
+
+    # Rendered at ingestion, see render_ehr_prompt_fragment
+    prompt_fragment: Optional[EHRPromptFragment] = Field(
+        default=None, exclude=True, repr=False
+    )
+
+
+class EHRContextItemField(StrEnum):
+    """Serialized fields of a context item, to project listings on."""
+
+    ID = auto()
+    PATIENT_ID = auto()
+    TYPE = auto()
+    CONTENT = auto()
+    DATA = auto()
+    SOURCE = auto()
+    CREATED_AT = auto()
+
+
+class EHRContextItemsFilter(BaseModel):
+    types: Optional[list[EHRContextType]] = None
+    # Inclusive bounds on source.recorded_at, items without one are left out
+    recorded_from: Optional[date] = None
+    recorded_to: Optional[date] = None
+
+
+class EHRContextItemKey(NamedTuple):
+    """Position of an item in listings, ordered by source.recorded_at (items
+    without one first) and then id."""
+
+    recorded_at: Optional[date]
+    id: UUID
+
+
+class EHRContextItemsPage(NamedTuple):
+    # As EHRContextItem serializes them, possibly only some of the fields
+    items: list[dict[str, Any]]
+    # Of all the pages, with the same filter
+    total: int
+    # Where the next page starts, None on the last one
+    next_key: Optional[EHRContextItemKey]
+
+
+class EHRContextItemsOfTypes(NamedTuple):
+    items: list[EHRContextItem]
+    # Items of the patient of every type, as of its snapshot. None if it has
+    # none yet, or if no item is of the types.
+    total: Optional[int]
+    # Version of the snapshot, read with the items. None like total.
+    version: Optional[int] = None
+
+
+class EHRContextsSnapshot(NamedTuple):
+    """Every item of a patient, written in one row by the ingestions that
+    change them, so that reading the patient is a single row fetch."""
+
+    # Bumped by every write of the patient's snapshot. None for items read
+    # from the rows of a patient that has no snapshot yet.
+    version: Optional[int]
+    items: list[EHRContextItem]
+
+
+class EHRSerializedContextItems(NamedTuple):
+    # A JSON array, as EHRContextItem serializes the items
+    json: bytes
+    total: int
@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from contextlib import suppress
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List, Optional
+from uuid import uuid4
+
+import asyncpg
+import asyncpg.pool
+from pydantic import BaseModel
+
+from app.domain.ehr_ingestion.ehr_context_models import EHRContextsSnapshot
+from app.domain.ehr_ingestion.ehr_contexts_repository import (
+    EHR_CONTEXTS_CHANGED_CHANNEL,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class EHRContextsCacheStats(BaseModel):
+    size: int
+    hits: int
+    misses: int
+    evictions: int
+    invalidations: int
+
+
+@dataclass
+class _Entry:
+    # The items with the version of the snapshot they were read from
+    snapshot: EHRContextsSnapshot
+    expires_at: float
+
+
+class EHRContextsCache:
+    """In-process LRU cache of the context items of a patient, with a TTL.
+    Items are kept with the version of the snapshot they were read from, for
+    whatever is derived from them to be keyed by it.
+
+    Writers invalidate a patient after committing. Loads are versioned against
+    invalidations: a load that started before an invalidation of the same
+    patient is returned to its caller but never cached, so a slow read cannot
+    put back data that a concurrent ingestion already replaced.
+    """
+
+    def __init__(self, max_patients: int, ttl_seconds: float) -> None:
+        # Tags the change notifications sent by this process
+        self.origin = uuid4().hex
+
+        self._max_patients = max_patients
+        self._ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+
+        # Version of the last invalidation of each recently invalidated patient.
+        # Bounded like the entries, loads older than the versions that were
+        # dropped are conservatively not cached.
+        self._version = 0
+        self._invalidated_at: OrderedDict[str, int] = OrderedDict()
+        self._forgotten_version = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+        self._invalidation_listeners: List[Callable[[str], None]] = []
+        self._clear_listeners: List[Callable[[], None]] = []
+
+    async def get_or_load(
+        self,
+        patient_id: str,
+        load: Callable[[], Awaitable[EHRContextsSnapshot]],
+    ) -> EHRContextsSnapshot:
+        cached = self.get(patient_id)
+        if cached is not None:
+            return cached
+
+        version = self._version
+        snapshot = await load()
+        self._put(patient_id, snapshot, version)
+
+        return snapshot._replace(items=list(snapshot.items))
+
+    def get(self, patient_id: str) -> Optional[EHRContextsSnapshot]:
+        """The cached items of the patient, without loading them on a miss."""
+        entry = self._entries.get(patient_id)
+        if entry is not None and entry.expires_at > time.monotonic():
+            self._entries.move_to_end(patient_id)
+            self._hits += 1
+            return entry.snapshot._replace(items=list(entry.snapshot.items))
+
+        self._misses += 1
+        return None
+
+    def add_invalidation_listener(self, listener: Callable[[str], None]) -> None:
+        """Calls listener with the patient of every invalidation, e.g. to drop
+        what other caches derived from its contexts."""
+        self._invalidation_listeners.append(listener)
+
+    def add_clear_listener(self, listener: Callable[[], None]) -> None:
+        """Calls listener whenever every patient is invalidated at once."""
+        self._clear_listeners.append(listener)
+
+    def clear(self) -> None:
+        """Invalidates every patient, e.g. when change notifications may have
+        been missed. Loads in flight are not cached either."""
+        self._version += 1
+        self._invalidations += 1
+        self._entries.clear()
+        for listener in self._clear_listeners:
+            listener()
+
+        self._invalidated_at.clear()
+        self._forgotten_version = self._version
+
+    def invalidate(self, patient_id: str) -> None:
+        self._version += 1
+        self._invalidations += 1
+        self._entries.pop(patient_id, None)
+        for listener in self._invalidation_listeners:
+            listener(patient_id)
+
+        self._invalidated_at[patient_id] = self._version
+        self._invalidated_at.move_to_end(patient_id)
+        if len(self._invalidated_at) > self._max_patients:
+            _, version = self._invalidated_at.popitem(last=False)
+            self._forgotten_version = version
+
+    def stats(self) -> EHRContextsCacheStats:
+        return EHRContextsCacheStats(
+            size=len(self._entries),
+            hits=self._hits,
+            misses=self._misses,
+            evictions=self._evictions,
+            invalidations=self._invalidations,
+        )
+
+    def _put(
+        self,
+        patient_id: str,
+        snapshot: EHRContextsSnapshot,
+        loaded_at_version: int,
+    ) -> None:
+        if self._max_patients <= 0:
+            return
+
+        invalidated_at = self._invalidated_at.get(patient_id, self._forgotten_version)
+        if invalidated_at > loaded_at_version:
+            return
+
+        self._entries[patient_id] = _Entry(
+            snapshot=snapshot, expires_at=time.monotonic() + self._ttl_seconds
+        )
+        self._entries.move_to_end(patient_id)
+        if len(self._entries) > self._max_patients:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+
+class EHRContextsInvalidationListener:
+    """Invalidates the cache when another process notifies that a patient
+    changed, this process invalidates its own writes directly.
+
+    Listens on a dedicated connection. If it is lost, the listener reconnects
+    and clears the cache once listening again: notifications sent in between
+    were missed.
+    """
+
+    def __init__(
+        self,
+        dsn: str,
+        ehr_contexts_cache: EHRContextsCache,
+        reconnect_delay_seconds: float = 1.0,
+    ) -> None:
+        self._dsn = dsn
+        self._ehr_contexts_cache = ehr_contexts_cache
+        self._reconnect_delay_seconds = reconnect_delay_seconds
+        self._conn: Optional[asyncpg.Connection] = None
+        self._reconnect_task: Optional[asyncio.Task[None]] = None
+        self._stopped = False
+
+    async def start(self) -> None:
+        await self._listen()
+
+    async def stop(self) -> None:
+        self._stopped = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._reconnect_task
+        if self._conn is not None:
+            await self._conn.close()
+
+    async def _listen(self) -> None:
+        conn = await asyncpg.connect(dsn=self._dsn)
+        try:
+            await conn.add_listener(EHR_CONTEXTS_CHANGED_CHANNEL, self._invalidate)
+        except BaseException:
+            await conn.close()
+            raise
+
+        conn.add_termination_listener(self._on_terminated)
+        self._conn = conn
+
+    async def _reconnect(self) -> None:
+        while True:
+            try:
+                await self._listen()
+            except Exception:
+                logger.exception(
+                    "Reconnecting the contexts invalidation listener failed"
+                )
+                await asyncio.sleep(self._reconnect_delay_seconds)
+            else:
+                break
+
+        logger.info("Contexts invalidation listener reconnected")
+        self._ehr_contexts_cache.clear()
+        self._reconnect_task = None
+
+    def _on_terminated(
+        self, connection: asyncpg.Connection | asyncpg.pool.PoolConnectionProxy
+    ) -> None:
+        if self._stopped or self._reconnect_task is not None:
+            return
+
+        logger.warning("Contexts invalidation listener connection lost")
+        self._conn = None
+        self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    def _invalidate(
+        self,
+        connection: asyncpg.Connection | asyncpg.pool.PoolConnectionProxy,
+        pid: int,
+        channel: str,
+        payload: object,
+    ) -> None:
+        origin, _, patient_id = str(payload).partition(":")
+        if origin != self._ehr_contexts_cache.origin:
+            self._ehr_contexts_cache.invalidate(patient_id)
@@ -1,14 +1,43 @@
+from contextlib import AbstractAsyncContextManager
 from datetime import date, datetime
 import json
-from typing import Iterable, List, Sequence, Any
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    Iterable,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    TypeVar,
+)
+from uuid import UUID
 
 import asyncpg
+import orjson
+from asyncpg.transaction import Transaction
+from pydantic import BaseModel, TypeAdapter
 
 from app.domain.ehr_ingestion.ehr_context_models import (
     EHRContextItem,
+    EHRContextItemField,
+    EHRContextItemKey,
+    EHRContextItemsFilter,
+    EHRContextItemsOfTypes,
     EHRContextSource,
+    EHRContextsSnapshot,
+    EHRContextType,
+    EHRPromptFragment,
+    EHRSerializedContextItems,
+    EHRSourceType,
 )
 
+# Postgres NOTIFY channel carrying "<origin>:<patient id>" payloads for patients
+# whose contexts changed, see notify_patients_changed
+EHR_CONTEXTS_CHANGED_CHANNEL = "ehr_patient_context_changed"
+
 
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, o: Any) -> Any:
@@ -19,54 +48,190 @@ class CustomJSONEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, o)
 
 
+EHR_CONTEXT_COLUMNS = [
+    "id",
+    "patient_id",
+    "type",
+    "content",
+    "data",
+    "source_type",
+    "source_recorded_at",
+    "source_recorded_by",
+    "created_at",
+    "item_key",
+    "content_hash",
+    "embedding",
+    "prompt_fragment",
+    "prompt_tokens",
+    "prompt_fragment_version",
+]
+
+# Read by list_by_patient only when asked for: most of a row's size, and only
+# used to build prompts and snapshots
+EHR_CONTEXT_EMBEDDING_COLUMNS = ["embedding"]
+EHR_CONTEXT_PROMPT_FRAGMENT_COLUMNS = [
+    "prompt_fragment",
+    "prompt_tokens",
+    "prompt_fragment_version",
+]
+
+# Columns read by listings for each serialized field of the items
+EHR_CONTEXT_FIELD_COLUMNS = {
+    EHRContextItemField.ID: ["id"],
+    EHRContextItemField.PATIENT_ID: ["patient_id"],
+    EHRContextItemField.TYPE: ["type"],
+    EHRContextItemField.CONTENT: ["content"],
+    EHRContextItemField.DATA: ["data"],
+    EHRContextItemField.SOURCE: [
+        "source_type",
+        "source_recorded_at",
+        "source_recorded_by",
+    ],
+    EHRContextItemField.CREATED_AT: ["created_at"],
+}
+
+# Sort key of listings, matching idx_ehr_context_patient_recorded_at. Items
+# without a date sort first, asyncpg maps -infinity to date.min.
+EHR_CONTEXT_RECORDED_AT_KEY = "COALESCE(source_recorded_at, '-infinity'::date)"
+
+
+class EHRContextFingerprint(NamedTuple):
+    id: UUID
+    item_key: Optional[str]
+    content_hash: Optional[str]
+    created_at: datetime
+
+
 class EhrContextsRepository:
     def __init__(self, conn: asyncpg.Connection) -> None:
         self.conn = conn
 
+    def transaction(self) -> Transaction:
+        return self.conn.transaction()
+
+    async def lock_patient(self, patient_id: str) -> None:
+        """Serializes writers of the same patient until the current transaction
+        ends, so concurrent re-ingestions cannot interleave their diffs."""
+
+        await self.conn.execute(
+            "SELECT pg_advisory_xact_lock(hashtextextended($1, 0))", patient_id
+        )
+
+    async def list_fingerprints_by_patient(
+        self, patient_id: str
+    ) -> list[EHRContextFingerprint]:
+        rows = await self.conn.fetch(
+            """
+            SELECT id, item_key, content_hash, created_at
+                FROM
+                    ehr_patient_context
+                WHERE
+                    patient_id = $1
+            """,
+            patient_id,
+        )
+        return [EHRContextFingerprint(*row) for row in rows]
+
+    async def list_fingerprints_by_patient_ids(
+        self, patient_ids: Sequence[str]
+    ) -> dict[str, list[EHRContextFingerprint]]:
+        """Like list_fingerprints_by_patient, for several patients at once.
+        Patients without items are left out."""
+
+        rows = await self.conn.fetch(
+            """
+            SELECT patient_id, id, item_key, content_hash, created_at
+                FROM
+                    ehr_patient_context
+                WHERE
+                    patient_id = ANY($1)
+            """,
+            list(patient_ids),
+        )
+
+        fingerprints: dict[str, list[EHRContextFingerprint]] = {}
+        for patient_id, *fingerprint in rows:
+            fingerprints.setdefault(patient_id, []).append(
+                EHRContextFingerprint(*fingerprint)
+            )
+        return fingerprints
+
     async def insert_many(self, items: list[EHRContextItem]) -> None:
         if not items:
             return
 
-        query = """
+        query = f"""
         INSERT INTO ehr_patient_context (
-            id,
-            patient_id,
-            type,
-            content,
-            data,
-            source_type,
-            source_recorded_at,
-            source_recorded_by,
-            created_at
+            {", ".join(EHR_CONTEXT_COLUMNS)}
         )
         VALUES (
-            $1, $2, $3, $4, $5, $6, $7, $8, $9
+            {", ".join(f"${i}" for i in range(1, len(EHR_CONTEXT_COLUMNS) + 1))}
         )
         """
 
         async with self.conn.transaction():
             await self.conn.executemany(
-                query,
-                [
-                    (
-                        item.id,
-                        item.patient_id,
-                        item.type.value,
-                        item.content,
-                        (
-                            json.dumps(item.data, default=str)
-                            if item.data is not None
-                            else None
-                        ),
-                        item.source.type.value,
-                        item.source.recorded_at,
-                        item.source.recorded_by,
-                        item.created_at,
-                    )
-                    for item in items
-                ],
+                query, [self._context_item_to_record(item) for item in items]
             )
 
+    async def update_many(self, items: list[EHRContextItem]) -> None:
+        """Rewrites the contents of existing items, matched by id. Ids and
+        created_at are kept."""
+
+        if not items:
+            return
+
+        await self.conn.executemany(
+            """
+            UPDATE
+                ehr_patient_context
+            SET
+                type = $2,
+                content = $3,
+                data = $4,
+                source_type = $5,
+                source_recorded_at = $6,
+                source_recorded_by = $7,
+                item_key = $8,
+                content_hash = $9,
+                embedding = $10,
+                prompt_fragment = $11,
+                prompt_tokens = $12,
+                prompt_fragment_version = $13
+            WHERE
+                id = $1
+            """,
+            [
+                (
+                    item.id,
+                    item.type.value,
+                    item.content,
+                    item.data,
+                    item.source.type.value,
+                    item.source.recorded_at,
+                    item.source.recorded_by,
+                    item.item_key,
+                    item.content_hash,
+                    item.embedding,
+                    *self._prompt_fragment_to_record(item),
+                )
+                for item in items
+            ],
+        )
+
+    async def copy_many(self, items: Iterable[EHRContextItem]) -> int:
+        """Bulk writes items with COPY, which is much faster than insert_many for
+        large batches. Callers are responsible for the surrounding transaction."""
+
+        result = await self.conn.copy_records_to_table(
+            "ehr_patient_context",
+            records=(self._context_item_to_record(item) for item in items),
+            columns=EHR_CONTEXT_COLUMNS,
+        )
+
+        _, count = result.split()
+        return int(count)
+
     async def delete_by_patient_id(self, patient_id: str) -> int:
         result = await self.conn.execute(
             """
@@ -81,10 +246,62 @@ class EhrContextsRepository:
         _, count = result.split()
         return int(count)
 
-    async def list_by_patient(self, patient_id: str) -> List[EHRContextItem]:
-        rows = await self.conn.fetch(
+    async def delete_by_ids(self, ids: Sequence[UUID]) -> int:
+        if not ids:
+            return 0
+
+        result = await self.conn.execute(
+            """
+            DELETE FROM
+                ehr_patient_context
+            WHERE
+                id = ANY($1)
+            """,
+            list(ids),
+        )
+
+        _, count = result.split()
+        return int(count)
+
+    async def notify_patients_changed(
+        self, patient_ids: Sequence[str], origin: str
+    ) -> None:
+        """Lets other processes know that the contexts of these patients changed,
+        origin identifies the sender so it can skip its own notifications.
+        Inside a transaction the notifications are only sent on commit."""
+
+        await self.conn.execute(
             """
-            SELECT *
+            SELECT pg_notify($1, $2 || ':' || patient_id)
+                FROM unnest($3::text[]) AS patient_id
+            """,
+            EHR_CONTEXTS_CHANGED_CHANNEL,
+            origin,
+            list(patient_ids),
+        )
+
+    async def list_by_patient(
+        self,
+        patient_id: str,
+        embeddings: bool = False,
+        prompt_fragments: bool = False,
+    ) -> List[EHRContextItem]:
+        """The patient's items, their embedding and prompt_fragment left None
+        unless asked for."""
+
+        skipped = set()
+        if not embeddings:
+            skipped.update(EHR_CONTEXT_EMBEDDING_COLUMNS)
+        if not prompt_fragments:
+            skipped.update(EHR_CONTEXT_PROMPT_FRAGMENT_COLUMNS)
+        columns = [
+            column if column not in skipped else f"NULL AS {column}"
+            for column in EHR_CONTEXT_COLUMNS
+        ]
+
+        rows = await self.conn.fetch(
+            f"""
+            SELECT {", ".join(columns)}
                 FROM 
                     ehr_patient_context
                 WHERE 
@@ -98,10 +315,26 @@ class EhrContextsRepository:
         self,
         patient_id: str,
         types: Iterable[str],
-    ) -> list[EHRContextItem]:
+    ) -> EHRContextItemsOfTypes:
+        # The patient's item count and snapshot version come along from its
+        # snapshot, in the same statement and so as of the same rows: the
+        # subqueries run once, not per row
         rows = await self.conn.fetch(
             """
-            SELECT *
+            SELECT
+                *,
+                (
+                    SELECT item_count
+                        FROM ehr_patient_context_snapshot
+                    WHERE
+                        patient_id = $1
+                ) AS patient_item_count,
+                (
+                    SELECT version
+                        FROM ehr_patient_context_snapshot
+                    WHERE
+                        patient_id = $1
+                ) AS patient_snapshot_version
                 FROM ehr_patient_context
             WHERE
                 patient_id = $1
@@ -110,26 +343,383 @@ class EhrContextsRepository:
             patient_id,
             list(types),
         )
-        return [self._row_to_context_item(row) for row in rows]
+        items = [self._row_to_context_item(row) for row in rows]
+        if not rows:
+            return EHRContextItemsOfTypes(items=items, total=None)
+        return EHRContextItemsOfTypes(
+            items=items,
+            total=rows[0]["patient_item_count"],
+            version=rows[0]["patient_snapshot_version"],
+        )
+
+    async def list_page_by_patient(
+        self,
+        patient_id: str,
+        filter: EHRContextItemsFilter,
+        limit: int,
+        after: Optional[EHRContextItemKey] = None,
+        fields: Optional[Collection[EHRContextItemField]] = None,
+    ) -> tuple[list[dict[str, Any]], Optional[EHRContextItemKey]]:
+        """The items following after, in EHRContextItemKey order, as a keyset
+        page: its cost does not depend on how deep the page is. Also returns
+        the key the next page starts after, None on the last one.
+
+        Items are returned as EHRContextItem serializes them, with only the
+        given fields, but without building models: the rows go straight to the
+        JSON encoder. Only the columns of the given fields are read.
+        """
+
+        fields = fields or list(EHRContextItemField)
+        needed = {"id", "source_recorded_at"}.union(
+            *(EHR_CONTEXT_FIELD_COLUMNS[field] for field in fields)
+        )
+        columns = [
+            column if column in needed else f"NULL AS {column}"
+            for field_columns in EHR_CONTEXT_FIELD_COLUMNS.values()
+            for column in field_columns
+        ]
+        conditions, args = self._filter_conditions(patient_id, filter)
+
+        if after is not None:
+            args.extend([after.recorded_at or date.min, after.id])
+            after_params = f"${len(args) - 1}, ${len(args)}"
+            conditions.append(f"({EHR_CONTEXT_RECORDED_AT_KEY}, id) > ({after_params})")
+
+        # One more row than asked for tells whether there is a next page
+        args.append(limit + 1)
+        rows = await self.conn.fetch(
+            f"""
+            SELECT {", ".join(columns)}
+                FROM ehr_patient_context
+            WHERE
+                {" AND ".join(conditions)}
+            ORDER BY {EHR_CONTEXT_RECORDED_AT_KEY}, id
+            LIMIT ${len(args)}
+            """,
+            *args,
+        )
+
+        next_key = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_key = EHRContextItemKey(rows[-1]["source_recorded_at"], rows[-1]["id"])
+
+        items = [self._row_to_serialized_context_item(row) for row in rows]
+        if len(fields) < len(EHRContextItemField):
+            keys = [field.value for field in fields]
+            items = [{key: item[key] for key in keys} for item in items]
+
+        return items, next_key
+
+    async def count_by_patient(
+        self, patient_id: str, filter: EHRContextItemsFilter
+    ) -> int:
+        conditions, args = self._filter_conditions(patient_id, filter)
+
+        count = await self.conn.fetchval(
+            f"""
+            SELECT count(*)
+                FROM ehr_patient_context
+            WHERE
+                {" AND ".join(conditions)}
+            """,
+            *args,
+        )
+        return int(count)
+
+    async def write_snapshots(
+        self, items_by_patient: Mapping[str, list[EHRContextItem]]
+    ) -> None:
+        """Rewrites the snapshot of each patient from all of its items, and bumps
+        its version. Must run in the transaction that writes the items, so that
+        the snapshot never disagrees with them."""
+
+        if not items_by_patient:
+            return
+
+        await self.conn.executemany(
+            """
+            INSERT INTO ehr_patient_context_snapshot (
+                patient_id,
+                version,
+                item_count,
+                items,
+                prompt_fragments,
+                embeddings,
+                updated_at
+            )
+            VALUES ($1, 1, $2, $3, $4, $5, now())
+            ON CONFLICT (patient_id) DO UPDATE SET
+                version = ehr_patient_context_snapshot.version + 1,
+                item_count = EXCLUDED.item_count,
+                items = EXCLUDED.items,
+                prompt_fragments = EXCLUDED.prompt_fragments,
+                embeddings = EXCLUDED.embeddings,
+                updated_at = EXCLUDED.updated_at
+            """,
+            [
+                (
+                    patient_id,
+                    len(items),
+                    _CONTEXT_ITEMS_ADAPTER.dump_json(items),
+                    # orjson does not serialize named tuples, only tuples
+                    orjson.dumps(
+                        [
+                            (
+                                tuple(item.prompt_fragment)
+                                if item.prompt_fragment
+                                else None
+                            )
+                            for item in items
+                        ]
+                    ),
+                    _concatenate_embeddings(items),
+                )
+                for patient_id, items in items_by_patient.items()
+            ],
+        )
+
+    async def get_snapshot_version(self, patient_id: str) -> Optional[int]:
+        version = await self.conn.fetchval(
+            """
+            SELECT version
+                FROM ehr_patient_context_snapshot
+            WHERE
+                patient_id = $1
+            """,
+            patient_id,
+        )
+        return int(version) if version is not None else None
+
+    async def get_snapshot_versions(self, patient_ids: Sequence[str]) -> dict[str, int]:
+        """The versions of the patients' snapshots, of those that have one."""
+
+        rows = await self.conn.fetch(
+            """
+            SELECT patient_id, version
+                FROM ehr_patient_context_snapshot
+            WHERE
+                patient_id = ANY($1)
+            """,
+            list(patient_ids),
+        )
+        return {row["patient_id"]: int(row["version"]) for row in rows}
+
+    async def get_snapshot(self, patient_id: str) -> Optional[EHRContextsSnapshot]:
+        """The patient's snapshot, None if it has none yet: patients ingested
+        before snapshots existed only have their rows until re-ingested."""
+
+        row = await self.conn.fetchrow(
+            """
+            SELECT version, items, prompt_fragments, embeddings
+                FROM ehr_patient_context_snapshot
+            WHERE
+                patient_id = $1
+            """,
+            patient_id,
+        )
+        if row is None:
+            return None
+
+        return EHRContextsSnapshot(
+            version=row["version"],
+            items=self._snapshot_to_context_items(
+                row["items"], row["prompt_fragments"], row["embeddings"]
+            ),
+        )
+
+    async def get_serialized_snapshot_items(
+        self, patient_id: str
+    ) -> Optional[EHRSerializedContextItems]:
+        """The items of the patient's snapshot as they were serialized, without
+        decoding them. None if the patient has no snapshot yet."""
+
+        row = await self.conn.fetchrow(
+            """
+            SELECT items, item_count
+                FROM ehr_patient_context_snapshot
+            WHERE
+                patient_id = $1
+            """,
+            patient_id,
+        )
+        if row is None:
+            return None
+
+        return EHRSerializedContextItems(json=row["items"], total=row["item_count"])
 
     @staticmethod
-    def _row_to_context_item(row: asyncpg.Record) -> EHRContextItem:
+    def _filter_conditions(
+        patient_id: str, filter: EHRContextItemsFilter
+    ) -> tuple[list[str], list[Any]]:
+        conditions = ["patient_id = $1"]
+        args: list[Any] = [patient_id]
+
+        if filter.types is not None:
+            args.append([type.value for type in filter.types])
+            conditions.append(f"type = ANY(${len(args)})")
+        if filter.recorded_from is not None:
+            args.append(filter.recorded_from)
+            conditions.append(f"source_recorded_at >= ${len(args)}")
+        if filter.recorded_to is not None:
+            args.append(filter.recorded_to)
+            conditions.append(f"source_recorded_at <= ${len(args)}")
 
-        data = row["data"]
+        return conditions, args
 
-        if isinstance(data, str):
-            data = json.loads(data)
+    @staticmethod
+    def _context_item_to_record(item: EHRContextItem) -> tuple[Any, ...]:
+        return (
+            item.id,
+            item.patient_id,
+            item.type.value,
+            item.content,
+            item.data,
+            item.source.type.value,
+            item.source.recorded_at,
+            item.source.recorded_by,
+            item.created_at,
+            item.item_key,
+            item.content_hash,
+            item.embedding,
+            *EhrContextsRepository._prompt_fragment_to_record(item),
+        )
+
+    @staticmethod
+    def _prompt_fragment_to_record(
+        item: EHRContextItem,
+    ) -> tuple[Optional[str], Optional[int], Optional[int]]:
+        fragment = item.prompt_fragment
+        if fragment is None:
+            return None, None, None
+        return fragment.text, fragment.tokens, fragment.version
+
+    @staticmethod
+    def _row_to_serialized_context_item(row: asyncpg.Record) -> dict[str, Any]:
+        # Must match how EHRContextItem serializes, bookkeeping fields excluded
+        return {
+            "id": row["id"],
+            "patient_id": row["patient_id"],
+            "type": row["type"],
+            "content": row["content"],
+            "data": row["data"],
+            "source": {
+                "type": row["source_type"],
+                "recorded_at": row["source_recorded_at"],
+                "recorded_by": row["source_recorded_by"],
+            },
+            "created_at": row["created_at"],
+        }
 
-        return EHRContextItem(
+    @staticmethod
+    def _snapshot_to_context_items(
+        items_json: bytes, prompt_fragments_json: bytes, embeddings: Optional[bytes]
+    ) -> list[EHRContextItem]:
+        # Serialized from models at ingestion, like rows they are not validated
+        # again. The decoded JSON objects become the models' values, converted
+        # in place, which measured faster than copying them. Bookkeeping fields
+        # are not part of snapshots.
+        items: list[Any] = orjson.loads(items_json)
+        prompt_fragments = orjson.loads(prompt_fragments_json)
+        embedding_size = len(embeddings) // len(items) if embeddings else 0
+
+        for i, (item, prompt_fragment) in enumerate(zip(items, prompt_fragments)):
+            source = item["source"]
+            source["type"] = _SOURCE_TYPES[source["type"]]
+            if source["recorded_at"] is not None:
+                source["recorded_at"] = date.fromisoformat(source["recorded_at"])
+
+            item["id"] = UUID(item["id"])
+            item["type"] = _CONTEXT_TYPES[item["type"]]
+            item["source"] = _construct_from(EHRContextSource, source)
+            item["created_at"] = datetime.fromisoformat(item["created_at"])
+            item["item_key"] = None
+            item["content_hash"] = None
+            item["embedding"] = (
+                embeddings[i * embedding_size : (i + 1) * embedding_size]
+                if embeddings
+                else None
+            )
+            item["prompt_fragment"] = (
+                EHRPromptFragment(*prompt_fragment) if prompt_fragment else None
+            )
+            items[i] = _construct_from(EHRContextItem, item)
+
+        return items
+
+    @staticmethod
+    def _row_to_context_item(row: asyncpg.Record) -> EHRContextItem:
+        # Rows come from our own schema and were validated when written, so
+        # models are built without validating them again: on large patients
+        # validation dominated the cost of reading them
+        return _construct(
+            EHRContextItem,
             id=row["id"],
             patient_id=row["patient_id"],
-            type=row["type"],
+            type=_CONTEXT_TYPES[row["type"]],
             content=row["content"],
-            data=data,
-            source=EHRContextSource(
-                type=row["source_type"],
+            data=row["data"],
+            source=_construct(
+                EHRContextSource,
+                type=_SOURCE_TYPES[row["source_type"]],
                 recorded_at=row["source_recorded_at"],
                 recorded_by=row["source_recorded_by"],
             ),
             created_at=row["created_at"],
+            item_key=row["item_key"],
+            content_hash=row["content_hash"],
+            embedding=row["embedding"],
+            prompt_fragment=(
+                EHRPromptFragment(
+                    row["prompt_fragment"],
+                    row["prompt_tokens"],
+                    row["prompt_fragment_version"],
+                )
+                if row["prompt_fragment"] is not None
+                else None
+            ),
         )
+
+
+_CONTEXT_TYPES = {type.value: type for type in EHRContextType}
+_SOURCE_TYPES = {type.value: type for type in EHRSourceType}
+
+_CONTEXT_ITEMS_ADAPTER = TypeAdapter(list[EHRContextItem])
+
+_Model = TypeVar("_Model", bound=BaseModel)
+
+
+def _construct(model: type[_Model], **values: Any) -> _Model:
+    """A model of already valid values, which must be given for every field.
+    Like model_construct, which measured slower than validating, without its
+    per-field handling of defaults, aliases and extra values."""
+
+    return _construct_from(model, values)
+
+
+def _construct_from(model: type[_Model], values: dict[str, Any]) -> _Model:
+    """Like _construct, the model taking the values dict as its own."""
+
+    instance = model.__new__(model)
+    object.__setattr__(instance, "__dict__", values)
+    object.__setattr__(instance, "__pydantic_fields_set__", set(values))
+    object.__setattr__(instance, "__pydantic_extra__", None)
+    object.__setattr__(instance, "__pydantic_private__", None)
+    return instance
+
+
+def _concatenate_embeddings(items: list[EHRContextItem]) -> Optional[bytes]:
+    """The items' embeddings back to back, None unless every item has one of
+    the same size: items are then embedded at query time if needed."""
+
+    embeddings = [item.embedding for item in items if item.embedding]
+    if len(embeddings) < len(items) or len({len(e) for e in embeddings}) > 1:
+        return None
+    return b"".join(embeddings) or None
+
+
+# Opens a repository bound to a pooled connection that is released when the
+# context exits, so callers only hold a connection for the duration of a read.
+EhrContextsRepositoryFactory = Callable[
+    [], AbstractAsyncContextManager[EhrContextsRepository]
+]
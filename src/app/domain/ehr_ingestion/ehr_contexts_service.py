@@ -1,23 +1,228 @@
+import hashlib
+import json
 from datetime import datetime, timezone
-from typing import List
-from uuid import uuid4
+from typing import AsyncIterable, Collection, List, NamedTuple, Optional
+from uuid import UUID, uuid4
 
+import asyncpg
+from pydantic import ValidationError
+
+from app.core.timing import timed
 from app.domain.ehr_ingestion.ehr_context_models import (
     EHRContextItem,
+    EHRContextItemField,
+    EHRContextItemKey,
+    EHRContextItemsFilter,
+    EHRContextItemsPage,
     EHRContextSource,
+    EHRContextsSnapshot,
     EHRContextType,
+    EHRSerializedContextItems,
     EHRSourceType,
 )
-from app.domain.ehr_ingestion.ehr_contexts_repository import EhrContextsRepository
+from app.domain.ehr_ingestion.ehr_contexts_cache import EHRContextsCache
+from app.domain.ehr_ingestion.ehr_contexts_repository import (
+    EHRContextFingerprint,
+    EhrContextsRepository,
+)
+from app.domain.ehr_ingestion.ehr_ingestion_models import (
+    EHRBulkIngestionError,
+    EHRBulkIngestionResult,
+    EHRIngestionResult,
+)
 from app.domain.ehr_ingestion.ehr_models import ElectronicPatientRecord
+from app.domain.ehr_query.ehr_lexical_ranker import ehr_context_item_search_text
+from app.domain.ehr_query.ehr_prompt_utils import render_ehr_prompt_fragment
+from app.domain.llm.embedding_client import EmbeddingClient, encode_embedding
 
 
 class EHRContextsService:
 
-    def __init__(self, ehr_contexts_repository: EhrContextsRepository):
+    def __init__(
+        self,
+        ehr_contexts_repository: EhrContextsRepository,
+        ehr_contexts_cache: Optional[EHRContextsCache] = None,
+        embedding_client: Optional[EmbeddingClient] = None,
+    ):
         self.ehr_contexts_repository = ehr_contexts_repository
+        self.ehr_contexts_cache = ehr_contexts_cache
+        self.embedding_client = embedding_client
+
+    async def ingest_ehr(self, ehr: ElectronicPatientRecord) -> EHRIngestionResult:
+        """Re-ingests a patient by only writing the context items that changed.
+
+        Items are matched to the stored ones by item_key, which keeps their ids
+        stable across ingestions, and compared by content_hash. Unchanged items
+        are not written at all.
+        """
+
+        with timed("ingest_build_items"):
+            items = self.build_ehr_context_items(ehr)
+        repository = self.ehr_contexts_repository
+
+        async with repository.transaction():
+            with timed("ingest_lock_read"):
+                await repository.lock_patient(ehr.patient_id)
+                stored = await repository.list_fingerprints_by_patient(ehr.patient_id)
+                snapshot_version = await repository.get_snapshot_version(ehr.patient_id)
+            inserted, updated, deleted = _diff_ehr_context_items(items, stored)
+
+            with timed("ingest_embed"):
+                await self._embed(inserted + updated)
+
+            with timed("ingest_write"):
+                await repository.delete_by_ids(deleted)
+                await repository.update_many(updated)
+                await repository.insert_many(inserted)
+
+                changed = bool(inserted or updated or deleted)
+                if changed:
+                    await repository.notify_patients_changed(
+                        [ehr.patient_id], origin=self._cache_origin
+                    )
+
+            # Built from the rows read back, which unlike the items built above
+            # have the ids and created_at of the unchanged items
+            if changed or snapshot_version is None:
+                with timed("ingest_snapshot"):
+                    await repository.write_snapshots(
+                        {
+                            ehr.patient_id: await repository.list_by_patient(
+                                ehr.patient_id, embeddings=True, prompt_fragments=True
+                            )
+                        }
+                    )
+
+        if changed:
+            self._invalidate_cache([ehr.patient_id])
+
+        return EHRIngestionResult(
+            inserted=len(inserted),
+            updated=len(updated),
+            deleted=len(deleted),
+            unchanged=len(items) - len(inserted) - len(updated),
+        )
+
+    async def ingest_ehr_ndjson(
+        self,
+        lines: AsyncIterable[bytes],
+        batch_size: int,
+        max_reported_errors: int = 100,
+    ) -> EHRBulkIngestionResult:
+        """Ingests a stream of NDJSON encoded EHRs, one record per line.
+
+        Records are validated and decomposed as they arrive and written every
+        batch_size records with COPY, so memory is bounded by the batch and not
+        by the stream. Invalid records are reported and skipped, they never
+        fail the whole stream.
+        """
+
+        result = EHRBulkIngestionResult()
+
+        # Keyed by patient id: a patient repeated within a batch is replaced by
+        # its last record, the same outcome as ingesting the records one by one.
+        batch: dict[str, list[EHRContextItem]] = {}
+        batch_lines: list[int] = []
+
+        def report_error(line: int, patient_id: str | None, error: str) -> None:
+            result.failed += 1
+            if len(result.errors) < max_reported_errors:
+                result.errors.append(
+                    EHRBulkIngestionError(line=line, patient_id=patient_id, error=error)
+                )
 
-    async def ingest_ehr(self, ehr: ElectronicPatientRecord) -> None:
+        async def flush() -> None:
+            if not batch:
+                return
+
+            repository = self.ehr_contexts_repository
+            try:
+                async with repository.transaction():
+                    # As ingest_ehr does, in a fixed order so that concurrent
+                    # batches sharing patients cannot deadlock
+                    for patient_id in sorted(batch):
+                        await repository.lock_patient(patient_id)
+                    changed = await self._write_batch(batch)
+            except asyncpg.PostgresError as e:
+                for line in batch_lines:
+                    report_error(line, None, f"Database error: {e}")
+            else:
+                self._invalidate_cache(changed)
+                result.ingested += len(batch_lines)
+                result.context_items += sum(len(items) for items in batch.values())
+
+            batch.clear()
+            batch_lines.clear()
+
+        line_number = 0
+        async for line in lines:
+            line_number += 1
+            if not line.strip():
+                continue
+
+            result.received += 1
+            try:
+                ehr = ElectronicPatientRecord.model_validate_json(line)
+            except ValidationError as e:
+                report_error(
+                    line_number, _extract_patient_id(line), _format_validation_error(e)
+                )
+                continue
+
+            batch[ehr.patient_id] = self.build_ehr_context_items(ehr)
+            batch_lines.append(line_number)
+
+            if len(batch_lines) >= batch_size:
+                await flush()
+
+        await flush()
+
+        return result
+
+    async def _write_batch(self, batch: dict[str, list[EHRContextItem]]) -> list[str]:
+        """Writes the items of a bulk batch as ingest_ehr writes those of one
+        patient, only what changed: ids are kept and patients whose items are
+        all unchanged are not written at all. Inserts go through COPY. Returns
+        the patients that changed."""
+
+        repository = self.ehr_contexts_repository
+        stored_by_patient = await repository.list_fingerprints_by_patient_ids(
+            list(batch)
+        )
+        snapshot_versions = await repository.get_snapshot_versions(list(batch))
+
+        inserted: list[EHRContextItem] = []
+        updated: list[EHRContextItem] = []
+        deleted: list[UUID] = []
+        changed: list[str] = []
+        snapshots: dict[str, list[EHRContextItem]] = {}
+        for patient_id, items in batch.items():
+            diff = _diff_ehr_context_items(items, stored_by_patient.get(patient_id, []))
+            inserted += diff.inserted
+            updated += diff.updated
+            deleted += diff.deleted
+
+            patient_changed = bool(diff.inserted or diff.updated or diff.deleted)
+            if patient_changed:
+                changed.append(patient_id)
+            # Unlike ingest_ehr's, built from the items: unchanged ones have the
+            # stored ids and created_at, and are embedded again if needed
+            if patient_changed or patient_id not in snapshot_versions:
+                snapshots[patient_id] = items
+
+        await self._embed([item for items in snapshots.values() for item in items])
+
+        await repository.delete_by_ids(deleted)
+        await repository.update_many(updated)
+        await repository.copy_many(inserted)
+        await repository.write_snapshots(snapshots)
+        if changed:
+            await repository.notify_patients_changed(changed, origin=self._cache_origin)
+
+        return changed
+
+    @staticmethod
+    def build_ehr_context_items(ehr: ElectronicPatientRecord) -> list[EHRContextItem]:
         items: list[EHRContextItem] = []
 
         now = datetime.now(timezone.utc)
@@ -42,6 +247,7 @@ class EHRContextsService:
                     recorded_by=None,
                 ),
                 created_at=now,
+                item_key=EHRContextType.DEMOGRAPHICS.value,
             )
         )
 
@@ -60,6 +266,7 @@ class EHRContextsService:
                         recorded_by=None,
                     ),
                     created_at=now,
+                    item_key=f"{EHRContextType.CHRONIC_CONDITION}:{condition}",
                 )
             )
 
@@ -78,6 +285,7 @@ class EHRContextsService:
                         recorded_by=None,
                     ),
                     created_at=now,
+                    item_key=f"{EHRContextType.ALLERGY}:{allergy}",
                 )
             )
 
@@ -96,6 +304,7 @@ class EHRContextsService:
                         recorded_by=None,
                     ),
                     created_at=now,
+                    item_key=f"{EHRContextType.MEDICATION}:{med.name}",
                 )
             )
 
@@ -114,6 +323,7 @@ class EHRContextsService:
                         recorded_by=visit.doctor,
                     ),
                     created_at=now,
+                    item_key=f"{EHRContextType.VISIT}:{visit.date}:{visit.doctor}",
                 )
             )
 
@@ -141,13 +351,178 @@ class EHRContextsService:
                         recorded_by=None,
                     ),
                     created_at=now,
+                    item_key=f"{EHRContextType.LAB_RESULT}:{lab.date}:{lab.test}",
                 )
             )
 
-        await self.ehr_contexts_repository.delete_by_patient_id(patient_id)
-        await self.ehr_contexts_repository.insert_many(items)
+        return _fingerprint_items(items)
 
     async def list_ehr_contexts_by_patient(
         self, patient_id: str
     ) -> List[EHRContextItem]:
-        return await self.ehr_contexts_repository.list_by_patient(patient_id)
+        if self.ehr_contexts_cache is None:
+            # Only listed, without the embeddings and prompt fragments
+            snapshot = await self._list_by_patient(patient_id, for_queries=False)
+            return snapshot.items
+
+        # The cache is shared with queries, which use them
+        snapshot = await self.ehr_contexts_cache.get_or_load(
+            patient_id, lambda: self._list_by_patient(patient_id, for_queries=True)
+        )
+        return snapshot.items
+
+    async def get_serialized_ehr_contexts_by_patient(
+        self, patient_id: str
+    ) -> Optional[EHRSerializedContextItems]:
+        """Every item of the patient already serialized, as they were when its
+        snapshot was written: up to date, without the cache. None if the
+        patient has no snapshot yet."""
+
+        return await self.ehr_contexts_repository.get_serialized_snapshot_items(
+            patient_id
+        )
+
+    async def list_ehr_contexts_page_by_patient(
+        self,
+        patient_id: str,
+        filter: EHRContextItemsFilter,
+        limit: int,
+        after: Optional[EHRContextItemKey] = None,
+        fields: Optional[Collection[EHRContextItemField]] = None,
+    ) -> EHRContextItemsPage:
+        """A page of the patient's items, read from the database rather than
+        from the cache: pages are meant for patients too large to load whole."""
+
+        repository = self.ehr_contexts_repository
+
+        items, next_key = await repository.list_page_by_patient(
+            patient_id, filter=filter, limit=limit, after=after, fields=fields
+        )
+        total = await repository.count_by_patient(patient_id, filter=filter)
+
+        return EHRContextItemsPage(items=items, total=total, next_key=next_key)
+
+    async def _list_by_patient(
+        self, patient_id: str, for_queries: bool
+    ) -> EHRContextsSnapshot:
+        # One row rather than one per item, unless the patient has not been
+        # ingested since snapshots exist
+        snapshot = await self.ehr_contexts_repository.get_snapshot(patient_id)
+        if snapshot is not None:
+            return snapshot
+        items = await self.ehr_contexts_repository.list_by_patient(
+            patient_id, embeddings=for_queries, prompt_fragments=for_queries
+        )
+        return EHRContextsSnapshot(version=None, items=items)
+
+    async def _embed(self, items: list[EHRContextItem]) -> None:
+        if self.embedding_client is None or not items:
+            return
+
+        embeddings = await self.embedding_client.embed(
+            [ehr_context_item_search_text(item) for item in items]
+        )
+        for item, embedding in zip(items, embeddings):
+            item.embedding = encode_embedding(embedding)
+
+    @property
+    def _cache_origin(self) -> str:
+        cache = self.ehr_contexts_cache
+        return cache.origin if cache is not None else ""
+
+    def _invalidate_cache(self, patient_ids: list[str]) -> None:
+        # Only this process, others are notified through Postgres
+        if self.ehr_contexts_cache is not None:
+            for patient_id in patient_ids:
+                self.ehr_contexts_cache.invalidate(patient_id)
+
+
+class _EHRContextItemsDiff(NamedTuple):
+    inserted: list[EHRContextItem]
+    updated: list[EHRContextItem]
+    deleted: list[UUID]
+
+
+def _diff_ehr_context_items(
+    items: list[EHRContextItem], stored: list[EHRContextFingerprint]
+) -> _EHRContextItemsDiff:
+    """Matches the items to the stored ones by item_key and compares them by
+    content_hash. Matched items take the id and created_at of the stored one,
+    unchanged ones are neither inserted nor updated."""
+
+    stored_by_key = {
+        fingerprint.item_key: fingerprint
+        for fingerprint in stored
+        if fingerprint.item_key is not None
+    }
+
+    inserted: list[EHRContextItem] = []
+    updated: list[EHRContextItem] = []
+    for item in items:
+        assert item.item_key is not None
+        fingerprint = stored_by_key.pop(item.item_key, None)
+        if fingerprint is None:
+            inserted.append(item)
+            continue
+
+        item.id = fingerprint.id
+        item.created_at = fingerprint.created_at
+        if fingerprint.content_hash != item.content_hash:
+            updated.append(item)
+
+    # Whatever is left was removed from the EHR, as are rows stored before
+    # items had a key
+    deleted = [fingerprint.id for fingerprint in stored_by_key.values()] + [
+        fingerprint.id for fingerprint in stored if fingerprint.item_key is None
+    ]
+
+    return _EHRContextItemsDiff(inserted, updated, deleted)
+
+
+def _fingerprint_items(items: list[EHRContextItem]) -> list[EHRContextItem]:
+    occurrences: dict[str, int] = {}
+
+    for item in items:
+        assert item.item_key is not None
+
+        # The same fact can legitimately be repeated within an EHR (e.g. two
+        # lab tests of the same kind on the same day)
+        occurrence = occurrences.get(item.item_key, 0)
+        occurrences[item.item_key] = occurrence + 1
+        if occurrence:
+            item.item_key = f"{item.item_key}#{occurrence}"
+
+        item.prompt_fragment = render_ehr_prompt_fragment(item)
+        item.content_hash = hashlib.sha256(
+            json.dumps(
+                {
+                    **item.model_dump(
+                        mode="json", include={"type", "content", "data", "source"}
+                    ),
+                    # So that re-ingestions rewrite fragments of an older
+                    # renderer, and fill those of rows stored before them
+                    "prompt_fragment_version": item.prompt_fragment.version,
+                },
+                sort_keys=True,
+                ensure_ascii=False,
+            ).encode()
+        ).hexdigest()
+
+    return items
+
+
+def _extract_patient_id(line: bytes) -> str | None:
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+
+    patient_id = record.get("patient_id") if isinstance(record, dict) else None
+    return patient_id if isinstance(patient_id, str) else None
+
+
+def _format_validation_error(e: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(loc) for loc in error['loc']) or 'record'}: {error['msg']}"
+        for error in e.errors()
+    )
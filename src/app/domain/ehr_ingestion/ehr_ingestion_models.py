@@ -0,0 +1,53 @@
+from datetime import datetime
+from enum import StrEnum, auto
+from typing import Optional
+from uuid import UUID
+
+from pydantic import BaseModel
+
+
+class EHRBulkIngestionError(BaseModel):
+    line: int
+    patient_id: Optional[str]
+    error: str
+
+
+class EHRBulkIngestionResult(BaseModel):
+    received: int = 0
+    ingested: int = 0
+    failed: int = 0
+    context_items: int = 0
+    errors: list[EHRBulkIngestionError] = []  # capped, see max_reported_errors
+
+
+class EHRIngestionTaskStatus(StrEnum):
+    PENDING = auto()
+    RUNNING = auto()
+    SUCCEEDED = auto()
+    FAILED = auto()
+
+
+class EHRIngestionTask(BaseModel):
+    id: UUID
+    patient_id: str
+    status: EHRIngestionTaskStatus
+    error: Optional[str]
+    attempts: int
+    created_at: datetime
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
+
+
+class EHRIngestionTaskStats(BaseModel):
+    pending: int
+    running: int
+    succeeded: int
+    failed: int
+    oldest_pending_created_at: Optional[datetime]
+
+
+class EHRIngestionResult(BaseModel):
+    inserted: int
+    updated: int
+    deleted: int
+    unchanged: int
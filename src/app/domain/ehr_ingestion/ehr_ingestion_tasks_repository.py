@@ -0,0 +1,206 @@
+from datetime import datetime
+from typing import Optional
+from uuid import UUID
+
+import asyncpg
+
+from app.domain.ehr_ingestion.ehr_ingestion_models import (
+    EHRIngestionTask,
+    EHRIngestionTaskStats,
+    EHRIngestionTaskStatus,
+)
+from app.domain.ehr_ingestion.ehr_models import ElectronicPatientRecord
+
+
+class EhrIngestionTasksRepository:
+    def __init__(self, conn: asyncpg.Connection) -> None:
+        self.conn = conn
+
+    async def insert(
+        self, task_id: UUID, ehr: ElectronicPatientRecord, created_at: datetime
+    ) -> EHRIngestionTask:
+        row = await self.conn.fetchrow(
+            """
+            INSERT INTO ehr_ingestion_task (
+                id,
+                patient_id,
+                status,
+                payload,
+                created_at
+            )
+            VALUES (
+                $1, $2, $3, $4, $5
+            )
+            RETURNING *
+            """,
+            task_id,
+            ehr.patient_id,
+            EHRIngestionTaskStatus.PENDING.value,
+            ehr.model_dump_json(),
+            created_at,
+        )
+        assert row is not None
+        return self._row_to_task(row)
+
+    async def get(self, task_id: UUID) -> Optional[EHRIngestionTask]:
+        row = await self.conn.fetchrow(
+            """
+            SELECT *
+                FROM
+                    ehr_ingestion_task
+                WHERE
+                    id = $1
+            """,
+            task_id,
+        )
+        return self._row_to_task(row) if row is not None else None
+
+    async def claim_next(
+        self, claimed_at: datetime, lease_seconds: float, max_attempts: int
+    ) -> Optional[tuple[EHRIngestionTask, str]]:
+        """Claims the oldest pending task, or running task whose lease expired
+        with attempts left, and returns it with its payload as JSON.
+
+        SKIP LOCKED lets any number of workers, in this process or others, poll
+        the same table without ever claiming the same task twice within a
+        lease.
+        """
+        row = await self.conn.fetchrow(
+            """
+            UPDATE
+                ehr_ingestion_task
+            SET
+                status = $1,
+                claimed_at = $2,
+                started_at = COALESCE(started_at, $2),
+                attempts = attempts + 1
+            WHERE
+                id = (
+                    SELECT id
+                        FROM ehr_ingestion_task
+                    WHERE
+                        status = $3
+                        OR (
+                            status = $1
+                            AND claimed_at
+                                <= $2::timestamptz - make_interval(secs => $4)
+                            AND attempts < $5
+                        )
+                    ORDER BY
+                        created_at
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+            RETURNING *
+            """,
+            EHRIngestionTaskStatus.RUNNING.value,
+            claimed_at,
+            EHRIngestionTaskStatus.PENDING.value,
+            lease_seconds,
+            max_attempts,
+        )
+        if row is None:
+            return None
+
+        return self._row_to_task(row), row["payload"]
+
+    async def fail_abandoned(
+        self, now: datetime, lease_seconds: float, max_attempts: int
+    ) -> int:
+        """Fails the running tasks whose lease expired with no attempts left,
+        which would otherwise stay running forever."""
+
+        result = await self.conn.execute(
+            """
+            UPDATE
+                ehr_ingestion_task
+            SET
+                status = $1,
+                finished_at = $3,
+                error = 'Abandoned after ' || attempts || ' attempts'
+            WHERE
+                status = $2
+                AND claimed_at <= $3::timestamptz - make_interval(secs => $4)
+                AND attempts >= $5
+            """,
+            EHRIngestionTaskStatus.FAILED.value,
+            EHRIngestionTaskStatus.RUNNING.value,
+            now,
+            lease_seconds,
+            max_attempts,
+        )
+        return int(result.split()[-1])
+
+    async def mark_finished(
+        self,
+        task: EHRIngestionTask,
+        status: EHRIngestionTaskStatus,
+        finished_at: datetime,
+        error: Optional[str] = None,
+    ) -> bool:
+        """Records the outcome of the claim of task, unless the task was
+        claimed again since, e.g. after its lease expired."""
+
+        result = await self.conn.execute(
+            """
+            UPDATE
+                ehr_ingestion_task
+            SET
+                status = $3,
+                finished_at = $4,
+                error = $5
+            WHERE
+                id = $1
+                AND attempts = $2
+                AND status = $6
+            """,
+            task.id,
+            task.attempts,
+            status.value,
+            finished_at,
+            error,
+            EHRIngestionTaskStatus.RUNNING.value,
+        )
+        return result != "UPDATE 0"
+
+    async def get_stats(self) -> EHRIngestionTaskStats:
+        rows = await self.conn.fetch("""
+            SELECT
+                status,
+                count(*) AS count,
+                min(created_at) AS oldest_created_at
+            FROM
+                ehr_ingestion_task
+            GROUP BY
+                status
+            """)
+        counts = {row["status"]: row["count"] for row in rows}
+        oldest_pending = next(
+            (
+                row["oldest_created_at"]
+                for row in rows
+                if row["status"] == EHRIngestionTaskStatus.PENDING.value
+            ),
+            None,
+        )
+
+        return EHRIngestionTaskStats(
+            pending=counts.get(EHRIngestionTaskStatus.PENDING.value, 0),
+            running=counts.get(EHRIngestionTaskStatus.RUNNING.value, 0),
+            succeeded=counts.get(EHRIngestionTaskStatus.SUCCEEDED.value, 0),
+            failed=counts.get(EHRIngestionTaskStatus.FAILED.value, 0),
+            oldest_pending_created_at=oldest_pending,
+        )
+
+    @staticmethod
+    def _row_to_task(row: asyncpg.Record) -> EHRIngestionTask:
+        return EHRIngestionTask(
+            id=row["id"],
+            patient_id=row["patient_id"],
+            status=row["status"],
+            error=row["error"],
+            attempts=row["attempts"],
+            created_at=row["created_at"],
+            started_at=row["started_at"],
+            finished_at=row["finished_at"],
+        )
@@ -0,0 +1,40 @@
+from datetime import datetime, timezone
+from typing import Optional
+from uuid import UUID, uuid4
+
+from app.domain.ehr_ingestion.ehr_ingestion_models import (
+    EHRIngestionTask,
+    EHRIngestionTaskStats,
+)
+from app.domain.ehr_ingestion.ehr_ingestion_tasks_repository import (
+    EhrIngestionTasksRepository,
+)
+from app.domain.ehr_ingestion.ehr_ingestion_workers import EHRIngestionWorkers
+from app.domain.ehr_ingestion.ehr_models import ElectronicPatientRecord
+
+
+class EHRIngestionTasksService:
+
+    def __init__(
+        self,
+        ehr_ingestion_tasks_repository: EhrIngestionTasksRepository,
+        ehr_ingestion_workers: EHRIngestionWorkers,
+    ):
+        self.ehr_ingestion_tasks_repository = ehr_ingestion_tasks_repository
+        self.ehr_ingestion_workers = ehr_ingestion_workers
+
+    async def create_task(self, ehr: ElectronicPatientRecord) -> EHRIngestionTask:
+        task = await self.ehr_ingestion_tasks_repository.insert(
+            task_id=uuid4(), ehr=ehr, created_at=datetime.now(timezone.utc)
+        )
+
+        # Workers in other processes pick the task up on their next poll
+        self.ehr_ingestion_workers.notify()
+
+        return task
+
+    async def get_task(self, task_id: UUID) -> Optional[EHRIngestionTask]:
+        return await self.ehr_ingestion_tasks_repository.get(task_id)
+
+    async def get_stats(self) -> EHRIngestionTaskStats:
+        return await self.ehr_ingestion_tasks_repository.get_stats()
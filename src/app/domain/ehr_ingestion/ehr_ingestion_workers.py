@@ -0,0 +1,132 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Optional, cast
+
+import asyncpg
+
+from app.domain.ehr_ingestion.ehr_contexts_cache import EHRContextsCache
+from app.domain.ehr_ingestion.ehr_contexts_repository import EhrContextsRepository
+from app.domain.ehr_ingestion.ehr_contexts_service import EHRContextsService
+from app.domain.ehr_ingestion.ehr_ingestion_models import EHRIngestionTaskStatus
+from app.domain.ehr_ingestion.ehr_ingestion_tasks_repository import (
+    EhrIngestionTasksRepository,
+)
+from app.domain.ehr_ingestion.ehr_models import ElectronicPatientRecord
+from app.domain.llm.embedding_client import EmbeddingClient
+
+logger = logging.getLogger(__name__)
+
+
+class EHRIngestionWorkers:
+    """In-process pool of workers that run pending EHR ingestion tasks.
+
+    Tasks are claimed from the ehr_ingestion_task table, so several app
+    processes can share the queue. Workers sleep until notified of a task
+    created in this process, or until the next poll for tasks created
+    elsewhere. A pooled connection is only held while claiming or running a
+    task.
+
+    A claim is a lease of lease_seconds: tasks left running by a process that
+    crashed or was killed are claimed again once it expires, and failed after
+    max_attempts claims.
+    """
+
+    def __init__(
+        self,
+        pool: asyncpg.Pool,
+        concurrency: int,
+        poll_interval_seconds: float,
+        lease_seconds: float,
+        max_attempts: int,
+        ehr_contexts_cache: Optional[EHRContextsCache] = None,
+        embedding_client: Optional[EmbeddingClient] = None,
+    ) -> None:
+        self._pool = pool
+        self._ehr_contexts_cache = ehr_contexts_cache
+        self._embedding_client = embedding_client
+        self._concurrency = concurrency
+        self._poll_interval_seconds = poll_interval_seconds
+        self._lease_seconds = lease_seconds
+        self._max_attempts = max_attempts
+        self._wake_up = asyncio.Event()
+        self._stopping = False
+        self._workers: list[asyncio.Task[None]] = []
+
+    def start(self) -> None:
+        self._stopping = False
+        self._workers = [
+            asyncio.create_task(self._work(), name=f"ehr-ingestion-worker-{i}")
+            for i in range(self._concurrency)
+        ]
+
+    async def stop(self) -> None:
+        """Lets running tasks finish, pending ones stay queued for the next start."""
+        self._stopping = True
+        self._wake_up.set()
+        await asyncio.gather(*self._workers)
+        self._workers = []
+
+    def notify(self) -> None:
+        self._wake_up.set()
+
+    async def _work(self) -> None:
+        while not self._stopping:
+            # Cleared before claiming: a task created after this point is either
+            # claimed below or sets the event again before we wait on it.
+            self._wake_up.clear()
+            try:
+                if await self._run_next_task():
+                    continue
+            except Exception:
+                # e.g. the database is restarting, retry on the next poll. Any
+                # error is caught, an exiting worker would never be replaced.
+                logger.exception("Could not run the next EHR ingestion task")
+
+            try:
+                await asyncio.wait_for(
+                    self._wake_up.wait(), timeout=self._poll_interval_seconds
+                )
+            except TimeoutError:
+                pass
+
+    async def _run_next_task(self) -> bool:
+        async with self._pool.acquire() as connection:
+            conn = cast(asyncpg.Connection, connection)
+            tasks_repository = EhrIngestionTasksRepository(conn=conn)
+
+            now = datetime.now(timezone.utc)
+            await tasks_repository.fail_abandoned(
+                now, lease_seconds=self._lease_seconds, max_attempts=self._max_attempts
+            )
+            claimed = await tasks_repository.claim_next(
+                claimed_at=now,
+                lease_seconds=self._lease_seconds,
+                max_attempts=self._max_attempts,
+            )
+            if claimed is None:
+                return False
+
+            task, payload = claimed
+            try:
+                ehr = ElectronicPatientRecord.model_validate_json(payload)
+                await EHRContextsService(
+                    ehr_contexts_repository=EhrContextsRepository(conn=conn),
+                    ehr_contexts_cache=self._ehr_contexts_cache,
+                    embedding_client=self._embedding_client,
+                ).ingest_ehr(ehr)
+            except Exception as e:
+                await tasks_repository.mark_finished(
+                    task,
+                    EHRIngestionTaskStatus.FAILED,
+                    finished_at=datetime.now(timezone.utc),
+                    error=f"{type(e).__name__}: {e}",
+                )
+            else:
+                await tasks_repository.mark_finished(
+                    task,
+                    EHRIngestionTaskStatus.SUCCEEDED,
+                    finished_at=datetime.now(timezone.utc),
+                )
+
+            return True
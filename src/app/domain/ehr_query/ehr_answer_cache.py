@@ -0,0 +1,185 @@
+import hashlib
+import json
+import re
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, NamedTuple, Optional, Sequence
+
+from app.core.metrics import ANSWER_CACHE_REQUESTS
+from app.domain.ehr_query.ehr_lexical_ranker import fold_text
+from app.domain.ehr_query.ehr_query_models import EHRQueryOutput
+
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize_question(question: str) -> str:
+    """The question without case, accents, punctuation or extra whitespace, e.g.
+    "¿Tiene  Alergias?" -> "tiene alergias"."""
+    return " ".join(_NON_WORD.sub(" ", fold_text(question)).split())
+
+
+class EHRAnswerKey(NamedTuple):
+    patient_id: str
+    # Version of the patient's snapshot when the question was answered, bumped
+    # by every ingestion that changes its contexts
+    context_version: int
+    # Of the normalized question, and of what else the answer depends on
+    question_hash: str
+
+
+def ehr_answer_key(
+    patient_id: str, context_version: int, question: str, variant: Sequence[str]
+) -> EHRAnswerKey:
+    question_hash = hashlib.sha256(
+        json.dumps(
+            [*variant, normalize_question(question)], ensure_ascii=False
+        ).encode()
+    ).hexdigest()
+    return EHRAnswerKey(patient_id, context_version, question_hash)
+
+
+class EHRAnswerStore(ABC):
+    """Persistent tier of the answer cache, shared by every process of the app.
+    Stores serialized answers, with a TTL and a bound on the number of them."""
+
+    @abstractmethod
+    async def get(self, key: EHRAnswerKey) -> Optional[bytes]: ...
+
+    @abstractmethod
+    async def set(self, key: EHRAnswerKey, value: bytes) -> None: ...
+
+
+@dataclass
+class _Entry:
+    output: EHRQueryOutput
+    expires_at: float
+
+
+class EHRAnswerCache:
+    """Query answers, references included, by patient context version and
+    normalized question: in an in-process LRU with a TTL, backed by a store if
+    given. Answers are looked up in the store on in-process misses, and written
+    to both.
+
+    Re-ingesting a patient bumps its context version, so the answers of older
+    versions are never served again. Invalidations of the patient's contexts
+    drop its answers from the process, and, as for EHRContextsCache, an answer
+    that started before one is returned but never cached: it may have been
+    built from contexts read before the invalidation, under the new version.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_seconds: float,
+        store: Optional[EHRAnswerStore] = None,
+    ) -> None:
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._store = store
+        self._entries: OrderedDict[EHRAnswerKey, _Entry] = OrderedDict()
+        # The in-process keys of each patient, to drop them on invalidation
+        self._keys_by_patient: dict[str, set[EHRAnswerKey]] = {}
+
+        # Versioned against invalidations as EHRContextsCache loads are
+        self._version = 0
+        self._invalidated_at: OrderedDict[str, int] = OrderedDict()
+        self._forgotten_version = 0
+
+    async def get_or_answer(
+        self,
+        key: EHRAnswerKey,
+        answer: Callable[[], Awaitable[EHRQueryOutput]],
+    ) -> EHRQueryOutput:
+        cached = await self.get(key)
+        if cached is not None:
+            return cached
+
+        version = self._version
+        output = await answer()
+        await self._put(key, output, version)
+
+        return output
+
+    async def get(self, key: EHRAnswerKey) -> Optional[EHRQueryOutput]:
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at > time.monotonic():
+            self._entries.move_to_end(key)
+            ANSWER_CACHE_REQUESTS.inc(tier="memory", result="hit")
+            return entry.output
+
+        ANSWER_CACHE_REQUESTS.inc(tier="memory", result="miss")
+        if entry is not None:
+            self._remove(key)
+        if self._store is None:
+            return None
+
+        version = self._version
+        stored = await self._store.get(key)
+        ANSWER_CACHE_REQUESTS.inc(
+            tier="store", result="miss" if stored is None else "hit"
+        )
+        if stored is None:
+            return None
+
+        output = EHRQueryOutput.model_validate_json(stored)
+        if not self._invalidated_since(key.patient_id, version):
+            self._add(key, output)
+        return output
+
+    def invalidate(self, patient_id: str) -> None:
+        self._version += 1
+        for key in self._keys_by_patient.pop(patient_id, ()):
+            del self._entries[key]
+
+        self._invalidated_at[patient_id] = self._version
+        self._invalidated_at.move_to_end(patient_id)
+        if len(self._invalidated_at) > self._max_entries:
+            _, version = self._invalidated_at.popitem(last=False)
+            self._forgotten_version = version
+
+    def clear(self) -> None:
+        """Invalidates every patient."""
+        self._version += 1
+        self._entries.clear()
+        self._keys_by_patient.clear()
+
+        self._invalidated_at.clear()
+        self._forgotten_version = self._version
+
+    async def _put(
+        self, key: EHRAnswerKey, output: EHRQueryOutput, answered_at_version: int
+    ) -> None:
+        if self._max_entries <= 0:
+            return
+        if self._invalidated_since(key.patient_id, answered_at_version):
+            return
+
+        self._add(key, output)
+        if self._store is not None:
+            await self._store.set(key, output.model_dump_json().encode())
+
+    def _invalidated_since(self, patient_id: str, version: int) -> bool:
+        invalidated_at = self._invalidated_at.get(patient_id, self._forgotten_version)
+        return invalidated_at > version
+
+    def _add(self, key: EHRAnswerKey, output: EHRQueryOutput) -> None:
+        if self._max_entries <= 0:
+            return
+
+        self._entries[key] = _Entry(
+            output=output, expires_at=time.monotonic() + self._ttl_seconds
+        )
+        self._entries.move_to_end(key)
+        self._keys_by_patient.setdefault(key.patient_id, set()).add(key)
+        while len(self._entries) > self._max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: EHRAnswerKey) -> None:
+        del self._entries[key]
+        keys = self._keys_by_patient[key.patient_id]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_patient[key.patient_id]
@@ -0,0 +1,20 @@
+from abc import ABC, abstractmethod
+
+from app.domain.ehr_ingestion.ehr_context_models import EHRContextItem
+
+
+class EHRContextsPrefilter(ABC):
+    """Narrows down the context items of a patient to the candidates worth
+    sending to the LLM selection step. Implementations must be cheap compared
+    to an LLM call and keep the items in their original order."""
+
+    @property
+    @abstractmethod
+    def variant(self) -> str:
+        """The prefilter and its configuration: prefilters of the same variant
+        narrow the same items alike, e.g. for answer cache keys."""
+
+    @abstractmethod
+    async def narrow(
+        self, question: str, items: list[EHRContextItem]
+    ) -> list[EHRContextItem]: ...
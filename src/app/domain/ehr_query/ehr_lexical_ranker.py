@@ -0,0 +1,183 @@
+import math
+import re
+import unicodedata
+from collections import Counter
+from datetime import date
+from typing import Any, Iterable, override
+
+from app.domain.ehr_ingestion.ehr_context_models import EHRContextItem, EHRContextType
+from app.domain.ehr_query.ehr_contexts_prefilter import EHRContextsPrefilter
+
+# Words a physician is likely to use for each type of context, so that items can
+# match a question even when their content does not name their type (a
+# medication item only says "Metformina, 850mg, 2x/día").
+EHR_CONTEXT_TYPE_TERMS: dict[EHRContextType, str] = {
+    EHRContextType.DEMOGRAPHICS: (
+        "datos demográficos nombre edad años género sexo tipo sanguíneo" " sangre grupo"
+    ),
+    EHRContextType.CHRONIC_CONDITION: (
+        "condición crónica enfermedad diagnóstico antecedente patología"
+    ),
+    EHRContextType.ALLERGY: "alergia alérgico reacción intolerancia",
+    EHRContextType.MEDICATION: (
+        "medicación medicamento fármaco tratamiento dosis toma receta"
+    ),
+    EHRContextType.VISIT: "visita consulta cita control médico doctor motivo notas",
+    EHRContextType.LAB_RESULT: (
+        "laboratorio análisis estudio prueba resultado examen valores"
+    ),
+}
+
+SPANISH_STOPWORDS = frozenset("""
+    a al algo algun alguna algunas alguno algunos ante antes aun como con contra
+    cual cuales cuando cuanto de del desde donde dos e el ella ellas ellos en entre
+    era es esa esas ese eso esos esta estas este esto estos fue fueron ha hace han
+    hasta hay la las le les lo los mas me mi mis muy ni no nos o otra otro para pero
+    por que quien se sea ser si sin sobre son su sus tambien tiene tienen todo tu un
+    una uno unos y ya paciente
+    """.split())
+
+# Light stemming: plural and gender endings are dropped and the result is cut to
+# a prefix, which conflates most Spanish derivations (alergia, alérgico) well
+# enough for ranking.
+STEM_PREFIX_LENGTH = 6
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def fold_text(text: str) -> str:
+    """Lower cases and removes accents, e.g. "Medicación" -> "medicacion"."""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def stem(token: str) -> str:
+    if len(token) > 4 and token.endswith("ces"):
+        token = token[:-3] + "z"
+    elif len(token) > 4 and token.endswith(("os", "as", "es")):
+        token = token[:-2]
+    elif len(token) > 3 and token.endswith(("o", "a", "e", "s")):
+        token = token[:-1]
+
+    return token[:STEM_PREFIX_LENGTH]
+
+
+def tokenize(text: str) -> list[str]:
+    return [
+        stem(token)
+        for token in TOKEN_PATTERN.findall(fold_text(text))
+        if token not in SPANISH_STOPWORDS
+    ]
+
+
+def _flatten_values(data: Any) -> Iterable[str]:
+    if isinstance(data, dict):
+        for key, value in data.items():
+            yield str(key)
+            yield from _flatten_values(value)
+    elif isinstance(data, (list, tuple)):
+        for value in data:
+            yield from _flatten_values(value)
+    elif data is not None:
+        yield str(data)
+
+
+def ehr_context_item_search_text(item: EHRContextItem) -> str:
+    """The text an item is searched by, lexically or by embedding."""
+    return " ".join(
+        [
+            EHR_CONTEXT_TYPE_TERMS[item.type],
+            item.content,
+            *_flatten_values(item.data),
+        ]
+    )
+
+
+def ehr_context_item_terms(item: EHRContextItem) -> list[str]:
+    return tokenize(ehr_context_item_search_text(item))
+
+
+class BM25Index:
+    """Okapi BM25 over a small in-memory corpus, e.g. the items of one patient."""
+
+    def __init__(
+        self, documents: list[list[str]], k1: float = 1.2, b: float = 0.75
+    ) -> None:
+        self._k1 = k1
+        self._b = b
+        self._term_frequencies = [Counter(document) for document in documents]
+        self._lengths = [len(document) for document in documents]
+        self._average_length = sum(self._lengths) / len(documents) if documents else 0.0
+
+        document_frequencies: Counter[str] = Counter()
+        for term_frequencies in self._term_frequencies:
+            document_frequencies.update(term_frequencies.keys())
+
+        total = len(documents)
+        self._idf = {
+            term: math.log(1 + (total - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequencies.items()
+        }
+
+    def scores(self, query: list[str]) -> list[float]:
+        terms = [term for term in set(query) if term in self._idf]
+        scores = []
+        for term_frequencies, length in zip(self._term_frequencies, self._lengths):
+            score = 0.0
+            normalization = self._k1 * (
+                1 - self._b + self._b * length / (self._average_length or 1)
+            )
+            for term in terms:
+                frequency = term_frequencies.get(term, 0)
+                if frequency:
+                    score += (
+                        self._idf[term]
+                        * frequency
+                        * (self._k1 + 1)
+                        / (frequency + normalization)
+                    )
+            scores.append(score)
+
+        return scores
+
+
+class LexicalEHRContextsPrefilter(EHRContextsPrefilter):
+    """Keeps the top_k items that best match the question with BM25.
+
+    Patients with at most bypass_max_items items are not filtered, the LLM can
+    cheaply look at all of them. When fewer than top_k items match the question
+    at all, the remaining slots go to undated items (demographics, medical
+    history) and then to the most recent ones.
+    """
+
+    def __init__(self, top_k: int, bypass_max_items: int) -> None:
+        self._top_k = top_k
+        self._bypass_max_items = bypass_max_items
+
+    @property
+    @override
+    def variant(self) -> str:
+        return f"lexical:{self._top_k}:{self._bypass_max_items}"
+
+    @override
+    async def narrow(
+        self, question: str, items: list[EHRContextItem]
+    ) -> list[EHRContextItem]:
+        if len(items) <= max(self._bypass_max_items, self._top_k):
+            return items
+
+        scores = BM25Index([ehr_context_item_terms(item) for item in items]).scores(
+            tokenize(question)
+        )
+
+        ranked = sorted(
+            range(len(items)),
+            key=lambda i: (
+                scores[i],
+                items[i].source.recorded_at or date.max,
+            ),
+            reverse=True,
+        )
+        kept = set(ranked[: self._top_k])
+
+        return [item for i, item in enumerate(items) if i in kept]
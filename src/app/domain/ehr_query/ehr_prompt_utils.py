@@ -1,9 +1,190 @@
-from app.domain.ehr_ingestion.ehr_context_models import EHRContextItem
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import date
+from functools import cache
+from typing import Any, Iterable, Iterator, Optional
 
+from app.domain.ehr_ingestion.ehr_context_models import (
+    EHRContextItem,
+    EHRPromptFragment,
+)
+from app.domain.ehr_query.ehr_lexical_ranker import (
+    BM25Index,
+    ehr_context_item_terms,
+    fold_text,
+    tokenize,
+)
+from app.domain.llm.token_counter import count_tokens, truncate_to_tokens
 
-def build_ehr_contexts_selection_prompt(
-    question: str, ehr_context_items: list[EHRContextItem]
+# Bump whenever render_ehr_context_item changes: stored fragments of older
+# versions are rendered again at query time, and rewritten by re-ingestions
+PROMPT_FRAGMENT_VERSION = 1
+
+
+@dataclass(frozen=True)
+class Prompt:
+    text: str
+    # Approximate, see count_tokens
+    tokens: int
+    # The items rendered in the prompt, after applying its token budget
+    ehr_context_items: list[EHRContextItem]
+
+
+_prompt_tokens: ContextVar[Optional[list[int]]] = ContextVar(
+    "prompt_tokens", default=None
+)
+
+
+@contextmanager
+def record_prompt_tokens() -> Iterator[list[int]]:
+    """Collects the token count of every prompt built within the block, in
+    build order, e.g. to report them in a response header."""
+    prompt_tokens: list[int] = []
+    token = _prompt_tokens.set(prompt_tokens)
+    try:
+        yield prompt_tokens
+    finally:
+        _prompt_tokens.reset(token)
+
+
+def report_prompt_tokens(tokens: int) -> None:
+    prompt_tokens = _prompt_tokens.get()
+    if prompt_tokens is not None:
+        prompt_tokens.append(tokens)
+
+
+def render_ehr_context_item(
+    item: EHRContextItem, max_tokens: Optional[int] = None
 ) -> str:
+    """One line per item: its type, its source, its content, and only the data
+    values that the content does not already state, e.g.
+
+    visit (doctor, 2024-10-15, Dra. Martínez): Control rutinario. PA: 135/85.
+    """
+    source = [item.source.type.value]
+    if item.source.recorded_at is not None:
+        source.append(item.source.recorded_at.isoformat())
+    if item.source.recorded_by:
+        source.append(item.source.recorded_by)
+
+    stated = fold_text(" ".join([item.content, *source]))
+    extras = [
+        f"{key}={value}"
+        for key, value in _flatten_data(item.data)
+        if not _is_stated(value, stated)
+    ]
+
+    line = f"{item.type.value} ({', '.join(source)}): {item.content}"
+    if extras:
+        line += f" [{'; '.join(extras)}]"
+
+    if max_tokens is not None:
+        line = truncate_to_tokens(line, max_tokens)
+
+    return line
+
+
+def render_ehr_prompt_fragment(item: EHRContextItem) -> EHRPromptFragment:
+    """The item's line, rendered once at ingestion and stored with it."""
+    text = render_ehr_context_item(item)
+    return EHRPromptFragment(
+        text=text, tokens=count_tokens(text), version=PROMPT_FRAGMENT_VERSION
+    )
+
+
+def _prompt_fragment(
+    item: EHRContextItem, max_tokens: Optional[int]
+) -> EHRPromptFragment:
+    """The item's stored fragment, unless rendered by another version of the
+    renderer (or not at all), truncated to max_tokens."""
+    fragment = item.prompt_fragment
+    if fragment is None or fragment.version != PROMPT_FRAGMENT_VERSION:
+        fragment = render_ehr_prompt_fragment(item)
+
+    if max_tokens is not None and fragment.tokens > max_tokens:
+        text = truncate_to_tokens(fragment.text, max_tokens)
+        fragment = fragment._replace(text=text, tokens=count_tokens(text))
+
+    return fragment
+
+
+def estimate_ehr_context_items_tokens(
+    ehr_context_items: list[EHRContextItem], item_max_tokens: Optional[int] = None
+) -> int:
+    """Approximate tokens of the items' lines, as a prompt would list them,
+    added up from their fragments without building any prompt."""
+    tokens = (
+        _prompt_fragment(item, max_tokens=None).tokens for item in ehr_context_items
+    )
+    if item_max_tokens is None:
+        return sum(tokens)
+    return sum(min(item_tokens, item_max_tokens) for item_tokens in tokens)
+
+
+def _is_stated(value: str, stated: str) -> bool:
+    # As a whole word, so that a short value like "M" is not found everywhere
+    return re.search(rf"(?<!\w){re.escape(fold_text(value))}(?!\w)", stated) is not None
+
+
+def _flatten_data(data: Any, prefix: str = "") -> Iterable[tuple[str, str]]:
+    if isinstance(data, dict):
+        for key, value in data.items():
+            yield from _flatten_data(value, f"{prefix}{key}.")
+    elif isinstance(data, (list, tuple)):
+        for i, value in enumerate(data):
+            yield from _flatten_data(value, f"{prefix}{i}.")
+    elif isinstance(data, date):
+        yield prefix.rstrip("."), data.isoformat()
+    elif data is not None:
+        yield prefix.rstrip("."), str(data)
+
+
+def _fit_to_token_budget(
+    question: str,
+    ehr_context_items: list[EHRContextItem],
+    item_tokens: list[int],
+    token_budget: int,
+) -> list[int]:
+    """Indexes of the items to keep, in their original order: all of them if
+    they fit, otherwise the best BM25 matches of the question (ties go to the
+    most recent) for as long as they fit."""
+    if sum(item_tokens) <= token_budget:
+        return list(range(len(ehr_context_items)))
+
+    scores = BM25Index(
+        [ehr_context_item_terms(item) for item in ehr_context_items]
+    ).scores(tokenize(question))
+    ranked = sorted(
+        range(len(ehr_context_items)),
+        key=lambda i: (
+            scores[i],
+            ehr_context_items[i].source.recorded_at or date.max,
+        ),
+        reverse=True,
+    )
+
+    kept = set()
+    remaining = token_budget
+    for i in ranked:
+        if item_tokens[i] <= remaining:
+            kept.add(i)
+            remaining -= item_tokens[i]
+
+    return sorted(kept)
+
+
+def build_ehr_contexts_selection_prompt(
+    question: str,
+    ehr_context_items: list[EHRContextItem],
+    token_budget: Optional[int] = None,
+    item_max_tokens: Optional[int] = None,
+) -> Prompt:
+    """Items are listed under short per-prompt aliases (1, 2, 3...) instead of
+    their UUIDs, which the LLM would otherwise have to read and echo back: alias
+    n is Prompt.ehr_context_items[n - 1]. Past token_budget, the items least
+    related to the question (BM25) are left out of the prompt."""
     lines = [
         "Eres un asistente clínico.",
         'Selecciona únicamente los "id" de los contextos relevantes.',
@@ -14,64 +195,172 @@ def build_ehr_contexts_selection_prompt(
         "Contextos:",
     ]
 
-    for item in ehr_context_items:
-        lines.append(f"")
-        lines.append(f"- id: {item.id}")
-        lines.append(f"\ttipo: {item.type}")
-        lines.append(f"\tcontenido: {item.content}")
-        lines.append(f"\tdatos: {item.data}")
-
-    lines.append(f"")
+    return _with_aliased_contexts(
+        lines, question, ehr_context_items, token_budget, item_max_tokens
+    )
 
-    return "\n".join(lines)
 
-
-def build_grounded_query_output_prompt(
-    question: str,
+def build_ehr_contexts_batch_selection_prompt(
+    questions: list[str],
     ehr_context_items: list[EHRContextItem],
-) -> str:
+    token_budget: Optional[int] = None,
+    item_max_tokens: Optional[int] = None,
+) -> Prompt:
+    """One selection for several questions over the same contexts, listed once.
+    Aliases and budget work as in build_ehr_contexts_selection_prompt."""
     lines = [
         "Eres un asistente clínico.",
-        "Responde la pregunta usando únicamente la información proporcionada.",
+        'Para cada pregunta, selecciona únicamente los "id" de los contextos'
+        " relevantes para esa pregunta.",
         "No inventes información, datos, ni hagas suposiciones.",
-        "Si la información no es suficiente, indícalo explícitamente.",
-        "Al terminar de dar la respuesta, incluye información clara sobre las fuentes o referencias utilizadas.",
-        "",
-        "Ejemplos de respuestas esperadas (los valores son solo ilustrativos):",
-        "",
-        "Pregunta: ¿Cuál es la medicación actual del paciente?",
-        "Respuesta:",
-        "El paciente actualmente se encuentra en tratamiento con <MEDICAMENTO_1> <DOSIS_1> y <MEDICAMENTO_2> <DOSIS_2>.",
-        "Fuentes: Según el historial médico del paciente (medicación actual registrada).",
         "",
-        "Pregunta: ¿Cuándo fue su última visita y por qué?",
-        "Respuesta:",
-        "La última visita del paciente fue el <FECHA_VISITA> y correspondió a una <RAZÓN_DE_LA_VISITA>.",
-        "Fuentes: Según la visita clínica del <FECHA_VISITA>, documentada por <PROFESIONAL_DE_SALUD>.",
+        "Preguntas:",
+        *(f"{number}. {question}" for number, question in enumerate(questions, 1)),
         "",
-        "Pregunta: ¿Tiene alguna alergia que deba considerar?",
-        "Respuesta:",
-        "Sí. El paciente presenta alergia a <ALERGIA>, la cual debe considerarse antes de prescribir tratamientos.",
-        "Fuentes: Según el historial médico del paciente, sección de alergias.",
+        "Contextos:",
+    ]
+
+    return _with_aliased_contexts(
+        lines, " ".join(questions), ehr_context_items, token_budget, item_max_tokens
+    )
+
+
+# Shared by the prompts that answer the question
+_GROUNDED_ANSWER_INSTRUCTIONS = [
+    "Responde la pregunta usando únicamente la información proporcionada.",
+    "No inventes información, datos, ni hagas suposiciones.",
+    "Si la información no es suficiente, indícalo explícitamente.",
+    "Al terminar de dar la respuesta, incluye información clara sobre las fuentes o referencias utilizadas.",
+    "",
+    "Ejemplos de respuestas esperadas (los valores son solo ilustrativos):",
+    "",
+    "Pregunta: ¿Cuál es la medicación actual del paciente?",
+    "Respuesta:",
+    "El paciente actualmente se encuentra en tratamiento con <MEDICAMENTO_1> <DOSIS_1> y <MEDICAMENTO_2> <DOSIS_2>.",
+    "Fuentes: Según el historial médico del paciente (medicación actual registrada).",
+    "",
+    "Pregunta: ¿Cuándo fue su última visita y por qué?",
+    "Respuesta:",
+    "La última visita del paciente fue el <FECHA_VISITA> y correspondió a una <RAZÓN_DE_LA_VISITA>.",
+    "Fuentes: Según la visita clínica del <FECHA_VISITA>, documentada por <PROFESIONAL_DE_SALUD>.",
+    "",
+    "Pregunta: ¿Tiene alguna alergia que deba considerar?",
+    "Respuesta:",
+    "Sí. El paciente presenta alergia a <ALERGIA>, la cual debe considerarse antes de prescribir tratamientos.",
+    "Fuentes: Según el historial médico del paciente, sección de alergias.",
+    "",
+    "Pregunta: ¿Cómo ha evolucionado un parámetro clínico relevante?",
+    "Respuesta:",
+    "En el estudio realizado el <FECHA_ESTUDIO>, se registró un valor de <PARÁMETRO_CLÍNICO> igual a <VALOR>, junto con <OTRO_INDICADOR>, lo que sugiere <INTERPRETACIÓN_GENERAL>.",
+    "Fuentes: Según el resultado del estudio del <FECHA_ESTUDIO>.",
+    "",
+    "Sigue el mismo estilo y nivel de detalle mostrado en los ejemplos anteriores.",
+    "Los ejemplos anteriores no contienen datos reales y no deben reutilizarse en la respuesta.",
+    "",
+]
+
+
+def build_ehr_contexts_selection_answer_prompt(
+    question: str,
+    ehr_context_items: list[EHRContextItem],
+    token_budget: Optional[int] = None,
+    item_max_tokens: Optional[int] = None,
+) -> Prompt:
+    """Selection and answer in one prompt: the answer is written from every
+    listed context, and cites the aliases of those it is based on. Aliases and
+    budget work as in build_ehr_contexts_selection_prompt."""
+    lines = [
+        "Eres un asistente clínico.",
+        *_GROUNDED_ANSWER_INSTRUCTIONS,
+        'Devuelve la respuesta en "answer" y, en "ids", únicamente los "id" de'
+        " los contextos en los que se basa.",
         "",
-        "Pregunta: ¿Cómo ha evolucionado un parámetro clínico relevante?",
-        "Respuesta:",
-        "En el estudio realizado el <FECHA_ESTUDIO>, se registró un valor de <PARÁMETRO_CLÍNICO> igual a <VALOR>, junto con <OTRO_INDICADOR>, lo que sugiere <INTERPRETACIÓN_GENERAL>.",
-        "Fuentes: Según el resultado del estudio del <FECHA_ESTUDIO>.",
+        f"Pregunta: {question}",
         "",
-        "Sigue el mismo estilo y nivel de detalle mostrado en los ejemplos anteriores.",
-        "Los ejemplos anteriores no contienen datos reales y no deben reutilizarse en la respuesta.",
+        "Contextos:",
+    ]
+
+    return _with_aliased_contexts(
+        lines, question, ehr_context_items, token_budget, item_max_tokens
+    )
+
+
+def _with_aliased_contexts(
+    lines: list[str],
+    question: str,
+    ehr_context_items: list[EHRContextItem],
+    token_budget: Optional[int],
+    item_max_tokens: Optional[int],
+) -> Prompt:
+    fragments = [_prompt_fragment(item, item_max_tokens) for item in ehr_context_items]
+    header_tokens = count_tokens("\n".join(lines))
+
+    kept = list(range(len(ehr_context_items)))
+    if token_budget is not None:
+        # Counted with the longest alias, they are only assigned to kept items
+        alias_tokens = _alias_tokens(len(ehr_context_items))
+        kept = _fit_to_token_budget(
+            question,
+            ehr_context_items,
+            item_tokens=[alias_tokens + fragment.tokens for fragment in fragments],
+            token_budget=token_budget - header_tokens,
+        )
+
+    lines = [
+        *lines,
+        *(
+            f"- id: {alias} | {fragments[i].text}"
+            for alias, i in enumerate(kept, start=1)
+        ),
         "",
+    ]
+
+    return Prompt(
+        text="\n".join(lines),
+        # Token counts add up across lines, which pieces never span
+        tokens=header_tokens
+        + sum(
+            _alias_tokens(alias) + fragments[i].tokens
+            for alias, i in enumerate(kept, start=1)
+        ),
+        ehr_context_items=[ehr_context_items[i] for i in kept],
+    )
+
+
+def _alias_tokens(alias: int) -> int:
+    # Digits are counted by runs, so only the number of them matters
+    return _alias_width_tokens(len(str(alias)))
+
+
+@cache
+def _alias_width_tokens(width: int) -> int:
+    return count_tokens(f"- id: {'9' * width} | ")
+
+
+def build_grounded_query_output_prompt(
+    question: str,
+    ehr_context_items: list[EHRContextItem],
+) -> Prompt:
+    lines = [
+        "Eres un asistente clínico.",
+        *_GROUNDED_ANSWER_INSTRUCTIONS,
         f"Pregunta: {question}",
         "",
         "Información del paciente:",
     ]
 
-    for ctx in ehr_context_items:
-        lines.append(f"- id: {ctx.id}\n")
-        lines.append(f"\ttipo: {ctx.type}\n")
-        lines.append(f"\tcontenido: {ctx.content}")
-        lines.append(f"\tdatos: {ctx.data}")
-        lines.append(f"\tfuente/referencia: {ctx.data}")
+    tokens = count_tokens("\n".join(lines))
+    item_prefix_tokens = count_tokens("- ")
+
+    # Every selected item is kept whole, whatever its size: the answer may
+    # only cite what it is given
+    for item in ehr_context_items:
+        fragment = _prompt_fragment(item, max_tokens=None)
+        lines.append(f"- {fragment.text}")
+        tokens += item_prefix_tokens + fragment.tokens
 
-    return "\n".join(lines)
+    return Prompt(
+        text="\n".join(lines),
+        tokens=tokens,
+        ehr_context_items=ehr_context_items,
+    )
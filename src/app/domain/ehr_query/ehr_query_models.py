@@ -1,8 +1,13 @@
-from uuid import UUID
-from pydantic import BaseModel, ConfigDict
+from typing import Literal, Optional
+
+from pydantic import BaseModel, ConfigDict, Field
 
 from app.domain.ehr_ingestion.ehr_context_models import EHRContextItem
 
+# How a query uses the LLM: a selection call, then an answer call given only the
+# selected contexts, or one call answering from every context and citing them
+EHRQueryMode = Literal["two_calls", "single_call"]
+
 
 class EHRQuery(BaseModel):
     query: str
@@ -13,6 +18,68 @@ class EHRQueryOutput(BaseModel):
     references: list[EHRContextItem]
 
 
-class EHRContextIds(BaseModel):
-    ids: list[UUID]
+class EHRBatchQuery(BaseModel):
+    queries: list[str] = Field(min_length=1, max_length=20)
+
+
+class EHRBatchQueryResult(BaseModel):
+    query: str
+    # Without an answer, error says why that question failed
+    answer: Optional[str] = None
+    references: list[EHRContextItem] = []
+    error: Optional[str] = None
+
+
+class EHRBatchQueryOutput(BaseModel):
+    # In the order of the queries
+    results: list[EHRBatchQueryResult]
+
+
+class EHRPatientsQuery(BaseModel):
+    query: str
+    patient_ids: list[str] = Field(min_length=1, max_length=1000)
+
+
+class EHRPatientQueryResult(BaseModel):
+    patient_id: str
+    # Without an answer, error says why the query failed for that patient
+    answer: Optional[str] = None
+    references: list[EHRContextItem] = []
+    error: Optional[str] = None
+
+
+class EHRQueryReferences(BaseModel):
+    references: list[EHRContextItem]
+
+
+class EHRQueryAnswerDelta(BaseModel):
+    delta: str
+
+
+class EHRQueryStreamError(BaseModel):
+    detail: str
+
+
+class EHRContextAliases(BaseModel):
+    # Aliases of the contexts as listed in the selection prompt, not their UUIDs
+    ids: list[int]
+    model_config = ConfigDict(extra="forbid")
+
+
+class EHRAnswerWithContextAliases(BaseModel):
+    answer: str
+    # Aliases of the contexts the answer is based on, as for EHRContextAliases
+    ids: list[int]
+    model_config = ConfigDict(extra="forbid")
+
+
+class EHRQuestionContextAliases(BaseModel):
+    # Number of the question in the batch selection prompt, from 1
+    question: int
+    ids: list[int]
+    model_config = ConfigDict(extra="forbid")
+
+
+class EHRBatchContextAliases(BaseModel):
+    selections: list[EHRQuestionContextAliases]
     model_config = ConfigDict(extra="forbid")
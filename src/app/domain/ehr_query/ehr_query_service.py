@@ -1,49 +1,550 @@
-from app.domain.ehr_ingestion.ehr_contexts_repository import EhrContextsRepository
+import asyncio
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import (
+    AsyncGenerator,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+from uuid import UUID
+
+from app.core.metrics import QUERY_CANDIDATE_TOKENS, QUERY_CONTEXT_SELECTIONS
+from app.core.timing import timed
+from app.domain.ehr_ingestion.ehr_context_models import (
+    EHRContextItem,
+    EHRContextsSnapshot,
+)
+from app.domain.ehr_ingestion.ehr_contexts_cache import EHRContextsCache
+from app.domain.ehr_ingestion.ehr_contexts_repository import (
+    EhrContextsRepositoryFactory,
+)
+from app.domain.ehr_query.ehr_answer_cache import EHRAnswerCache, ehr_answer_key
+from app.domain.ehr_query.ehr_contexts_prefilter import EHRContextsPrefilter
 from app.domain.ehr_query.ehr_prompt_utils import (
+    PROMPT_FRAGMENT_VERSION,
+    Prompt,
+    build_ehr_contexts_batch_selection_prompt,
+    build_ehr_contexts_selection_answer_prompt,
     build_ehr_contexts_selection_prompt,
     build_grounded_query_output_prompt,
+    estimate_ehr_context_items_tokens,
+    report_prompt_tokens,
 )
 from app.domain.ehr_query.ehr_query_models import (
-    EHRContextIds,
+    EHRAnswerWithContextAliases,
+    EHRBatchContextAliases,
+    EHRBatchQuery,
+    EHRBatchQueryOutput,
+    EHRBatchQueryResult,
+    EHRContextAliases,
+    EHRPatientQueryResult,
+    EHRPatientsQuery,
     EHRQuery,
+    EHRQueryMode,
     EHRQueryOutput,
 )
+from app.domain.ehr_query.ehr_type_router import (
+    EHRContextTypeRoute,
+    EHRContextTypeRouter,
+)
 from app.domain.llm.llm_client import LLMClient
 
+logger = logging.getLogger(__name__)
+
+
+class ContextSelection(NamedTuple):
+    # "selected" by the LLM, or "skipped" and every candidate answered from
+    decision: Literal["selected", "skipped"]
+    # Approximate, of the candidates' lines
+    candidate_tokens: int
+
+
+_context_selections: ContextVar[Optional[list[ContextSelection]]] = ContextVar(
+    "context_selections", default=None
+)
+
+
+@contextmanager
+def record_context_selections() -> Iterator[list[ContextSelection]]:
+    """Collects the selection decision of every query made within the block,
+    in order, e.g. to report them in a response header."""
+    selections: list[ContextSelection] = []
+    token = _context_selections.set(selections)
+    try:
+        yield selections
+    finally:
+        _context_selections.reset(token)
+
+
+def report_context_selection(selection: ContextSelection) -> None:
+    QUERY_CONTEXT_SELECTIONS.inc(decision=selection.decision)
+    QUERY_CANDIDATE_TOKENS.observe(
+        selection.candidate_tokens, decision=selection.decision
+    )
+    selections = _context_selections.get()
+    if selections is not None:
+        selections.append(selection)
+
 
 class EHRQueryService:
 
     def __init__(
-        self, ehr_contexts_repository: EhrContextsRepository, llm_client: LLMClient
+        self,
+        ehr_contexts_repository_factory: EhrContextsRepositoryFactory,
+        llm_client: LLMClient,
+        ehr_contexts_cache: Optional[EHRContextsCache] = None,
+        ehr_contexts_prefilter: Optional[EHRContextsPrefilter] = None,
+        ehr_context_type_router: Optional[EHRContextTypeRouter] = None,
+        prompt_token_budget: Optional[int] = None,
+        prompt_item_max_tokens: Optional[int] = None,
+        batch_query_concurrency: int = 4,
+        query_mode: Literal["two_calls", "single_call", "auto"] = "two_calls",
+        single_call_max_tokens: int = 3000,
+        skip_selection_below_tokens: int = 0,
+        ehr_answer_cache: Optional[EHRAnswerCache] = None,
     ):
-        self.ehr_contexts_repository = ehr_contexts_repository
+        self.ehr_contexts_repository_factory = ehr_contexts_repository_factory
         self.llm_client = llm_client
+        self.ehr_contexts_cache = ehr_contexts_cache
+        self.ehr_contexts_prefilter = ehr_contexts_prefilter
+        self.ehr_context_type_router = ehr_context_type_router
+        self.prompt_token_budget = prompt_token_budget
+        self.prompt_item_max_tokens = prompt_item_max_tokens
+        self.batch_query_concurrency = batch_query_concurrency
+        self.query_mode = query_mode
+        self.single_call_max_tokens = single_call_max_tokens
+        self.skip_selection_below_tokens = skip_selection_below_tokens
+        self.ehr_answer_cache = ehr_answer_cache
 
-    async def query(self, patient_id: str, ehr_query: EHRQuery) -> EHRQueryOutput:
-        items = await self.ehr_contexts_repository.list_by_patient(patient_id)
+    async def query(
+        self,
+        patient_id: str,
+        ehr_query: EHRQuery,
+        mode: Optional[EHRQueryMode] = None,
+    ) -> EHRQueryOutput:
+        """Answers the question in the given mode, or else in the service's: in
+        auto mode, with a single call while its prompt is small enough. Few
+        enough candidates are all answered from, without selecting any.
+        Repeated questions are answered from the answer cache, if any, until
+        the patient's contexts change."""
+        query_mode = mode or self.query_mode
+        contexts = await self._read_contexts(patient_id, [ehr_query.query])
+        if self.ehr_answer_cache is None or contexts.version is None:
+            return await self._answer(ehr_query, contexts.items, query_mode)
 
-        context_selection_prompt = build_ehr_contexts_selection_prompt(
-            question=ehr_query.query,
-            ehr_context_items=items,
+        # The version the items were read at, even if a newer one was written
+        # since: the answer is built from them
+        key = ehr_answer_key(
+            patient_id,
+            contexts.version,
+            ehr_query.query,
+            variant=self._answer_variant(query_mode),
         )
-
-        relevant_items_ids = await self.llm_client.run_structured(
-            prompt=context_selection_prompt,
-            response_model=EHRContextIds,
+        return await self.ehr_answer_cache.get_or_answer(
+            key, lambda: self._answer(ehr_query, contexts.items, query_mode)
         )
 
-        relevant_items = [item for item in items if item.id in relevant_items_ids.ids]
+    def _answer_variant(
+        self, mode: Literal["two_calls", "single_call", "auto"]
+    ) -> list[str]:
+        """What answers depend on besides the contexts and the question: the
+        model, and whatever shapes its prompts. Answers given under another
+        configuration are not served."""
+        prefilter = self.ehr_contexts_prefilter
+        router = self.ehr_context_type_router
+        return [
+            self.llm_client.model,
+            mode,
+            prefilter.variant if prefilter is not None else "",
+            router.variant if router is not None else "",
+            str(self.prompt_token_budget),
+            str(self.prompt_item_max_tokens),
+            str(self.single_call_max_tokens),
+            str(self.skip_selection_below_tokens),
+            str(PROMPT_FRAGMENT_VERSION),
+        ]
 
-        grounded_answer_prompt = build_grounded_query_output_prompt(
-            question=ehr_query.query,
-            ehr_context_items=relevant_items,
-        )
+    async def _answer(
+        self,
+        ehr_query: EHRQuery,
+        items: List[EHRContextItem],
+        mode: Literal["two_calls", "single_call", "auto"],
+    ) -> EHRQueryOutput:
+        items = await self._prefilter([ehr_query.query], items)
+
+        if self._skips_selection(items):
+            relevant_items = items
+        else:
+            single_call_prompt = self._build_single_call_prompt(ehr_query, items, mode)
+            if single_call_prompt is not None:
+                return await self._select_and_answer(single_call_prompt)
 
-        grounded_query_output = await self.llm_client.run(
-            prompt=grounded_answer_prompt,
+            relevant_items = await self._select_references(ehr_query, items)
+
+        grounded_answer_prompt = self._build_grounded_answer_prompt(
+            ehr_query, relevant_items
         )
 
+        with timed("llm_answer"):
+            grounded_query_output = await self.llm_client.run(
+                prompt=grounded_answer_prompt.text,
+            )
+
         return EHRQueryOutput(
             answer=grounded_query_output,
             references=relevant_items,
         )
+
+    async def select_references(
+        self, patient_id: str, ehr_query: EHRQuery
+    ) -> List[EHRContextItem]:
+        """The context items the LLM selects as relevant to the question, or
+        every candidate if they are few enough."""
+        items = await self._list_candidate_contexts(patient_id, [ehr_query.query])
+        if self._skips_selection(items):
+            return items
+        return await self._select_references(ehr_query, items)
+
+    async def _select_references(
+        self, ehr_query: EHRQuery, items: List[EHRContextItem]
+    ) -> List[EHRContextItem]:
+        with timed("selection_prompt"):
+            context_selection_prompt = build_ehr_contexts_selection_prompt(
+                question=ehr_query.query,
+                ehr_context_items=items,
+                token_budget=self.prompt_token_budget,
+                item_max_tokens=self.prompt_item_max_tokens,
+            )
+        report_prompt_tokens(context_selection_prompt.tokens)
+
+        with timed("llm_selection"):
+            relevant_items_aliases = await self.llm_client.run_structured(
+                prompt=context_selection_prompt.text,
+                response_model=EHRContextAliases,
+            )
+
+        return resolve_ehr_context_aliases(
+            relevant_items_aliases.ids, context_selection_prompt.ehr_context_items
+        )
+
+    async def batch_query(
+        self, patient_id: str, ehr_batch_query: EHRBatchQuery
+    ) -> EHRBatchQueryOutput:
+        """Answers several questions with one read of the contexts and one
+        selection call, then generates the answers concurrently. A question
+        whose answer fails gets an error result, the others are unaffected."""
+        queries = ehr_batch_query.queries
+        items = await self._list_candidate_contexts(patient_id, queries)
+
+        if self._skips_selection(items):
+            references_by_question = {
+                number: items for number in range(1, len(queries) + 1)
+            }
+        else:
+            references_by_question = await self._batch_select_references(queries, items)
+
+        concurrency = asyncio.Semaphore(self.batch_query_concurrency)
+
+        async def answer(number: int, query: str) -> EHRBatchQueryResult:
+            references = references_by_question.get(number, [])
+            grounded_answer_prompt = self._build_grounded_answer_prompt(
+                EHRQuery(query=query), references
+            )
+
+            async with concurrency:
+                try:
+                    with timed("llm_answer"):
+                        grounded_query_output = await self.llm_client.run(
+                            prompt=grounded_answer_prompt.text,
+                        )
+                except Exception:
+                    logger.exception("Answering batch question %d failed", number)
+                    return EHRBatchQueryResult(
+                        query=query, error="Answer generation failed"
+                    )
+
+            return EHRBatchQueryResult(
+                query=query, answer=grounded_query_output, references=references
+            )
+
+        results = await asyncio.gather(
+            *(answer(number, query) for number, query in enumerate(queries, 1))
+        )
+
+        return EHRBatchQueryOutput(results=results)
+
+    async def _batch_select_references(
+        self, queries: List[str], items: List[EHRContextItem]
+    ) -> Dict[int, List[EHRContextItem]]:
+        """The items selected for each question, by number from 1."""
+        with timed("selection_prompt"):
+            context_selection_prompt = build_ehr_contexts_batch_selection_prompt(
+                questions=queries,
+                ehr_context_items=items,
+                token_budget=self.prompt_token_budget,
+                item_max_tokens=self.prompt_item_max_tokens,
+            )
+        report_prompt_tokens(context_selection_prompt.tokens)
+
+        with timed("llm_selection"):
+            selection = await self.llm_client.run_structured(
+                prompt=context_selection_prompt.text,
+                response_model=EHRBatchContextAliases,
+            )
+
+        aliases_by_question: Dict[int, List[int]] = {}
+        for question_selection in selection.selections:
+            aliases_by_question.setdefault(question_selection.question, []).extend(
+                question_selection.ids
+            )
+
+        return {
+            number: resolve_ehr_context_aliases(
+                aliases, context_selection_prompt.ehr_context_items
+            )
+            for number, aliases in aliases_by_question.items()
+        }
+
+    async def query_patients(
+        self, ehr_patients_query: EHRPatientsQuery, concurrency: int
+    ) -> AsyncGenerator[EHRPatientQueryResult, None]:
+        """Runs the question for each patient, at most concurrency at a time,
+        and yields the results as they complete. A patient whose query fails
+        gets an error result, the others are unaffected. Closing the iterator
+        cancels the queries still running."""
+        semaphore = asyncio.Semaphore(concurrency)
+        ehr_query = EHRQuery(query=ehr_patients_query.query)
+
+        async def query_patient(patient_id: str) -> EHRPatientQueryResult:
+            async with semaphore:
+                try:
+                    output = await self.query(patient_id, ehr_query)
+                except Exception:
+                    logger.exception("Querying patient %s failed", patient_id)
+                    return EHRPatientQueryResult(
+                        patient_id=patient_id, error="Query failed"
+                    )
+
+            return EHRPatientQueryResult(
+                patient_id=patient_id,
+                answer=output.answer,
+                references=output.references,
+            )
+
+        tasks = [
+            asyncio.create_task(query_patient(patient_id))
+            for patient_id in dict.fromkeys(ehr_patients_query.patient_ids)
+        ]
+        try:
+            for completed in asyncio.as_completed(tasks):
+                yield await completed
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stream_answer(
+        self, ehr_query: EHRQuery, references: List[EHRContextItem]
+    ) -> AsyncIterator[str]:
+        """Streams the grounded answer to the question, built only from the
+        given references, as the LLM generates it."""
+        grounded_answer_prompt = self._build_grounded_answer_prompt(
+            ehr_query, references
+        )
+
+        async def answer_chunks() -> AsyncIterator[str]:
+            with timed("llm_answer"):
+                async for chunk in self.llm_client.stream(
+                    prompt=grounded_answer_prompt.text
+                ):
+                    yield chunk
+
+        return answer_chunks()
+
+    def _skips_selection(self, items: List[EHRContextItem]) -> bool:
+        """Whether the candidates are few enough to answer from all of them,
+        rather than paying for an LLM call to select some. Reported either way,
+        to tune the threshold."""
+        candidate_tokens = estimate_ehr_context_items_tokens(
+            items, self.prompt_item_max_tokens
+        )
+        skipped = candidate_tokens < self.skip_selection_below_tokens
+        report_context_selection(
+            ContextSelection(
+                decision="skipped" if skipped else "selected",
+                candidate_tokens=candidate_tokens,
+            )
+        )
+        return skipped
+
+    def _build_single_call_prompt(
+        self,
+        ehr_query: EHRQuery,
+        items: List[EHRContextItem],
+        mode: Literal["two_calls", "single_call", "auto"],
+    ) -> Optional[Prompt]:
+        """The prompt to select and answer in one call, None if the mode makes
+        a call for each: two_calls, or auto past single_call_max_tokens."""
+        if mode == "two_calls":
+            return None
+
+        with timed("selection_answer_prompt"):
+            prompt = build_ehr_contexts_selection_answer_prompt(
+                question=ehr_query.query,
+                ehr_context_items=items,
+                token_budget=self.prompt_token_budget,
+                item_max_tokens=self.prompt_item_max_tokens,
+            )
+
+        if mode == "auto" and prompt.tokens > self.single_call_max_tokens:
+            return None
+        return prompt
+
+    async def _select_and_answer(self, prompt: Prompt) -> EHRQueryOutput:
+        report_prompt_tokens(prompt.tokens)
+
+        with timed("llm_selection_answer"):
+            answer = await self.llm_client.run_structured(
+                prompt=prompt.text,
+                response_model=EHRAnswerWithContextAliases,
+            )
+
+        # Cited aliases are checked as selected ones are
+        return EHRQueryOutput(
+            answer=answer.answer,
+            references=resolve_ehr_context_aliases(
+                answer.ids, prompt.ehr_context_items
+            ),
+        )
+
+    def _build_grounded_answer_prompt(
+        self, ehr_query: EHRQuery, references: List[EHRContextItem]
+    ) -> Prompt:
+        with timed("answer_prompt"):
+            grounded_answer_prompt = build_grounded_query_output_prompt(
+                question=ehr_query.query,
+                ehr_context_items=references,
+            )
+        report_prompt_tokens(grounded_answer_prompt.tokens)
+
+        return grounded_answer_prompt
+
+    async def _list_candidate_contexts(
+        self, patient_id: str, questions: List[str]
+    ) -> List[EHRContextItem]:
+        """The items worth showing to the selection step for any of the
+        questions: of the types they are routed to, then prefiltered."""
+        contexts = await self._read_contexts(patient_id, questions)
+        return await self._prefilter(questions, contexts.items)
+
+    async def _read_contexts(
+        self, patient_id: str, questions: List[str]
+    ) -> EHRContextsSnapshot:
+        """The items of the types any of the questions are routed to, with the
+        version of the snapshot they were read from."""
+        router = self.ehr_context_type_router
+        with timed("routing"):
+            routes = (
+                [await router.route(question) for question in questions]
+                if router is not None
+                else []
+            )
+
+        if router is None or any(route is None for route in routes):
+            return await self._list_contexts(patient_id)
+
+        route = EHRContextTypeRoute(
+            types=frozenset().union(
+                *(route.types for route in routes if route is not None)
+            )
+        )
+        contexts, skipped = await self._list_routed_contexts(patient_id, route)
+        router.record_narrowed_items(kept=len(contexts.items), skipped=skipped)
+        return contexts
+
+    async def _prefilter(
+        self, questions: List[str], items: List[EHRContextItem]
+    ) -> List[EHRContextItem]:
+        if self.ehr_contexts_prefilter is None:
+            return items
+
+        with timed("prefilter"):
+            candidate_ids: Set[UUID] = set()
+            for question in questions:
+                narrowed = await self.ehr_contexts_prefilter.narrow(question, items)
+                candidate_ids.update(item.id for item in narrowed)
+            return [item for item in items if item.id in candidate_ids]
+
+    async def _list_contexts(self, patient_id: str) -> EHRContextsSnapshot:
+        if self.ehr_contexts_cache is None:
+            return await self._list_by_patient(patient_id)
+
+        return await self.ehr_contexts_cache.get_or_load(
+            patient_id, lambda: self._list_by_patient(patient_id)
+        )
+
+    async def _list_routed_contexts(
+        self, patient_id: str, route: EHRContextTypeRoute
+    ) -> Tuple[EHRContextsSnapshot, int]:
+        """The items of the routed types, and how many of the others were
+        skipped."""
+        cached = None
+        if self.ehr_contexts_cache is not None:
+            cached = self.ehr_contexts_cache.get(patient_id)
+
+        # A cached patient is filtered in memory. Otherwise only the routed types
+        # are read, and not cached: the cache holds whole patients.
+        if cached is not None:
+            items = [item for item in cached.items if item.type in route.types]
+            return cached._replace(items=items), len(cached.items) - len(items)
+
+        async with self.ehr_contexts_repository_factory() as ehr_contexts_repository:
+            with timed("db_read"):
+                items, total, version = (
+                    await ehr_contexts_repository.list_by_patient_and_types(
+                        patient_id, route.types
+                    )
+                )
+        contexts = EHRContextsSnapshot(version=version, items=items)
+        # Unknown without a snapshot, not counted
+        return contexts, total - len(items) if total is not None else 0
+
+    async def _list_by_patient(self, patient_id: str) -> EHRContextsSnapshot:
+        # The connection goes back to the pool before the LLM round-trips, which
+        # take far longer than the read and would otherwise starve the pool.
+        async with self.ehr_contexts_repository_factory() as ehr_contexts_repository:
+            with timed("db_read"):
+                # One row rather than one per item, unless the patient has not
+                # been re-ingested since snapshots exist
+                snapshot = await ehr_contexts_repository.get_snapshot(patient_id)
+                if snapshot is not None:
+                    return snapshot
+                items = await ehr_contexts_repository.list_by_patient(
+                    patient_id, embeddings=True, prompt_fragments=True
+                )
+                return EHRContextsSnapshot(version=None, items=items)
+
+
+def resolve_ehr_context_aliases(
+    aliases: List[int], ehr_context_items: List[EHRContextItem]
+) -> List[EHRContextItem]:
+    """The items behind the aliases of a selection prompt, in prompt order.
+    Aliases out of range name no listed item and are rejected."""
+    valid = {alias for alias in aliases if 1 <= alias <= len(ehr_context_items)}
+
+    rejected = len(set(aliases) - valid)
+    if rejected:
+        logger.warning(
+            "Rejected %d out-of-range context aliases (%d contexts listed)",
+            rejected,
+            len(ehr_context_items),
+        )
+
+    return [item for alias, item in enumerate(ehr_context_items, 1) if alias in valid]
@@ -0,0 +1,200 @@
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Optional, override
+
+import numpy as np
+from pydantic import BaseModel
+
+from app.domain.ehr_ingestion.ehr_context_models import EHRContextType
+from app.domain.ehr_query.ehr_lexical_ranker import tokenize
+from app.domain.llm.embedding_client import EmbeddingClient, EmbeddingMatrix
+
+# Words that, in a question, clearly point at one type of context. Kept narrower
+# than the ranker's EHR_CONTEXT_TYPE_TERMS on purpose: a wrong match here hides
+# whole types from the LLM, so ambiguous words ("tipo", "control", "médico")
+# are left out and such questions fall back to the classifier or to all types.
+EHR_CONTEXT_TYPE_KEYWORDS: dict[EHRContextType, str] = {
+    EHRContextType.DEMOGRAPHICS: (
+        "edad años nombre género sexo sanguíneo sangre nacimiento demográficos"
+    ),
+    EHRContextType.CHRONIC_CONDITION: (
+        "crónica crónico crónicas enfermedad enfermedades diagnóstico diagnósticos"
+        " antecedentes patología patologías comorbilidades padece"
+    ),
+    EHRContextType.ALLERGY: "alergia alergias alérgico alérgica intolerancia",
+    EHRContextType.MEDICATION: (
+        "medicación medicamento medicamentos fármaco fármacos tratamiento dosis"
+        " toma tomar receta prescripción pastillas"
+    ),
+    EHRContextType.VISIT: (
+        "visita visitas consulta consultado consultó cita citas motivo notas acudió"
+    ),
+    EHRContextType.LAB_RESULT: (
+        "laboratorio análisis estudio estudios prueba pruebas resultado resultados"
+        " examen valores hemograma hemoglobina glucosa colesterol triglicéridos"
+        " perfil lipídico panel metabólico creatinina hba1c ldl hdl"
+    ),
+}
+
+# Words asking about the record as a whole, which no subset of types answers
+BROAD_QUESTION_KEYWORDS = "resumen historia historial general"
+
+# Always sent alongside a routed subset: demographics are a single cheap item
+# that grounds every answer, and allergies matter to any medication question.
+ALWAYS_ROUTED_TYPES = frozenset({EHRContextType.DEMOGRAPHICS})
+COMPANION_TYPES: dict[EHRContextType, frozenset[EHRContextType]] = {
+    EHRContextType.MEDICATION: frozenset({EHRContextType.ALLERGY}),
+}
+
+
+def _keyword_types() -> dict[str, frozenset[EHRContextType]]:
+    types_by_term: dict[str, set[EHRContextType]] = {}
+    for type, keywords in EHR_CONTEXT_TYPE_KEYWORDS.items():
+        for term in tokenize(keywords):
+            types_by_term.setdefault(term, set()).add(type)
+
+    return {term: frozenset(types) for term, types in types_by_term.items()}
+
+
+KEYWORD_TYPES = _keyword_types()
+BROAD_QUESTION_TERMS = frozenset(tokenize(BROAD_QUESTION_KEYWORDS))
+
+
+@dataclass(frozen=True)
+class EHRContextTypeRoute:
+    types: frozenset[EHRContextType]
+    by_classifier: bool = False
+
+
+class EHRContextTypeRoutingStats(BaseModel):
+    questions: int
+    # Questions routed to a subset of the types, and by the classifier fallback
+    narrowed: int
+    narrowed_by_classifier: int
+    # Summed over narrowed questions. Skipped items are counted from the cached
+    # patient, or else from its snapshot's item count: those of patients
+    # without a snapshot yet are not.
+    types_skipped: int
+    items_kept: int
+    items_skipped: int
+
+
+class EHRContextTypeClassifier(ABC):
+    """Fallback for questions that match no keyword."""
+
+    @property
+    @abstractmethod
+    def variant(self) -> str:
+        """The classifier and its configuration, see EHRContextTypeRouter.variant."""
+
+    @abstractmethod
+    async def classify(self, question: str) -> frozenset[EHRContextType]: ...
+
+
+class EmbeddingEHRContextTypeClassifier(EHRContextTypeClassifier):
+    """Picks the type whose keywords embed closest to the question.
+
+    With the local hashing embedder this is a fuzzy keyword match (sub-word
+    overlap, e.g. "alergénico"), which costs one embedding of the question.
+    Similarities are noisy for short questions, so only the best type is kept
+    and only when it reaches min_similarity, otherwise the question is not
+    routed.
+    """
+
+    def __init__(self, embedding_client: EmbeddingClient, min_similarity: float):
+        self._embedding_client = embedding_client
+        self._min_similarity = min_similarity
+        self._types = list(EHR_CONTEXT_TYPE_KEYWORDS)
+        self._prototypes: Optional[EmbeddingMatrix] = None
+
+    @property
+    @override
+    def variant(self) -> str:
+        return f"embedding:{self._min_similarity}:{self._embedding_client.dimensions}"
+
+    @override
+    async def classify(self, question: str) -> frozenset[EHRContextType]:
+        if self._prototypes is None:
+            self._prototypes = await self._embedding_client.embed(
+                [EHR_CONTEXT_TYPE_KEYWORDS[type] for type in self._types]
+            )
+
+        question_embedding = (await self._embedding_client.embed([question]))[0]
+        similarities = self._prototypes @ question_embedding
+
+        best = int(np.argmax(similarities))
+        if similarities[best] < self._min_similarity:
+            return frozenset()
+
+        return frozenset({self._types[best]})
+
+
+class EHRContextTypeRouter:
+    """Maps a question to the types of context it is about, so that only those
+    are read and sent to the LLM.
+
+    Keywords decide first; questions matching none go to the optional
+    classifier. Questions about the whole record, or that nothing matches, are
+    not routed (None) and see every type.
+    """
+
+    def __init__(self, classifier: Optional[EHRContextTypeClassifier] = None):
+        self._classifier = classifier
+
+        self._questions = 0
+        self._narrowed = 0
+        self._narrowed_by_classifier = 0
+        self._types_skipped = 0
+        self._items_kept = 0
+        self._items_skipped = 0
+
+    @property
+    def variant(self) -> str:
+        """The router and its configuration: routers of the same variant route
+        questions alike, e.g. for answer cache keys."""
+        if self._classifier is None:
+            return "keywords"
+        return f"keywords+{self._classifier.variant}"
+
+    async def route(self, question: str) -> Optional[EHRContextTypeRoute]:
+        self._questions += 1
+
+        terms = set(tokenize(question))
+        if terms & BROAD_QUESTION_TERMS:
+            return None
+
+        types: frozenset[EHRContextType] = frozenset().union(
+            *(KEYWORD_TYPES[term] for term in terms if term in KEYWORD_TYPES)
+        )
+        by_classifier = False
+        if not types and self._classifier is not None:
+            types = await self._classifier.classify(question)
+            by_classifier = True
+        if not types:
+            return None
+
+        types = types.union(
+            ALWAYS_ROUTED_TYPES, *(COMPANION_TYPES.get(type, ()) for type in types)
+        )
+        if types >= set(EHRContextType):
+            return None
+
+        self._narrowed += 1
+        self._narrowed_by_classifier += by_classifier
+        self._types_skipped += len(EHRContextType) - len(types)
+
+        return EHRContextTypeRoute(types=types, by_classifier=by_classifier)
+
+    def record_narrowed_items(self, kept: int, skipped: int) -> None:
+        self._items_kept += kept
+        self._items_skipped += skipped
+
+    def stats(self) -> EHRContextTypeRoutingStats:
+        return EHRContextTypeRoutingStats(
+            questions=self._questions,
+            narrowed=self._narrowed,
+            narrowed_by_classifier=self._narrowed_by_classifier,
+            types_skipped=self._types_skipped,
+            items_kept=self._items_kept,
+            items_skipped=self._items_skipped,
+        )
@@ -0,0 +1,82 @@
+from typing import override
+
+import numpy as np
+
+from app.domain.ehr_ingestion.ehr_context_models import EHRContextItem
+from app.domain.ehr_query.ehr_contexts_prefilter import EHRContextsPrefilter
+from app.domain.ehr_query.ehr_lexical_ranker import ehr_context_item_search_text
+from app.domain.llm.embedding_client import (
+    EmbeddingClient,
+    EmbeddingMatrix,
+    decode_embeddings,
+)
+
+
+class VectorEHRContextsPrefilter(EHRContextsPrefilter):
+    """Keeps the top_k items whose embeddings are closest to the question's.
+
+    Item embeddings are computed at ingestion and stored with the items, so a
+    query only embeds the question and runs one matrix-vector product over the
+    patient's items (an exact search, which for the few thousand items of a
+    patient is faster than building an approximate index). Items stored
+    without an embedding, or with one of a different size, are embedded on the
+    fly. Patients with at most bypass_max_items items are not filtered.
+    """
+
+    def __init__(
+        self,
+        embedding_client: EmbeddingClient,
+        top_k: int,
+        bypass_max_items: int,
+    ) -> None:
+        self._embedding_client = embedding_client
+        self._top_k = top_k
+        self._bypass_max_items = bypass_max_items
+
+    @property
+    @override
+    def variant(self) -> str:
+        return (
+            f"vector:{self._top_k}:{self._bypass_max_items}"
+            f":{self._embedding_client.dimensions}"
+        )
+
+    @override
+    async def narrow(
+        self, question: str, items: list[EHRContextItem]
+    ) -> list[EHRContextItem]:
+        if len(items) <= max(self._bypass_max_items, self._top_k):
+            return items
+
+        matrix = await self._item_embeddings(items)
+        question_embedding = (await self._embedding_client.embed([question]))[0]
+
+        similarities = matrix @ question_embedding
+        kept = np.argpartition(-similarities, self._top_k)[: self._top_k]
+
+        return [items[i] for i in np.sort(kept)]
+
+    async def _item_embeddings(self, items: list[EHRContextItem]) -> EmbeddingMatrix:
+        dimensions = self._embedding_client.dimensions
+        size = dimensions * np.dtype(np.float32).itemsize
+
+        stored = [
+            item.embedding
+            for item in items
+            if item.embedding is not None and len(item.embedding) == size
+        ]
+        if len(stored) == len(items):
+            return decode_embeddings(stored, dimensions)
+
+        matrix = np.empty((len(items), dimensions), dtype=np.float32)
+        missing = []
+        for i, item in enumerate(items):
+            if item.embedding is not None and len(item.embedding) == size:
+                matrix[i] = decode_embeddings([item.embedding], dimensions)[0]
+            else:
+                missing.append(i)
+
+        matrix[missing] = await self._embedding_client.embed(
+            [ehr_context_item_search_text(items[i]) for i in missing]
+        )
+        return matrix
@@ -0,0 +1,110 @@
+import hashlib
+import json
+from typing import Any, AsyncIterator, TypeVar, cast, override
+
+from pydantic import TypeAdapter
+
+from app.domain.llm.llm_client import LLMClient
+from app.domain.llm.llm_response_cache import (
+    LLMCacheStatus,
+    LLMResponseCache,
+    report_llm_cache_status,
+)
+
+T = TypeVar("T")
+
+
+# Building an adapter compiles a validator, so it is done once per model
+_type_adapters: dict[type[Any], TypeAdapter[Any]] = {}
+
+
+def _type_adapter(response_model: type[T]) -> TypeAdapter[T]:
+    type_adapter = _type_adapters.get(response_model)
+    if type_adapter is None:
+        type_adapter = _type_adapters[response_model] = TypeAdapter(response_model)
+
+    return cast(TypeAdapter[T], type_adapter)
+
+
+class CachingLLMClient(LLMClient):
+    """Serves identical calls from a response cache instead of the network.
+
+    Keys combine the model, the response schema (none for free-text answers)
+    and a hash of the prompt. Prompts embed the patient's contexts, so a change
+    in the record changes the key and stale answers are never served for it.
+    """
+
+    def __init__(self, llm_client: LLMClient, cache: LLMResponseCache) -> None:
+        self._llm_client = llm_client
+        self._cache = cache
+
+    @property
+    @override
+    def model(self) -> str:
+        return self._llm_client.model
+
+    @override
+    async def run_structured(
+        self,
+        *,
+        prompt: str,
+        response_model: type[T],
+    ) -> T:
+        type_adapter = _type_adapter(response_model)
+        key = self._key(prompt, schema=type_adapter.json_schema())
+
+        cached = await self._cache.get(key)
+        if cached is not None:
+            report_llm_cache_status(LLMCacheStatus.HIT)
+            return type_adapter.validate_json(cached)
+
+        report_llm_cache_status(LLMCacheStatus.MISS)
+        response = await self._llm_client.run_structured(
+            prompt=prompt, response_model=response_model
+        )
+        await self._cache.set(key, type_adapter.dump_json(response).decode())
+
+        return response
+
+    @override
+    async def run(self, *, prompt: str) -> str:
+        key = self._key(prompt, schema=None)
+
+        cached = await self._cache.get(key)
+        if cached is not None:
+            report_llm_cache_status(LLMCacheStatus.HIT)
+            return cached
+
+        report_llm_cache_status(LLMCacheStatus.MISS)
+        response = await self._llm_client.run(prompt=prompt)
+        await self._cache.set(key, response)
+
+        return response
+
+    @override
+    async def stream(self, *, prompt: str) -> AsyncIterator[str]:
+        # Same key as run: a streamed answer is cached once complete, and
+        # served later as a single chunk
+        key = self._key(prompt, schema=None)
+
+        cached = await self._cache.get(key)
+        if cached is not None:
+            report_llm_cache_status(LLMCacheStatus.HIT)
+            yield cached
+            return
+
+        report_llm_cache_status(LLMCacheStatus.MISS)
+        chunks = []
+        async for chunk in self._llm_client.stream(prompt=prompt):
+            chunks.append(chunk)
+            yield chunk
+
+        await self._cache.set(key, "".join(chunks))
+
+    def _key(self, prompt: str, schema: dict[str, Any] | None) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
+        return hashlib.sha256(
+            json.dumps(
+                [self.model, schema, prompt_hash], sort_keys=True, ensure_ascii=False
+            ).encode()
+        ).hexdigest()
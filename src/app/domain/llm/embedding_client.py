@@ -0,0 +1,30 @@
+from abc import ABC, abstractmethod
+from typing import Sequence
+
+import numpy as np
+import numpy.typing as npt
+
+EmbeddingMatrix = npt.NDArray[np.float32]
+
+
+class EmbeddingClient(ABC):
+
+    @property
+    @abstractmethod
+    def dimensions(self) -> int: ...
+
+    @abstractmethod
+    async def embed(self, texts: Sequence[str]) -> EmbeddingMatrix:
+        """Returns one L2-normalized float32 row per text, so that dot products
+        are cosine similarities."""
+
+
+def encode_embedding(vector: EmbeddingMatrix) -> bytes:
+    """Compact storage format of an embedding: its raw float32 bytes."""
+    return vector.astype(np.float32).tobytes()
+
+
+def decode_embeddings(encoded: Sequence[bytes], dimensions: int) -> EmbeddingMatrix:
+    return np.frombuffer(b"".join(encoded), dtype=np.float32).reshape(
+        len(encoded), dimensions
+    )
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Type, TypeVar
+from typing import AsyncIterator, Type, TypeVar
 from uuid import UUID
 
 from openai import BaseModel
@@ -13,6 +13,11 @@ T = TypeVar("T")
 
 class LLMClient(ABC):
 
+    @property
+    def model(self) -> str:
+        """Identifies the model answering, e.g. in response cache keys."""
+        return type(self).__name__
+
     @abstractmethod
     async def run_structured(
         self,
@@ -27,3 +32,12 @@ class LLMClient(ABC):
         *,
         prompt: str,
     ) -> str: ...
+
+    async def stream(
+        self,
+        *,
+        prompt: str,
+    ) -> AsyncIterator[str]:
+        """Yields the answer in chunks as they are generated. By default the
+        whole answer of run comes as a single chunk."""
+        yield await self.run(prompt=prompt)
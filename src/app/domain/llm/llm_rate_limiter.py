@@ -0,0 +1,164 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from pydantic import BaseModel
+
+# Burst allowed by the per-minute limits. The API enforces them over shorter
+# windows too, so a whole minute's quota is never sent at once.
+RATE_LIMIT_BURST_SECONDS = 1.0
+
+
+class LLMRateLimiterStats(BaseModel):
+    requests: int
+    # Calls that had to wait for a slot or for the rate limits, and for how long
+    queued: int
+    wait_seconds_total: float
+    wait_seconds_max: float
+    # Right now
+    waiting: int
+    in_flight: int
+    # Approximate tokens of the calls made, as counted against the limits
+    prompt_tokens: int
+    output_tokens: int
+
+
+class _TokenBucket:
+    """Refills at per_minute / 60 a second, up to the burst. Takes may leave it
+    below zero, e.g. for output tokens only known after the call, and later
+    calls then wait for the debt to be paid off."""
+
+    def __init__(self, per_minute: float) -> None:
+        self._rate = per_minute / 60
+        self._capacity = max(self._rate * RATE_LIMIT_BURST_SECONDS, 1.0)
+        self._level = self._capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._level = min(
+            self._capacity, self._level + (now - self._updated) * self._rate
+        )
+        self._updated = now
+
+    def wait_seconds(self, amount: float, now: float) -> float:
+        self._refill(now)
+        # Larger amounts than the burst go through once the bucket is full
+        needed = min(amount, self._capacity)
+        return max(0.0, (needed - self._level) / self._rate)
+
+    def take(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self._level -= amount
+
+
+class LLMRateLimiter:
+    """Bounds the LLM calls of the whole process: at most max_concurrency in
+    flight, and requests and tokens per minute within the account's limits
+    (0 disables a limit).
+
+    Calls past a limit wait for their turn, in arrival order, instead of failing
+    or being rejected by the API with a 429. Tokens are approximate: the prompt
+    is counted up front and the output once known.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+    ) -> None:
+        self._slots = asyncio.Semaphore(max_concurrency)
+        # Held while waiting on the rate limits, so that calls go in order
+        self._turn = asyncio.Lock()
+        self._requests_bucket: Optional[_TokenBucket] = (
+            _TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        )
+        self._tokens_bucket: Optional[_TokenBucket] = (
+            _TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        )
+
+        self._requests = 0
+        self._queued = 0
+        self._wait_seconds_total = 0.0
+        self._wait_seconds_max = 0.0
+        self._waiting = 0
+        self._in_flight = 0
+        self._prompt_tokens = 0
+        self._output_tokens = 0
+
+    @asynccontextmanager
+    async def acquire(self, tokens: int) -> AsyncIterator[None]:
+        """Waits until a call with a prompt of the given tokens can be made, and
+        holds its concurrency slot within the block."""
+        started = time.monotonic()
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+            try:
+                await self._wait_for_rate_limits(tokens)
+            except BaseException:
+                self._slots.release()
+                raise
+        finally:
+            self._waiting -= 1
+
+        self._record_wait(time.monotonic() - started)
+        self._prompt_tokens += tokens
+        self._in_flight += 1
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            self._slots.release()
+
+    def record_tokens(self, tokens: int) -> None:
+        """Counts tokens only known after the call, e.g. its output."""
+        self._output_tokens += tokens
+        if self._tokens_bucket is not None:
+            self._tokens_bucket.take(tokens, time.monotonic())
+
+    def stats(self) -> LLMRateLimiterStats:
+        return LLMRateLimiterStats(
+            requests=self._requests,
+            queued=self._queued,
+            wait_seconds_total=self._wait_seconds_total,
+            wait_seconds_max=self._wait_seconds_max,
+            waiting=self._waiting,
+            in_flight=self._in_flight,
+            prompt_tokens=self._prompt_tokens,
+            output_tokens=self._output_tokens,
+        )
+
+    async def _wait_for_rate_limits(self, tokens: int) -> None:
+        limits = [
+            (bucket, amount)
+            for bucket, amount in (
+                (self._requests_bucket, 1),
+                (self._tokens_bucket, tokens),
+            )
+            if bucket is not None
+        ]
+        if not limits:
+            return
+
+        async with self._turn:
+            while True:
+                now = time.monotonic()
+                wait_seconds = max(
+                    bucket.wait_seconds(amount, now) for bucket, amount in limits
+                )
+                if wait_seconds <= 0:
+                    break
+                await asyncio.sleep(wait_seconds)
+
+            for bucket, amount in limits:
+                bucket.take(amount, now)
+
+    def _record_wait(self, wait_seconds: float) -> None:
+        self._requests += 1
+        # Below a millisecond the call did not really queue
+        if wait_seconds >= 0.001:
+            self._queued += 1
+        self._wait_seconds_total += wait_seconds
+        self._wait_seconds_max = max(self._wait_seconds_max, wait_seconds)
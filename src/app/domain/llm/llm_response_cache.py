@@ -0,0 +1,90 @@
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from enum import StrEnum, auto
+from typing import Iterator, Optional, override
+
+from app.core.metrics import LLM_CACHE_REQUESTS
+
+
+class LLMCacheStatus(StrEnum):
+    HIT = auto()
+    MISS = auto()
+
+
+class LLMResponseCache(ABC):
+    """Stores serialized LLM responses by cache key, with a TTL and a bound on
+    the number of entries."""
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[str]: ...
+
+    @abstractmethod
+    async def set(self, key: str, value: str) -> None: ...
+
+
+@dataclass
+class _Entry:
+    value: str
+    expires_at: float
+
+
+class InMemoryLLMResponseCache(LLMResponseCache):
+    """Per-process LRU cache, lost on restart and not shared between processes."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float) -> None:
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+
+    @override
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        if entry.expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return entry.value
+
+    @override
+    async def set(self, key: str, value: str) -> None:
+        if self._max_entries <= 0:
+            return
+
+        self._entries[key] = _Entry(
+            value=value, expires_at=time.monotonic() + self._ttl_seconds
+        )
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+
+_llm_cache_statuses: ContextVar[Optional[list[LLMCacheStatus]]] = ContextVar(
+    "llm_cache_statuses", default=None
+)
+
+
+@contextmanager
+def record_llm_cache_statuses() -> Iterator[list[LLMCacheStatus]]:
+    """Collects the cache status of every cached LLM call made within the block,
+    in call order, e.g. to report them in a response header."""
+    statuses: list[LLMCacheStatus] = []
+    token = _llm_cache_statuses.set(statuses)
+    try:
+        yield statuses
+    finally:
+        _llm_cache_statuses.reset(token)
+
+
+def report_llm_cache_status(status: LLMCacheStatus) -> None:
+    LLM_CACHE_REQUESTS.inc(result=status.value)
+    statuses = _llm_cache_statuses.get()
+    if statuses is not None:
+        statuses.append(status)
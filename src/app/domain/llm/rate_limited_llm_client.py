@@ -0,0 +1,58 @@
+from typing import AsyncIterator, TypeVar, override
+
+import pydantic_core
+
+from app.domain.llm.llm_client import LLMClient
+from app.domain.llm.llm_rate_limiter import LLMRateLimiter
+from app.domain.llm.token_counter import count_tokens
+
+T = TypeVar("T")
+
+
+class RateLimitedLLMClient(LLMClient):
+    """Makes every call through the process-wide rate limiter."""
+
+    def __init__(self, llm_client: LLMClient, limiter: LLMRateLimiter) -> None:
+        self._llm_client = llm_client
+        self._limiter = limiter
+
+    @property
+    @override
+    def model(self) -> str:
+        return self._llm_client.model
+
+    @override
+    async def run_structured(
+        self,
+        *,
+        prompt: str,
+        response_model: type[T],
+    ) -> T:
+        async with self._limiter.acquire(count_tokens(prompt)):
+            response = await self._llm_client.run_structured(
+                prompt=prompt, response_model=response_model
+            )
+
+        self._limiter.record_tokens(
+            count_tokens(pydantic_core.to_json(response).decode())
+        )
+        return response
+
+    @override
+    async def run(self, *, prompt: str) -> str:
+        async with self._limiter.acquire(count_tokens(prompt)):
+            response = await self._llm_client.run(prompt=prompt)
+
+        self._limiter.record_tokens(count_tokens(response))
+        return response
+
+    @override
+    async def stream(self, *, prompt: str) -> AsyncIterator[str]:
+        # The slot is held until the whole answer has been streamed
+        output_tokens = 0
+        async with self._limiter.acquire(count_tokens(prompt)):
+            async for chunk in self._llm_client.stream(prompt=prompt):
+                output_tokens += count_tokens(chunk)
+                yield chunk
+
+        self._limiter.record_tokens(output_tokens)
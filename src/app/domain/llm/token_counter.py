@@ -0,0 +1,38 @@
+import math
+import re
+
+# Pieces a BPE tokenizer never merges across: letter runs, runs of up to three
+# digits, and single symbols. Whitespace is merged into the next piece.
+TOKEN_PIECE_PATTERN = re.compile(r"[^\W\d_]+|\d{1,3}|[^\w\s]|_")
+
+# Rough average length of a token within a word
+CHARACTERS_PER_TOKEN = 4
+
+
+def _piece_tokens(piece: str) -> int:
+    if piece[0].isalpha():
+        return math.ceil(len(piece) / CHARACTERS_PER_TOKEN)
+    return 1
+
+
+def count_tokens(text: str) -> int:
+    """Approximate token count of the text, computed locally.
+
+    An estimate rather than an exact BPE count, which would need the model's
+    vocabulary files at runtime. It is deterministic and grows with the text
+    the way real counts do, which is what budgeting prompts and comparing their
+    sizes need.
+    """
+    return sum(_piece_tokens(piece) for piece in TOKEN_PIECE_PATTERN.findall(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, marker: str = "…") -> str:
+    """The longest prefix of the text within max_tokens, ending in the marker
+    when something was cut."""
+    tokens = 0
+    for match in TOKEN_PIECE_PATTERN.finditer(text):
+        tokens += _piece_tokens(match.group())
+        if tokens > max_tokens:
+            return text[: match.start()].rstrip() + marker
+
+    return text
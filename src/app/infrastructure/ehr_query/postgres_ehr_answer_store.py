@@ -0,0 +1,79 @@
+from typing import Optional, cast, override
+
+import asyncpg
+
+from app.domain.ehr_query.ehr_answer_cache import EHRAnswerKey, EHRAnswerStore
+
+
+class PostgresEHRAnswerStore(EHRAnswerStore):
+    """Answers in the ehr_query_answer_cache table, shared by every process of
+    the app and kept across restarts.
+
+    Entries expire ttl_seconds after being written. Writing an answer deletes
+    those of older context versions of the patient, which can no longer be
+    served. Past max_entries the oldest writes are evicted, as in
+    PostgresLLMResponseCache.
+    """
+
+    def __init__(self, pool: asyncpg.Pool, max_entries: int, ttl_seconds: float):
+        self._pool = pool
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+
+    @override
+    async def get(self, key: EHRAnswerKey) -> Optional[bytes]:
+        value = await self._pool.fetchval(
+            """
+            SELECT value
+                FROM ehr_query_answer_cache
+            WHERE
+                patient_id = $1
+                AND context_version = $2
+                AND question_hash = $3
+                AND created_at > now() - make_interval(secs => $4)
+            """,
+            *key,
+            self._ttl_seconds,
+        )
+        return cast(Optional[bytes], value)
+
+    @override
+    async def set(self, key: EHRAnswerKey, value: bytes) -> None:
+        if self._max_entries <= 0:
+            return
+
+        async with self._pool.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO ehr_query_answer_cache (
+                    patient_id,
+                    context_version,
+                    question_hash,
+                    value,
+                    created_at
+                )
+                VALUES ($1, $2, $3, $4, now())
+                ON CONFLICT (patient_id, context_version, question_hash) DO UPDATE
+                    SET value = EXCLUDED.value, created_at = EXCLUDED.created_at
+                """,
+                *key,
+                value,
+            )
+            await conn.execute(
+                """
+                DELETE FROM ehr_query_answer_cache
+                WHERE
+                    (patient_id = $1 AND context_version < $2)
+                    OR created_at <= now() - make_interval(secs => $3)
+                    OR (patient_id, context_version, question_hash) IN (
+                        SELECT patient_id, context_version, question_hash
+                            FROM ehr_query_answer_cache
+                        ORDER BY created_at DESC
+                        OFFSET $4
+                    )
+                """,
+                key.patient_id,
+                key.context_version,
+                self._ttl_seconds,
+                self._max_entries,
+            )
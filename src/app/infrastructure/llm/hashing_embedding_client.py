@@ -0,0 +1,65 @@
+import asyncio
+import hashlib
+from typing import Sequence, override
+
+import numpy as np
+
+from app.domain.ehr_query.ehr_lexical_ranker import fold_text, tokenize
+from app.domain.llm.embedding_client import EmbeddingClient, EmbeddingMatrix
+
+_INLINE_MAX_TEXTS = 8
+
+
+class HashingEmbeddingClient(EmbeddingClient):
+    """Deterministic local embedder that runs offline on CPU.
+
+    Words (stemmed with the lexical ranker's Spanish tokenizer) and character
+    trigrams of the folded text are hashed into a fixed number of signed
+    buckets, the feature hashing trick. It captures lexical and sub-word
+    overlap only, not semantics, but needs no model download and the same text
+    always gets the same vector.
+
+    It is pure Python, batches are embedded in a worker thread so that long
+    ingestions do not block the event loop.
+    """
+
+    def __init__(self, dimensions: int = 256) -> None:
+        self._dimensions = dimensions
+
+    @property
+    @override
+    def dimensions(self) -> int:
+        return self._dimensions
+
+    @override
+    async def embed(self, texts: Sequence[str]) -> EmbeddingMatrix:
+        # A question or two take less than the hop to a thread
+        if len(texts) <= _INLINE_MAX_TEXTS:
+            return self._embed(texts)
+        return await asyncio.to_thread(self._embed, texts)
+
+    def _embed(self, texts: Sequence[str]) -> EmbeddingMatrix:
+        matrix = np.zeros((len(texts), self._dimensions), dtype=np.float32)
+
+        for row, text in enumerate(texts):
+            for feature, weight in self._features(text):
+                digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self._dimensions
+                sign = 1.0 if digest[4] & 1 else -1.0
+                matrix[row, bucket] += sign * weight
+
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+    @staticmethod
+    def _features(text: str) -> list[tuple[str, float]]:
+        features = [(f"w:{token}", 1.0) for token in tokenize(text)]
+
+        for word in fold_text(text).split():
+            padded = f" {word} "
+            features.extend(
+                (f"c:{padded[i:i + 3]}", 0.5) for i in range(len(padded) - 2)
+            )
+
+        return features
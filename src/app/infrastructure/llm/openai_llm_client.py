@@ -1,5 +1,7 @@
-from typing import TypeVar, override
-from openai import AsyncOpenAI
+from typing import AsyncIterator, Optional, TypeVar, override
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 
 from app.domain.llm.llm_client import LLMClient
 
@@ -7,10 +9,38 @@ T = TypeVar("T")
 
 
 class OpenAILLMClient(LLMClient):
-    def __init__(self, api_key: str, model: str = "gpt-4.1-mini"):
-        self._client = AsyncOpenAI(api_key=api_key)
+    """Meant to be shared by the whole process: its HTTP connection pool keeps
+    connections alive between calls, saving a TLS handshake on each."""
+
+    def __init__(
+        self,
+        api_key: str,
+        model: str = "gpt-4.1-mini",
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        base_url: Optional[str] = None,
+    ):
+        self._client = AsyncOpenAI(
+            api_key=api_key,
+            # None targets the real API, e.g. a local stand-in for load tests
+            base_url=base_url,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_keepalive_connections,
+                )
+            ),
+        )
         self._model = model
 
+    async def close(self) -> None:
+        await self._client.close()
+
+    @property
+    @override
+    def model(self) -> str:
+        return self._model
+
     @override
     async def run_structured(
         self,
@@ -38,3 +68,30 @@ class OpenAILLMClient(LLMClient):
         )
 
         return response.output_text or ""
+
+    @override
+    async def stream(self, *, prompt: str) -> AsyncIterator[str]:
+        events = await self._client.responses.create(
+            model=self._model,
+            input=prompt,
+            stream=True,
+        )
+
+        # Failures after the response started come as events, not as errors of
+        # the request: raised so that the answer does not silently end there
+        async for event in events:
+            if event.type == "response.output_text.delta":
+                yield event.delta
+            elif event.type == "error":
+                raise RuntimeError(f"LLM stream failed: {event.message}")
+            elif event.type == "response.failed":
+                error = event.response.error
+                raise RuntimeError(
+                    f"LLM response failed: {error.message if error else 'no details'}"
+                )
+            elif event.type == "response.incomplete":
+                details = event.response.incomplete_details
+                raise RuntimeError(
+                    "LLM response incomplete: "
+                    f"{details.reason if details else 'no details'}"
+                )
@@ -0,0 +1,90 @@
+import time
+from typing import Optional, cast, override
+
+import asyncpg
+
+from app.domain.llm.llm_response_cache import LLMResponseCache
+
+
+class PostgresLLMResponseCache(LLMResponseCache):
+    """Response cache in the llm_response_cache table, shared by every process
+    of the app and kept across restarts.
+
+    Entries expire ttl_seconds after being written. Past max_entries the oldest
+    writes are evicted (FIFO rather than LRU, so that hits stay read-only).
+    Writes prune the table at most every prune_interval_seconds, so it can
+    briefly hold more entries: by a created_at cutoff, found on the created_at
+    index rather than by sorting the table.
+    """
+
+    def __init__(
+        self,
+        pool: asyncpg.Pool,
+        max_entries: int,
+        ttl_seconds: float,
+        prune_interval_seconds: float = 60,
+    ):
+        self._pool = pool
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._prune_interval_seconds = prune_interval_seconds
+        self._next_prune_at = 0.0
+
+    @override
+    async def get(self, key: str) -> Optional[str]:
+        value = await self._pool.fetchval(
+            """
+            SELECT value
+                FROM llm_response_cache
+            WHERE
+                key = $1
+                AND created_at > now() - make_interval(secs => $2)
+            """,
+            key,
+            self._ttl_seconds,
+        )
+        return cast(Optional[str], value)
+
+    @override
+    async def set(self, key: str, value: str) -> None:
+        if self._max_entries <= 0:
+            return
+
+        await self._pool.execute(
+            """
+            INSERT INTO llm_response_cache (key, value, created_at)
+            VALUES ($1, $2, now())
+            ON CONFLICT (key) DO UPDATE
+                SET value = EXCLUDED.value, created_at = EXCLUDED.created_at
+            """,
+            key,
+            value,
+        )
+
+        if time.monotonic() >= self._next_prune_at:
+            self._next_prune_at = time.monotonic() + self._prune_interval_seconds
+            await self.prune()
+
+    async def prune(self) -> None:
+        """Deletes the expired entries and those past the newest max_entries."""
+
+        # The cutoff is the creation of the newest entry past max_entries, if
+        # any, GREATEST ignores NULL
+        await self._pool.execute(
+            """
+            DELETE FROM llm_response_cache
+            WHERE
+                created_at <= GREATEST(
+                    now() - make_interval(secs => $1),
+                    (
+                        SELECT created_at
+                            FROM llm_response_cache
+                        ORDER BY created_at DESC
+                        OFFSET $2
+                        LIMIT 1
+                    )
+                )
+            """,
+            self._ttl_seconds,
+            self._max_entries,
+        )
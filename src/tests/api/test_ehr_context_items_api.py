@@ -0,0 +1,305 @@
+import asyncio
+import json
+from http import HTTPStatus
+from typing import Any
+
+import asyncpg
+import pytest
+from fastapi import FastAPI
+from httpx import AsyncClient
+
+from app.api.dependencies import get_llm_client
+from app.core.app_settings import get_app_settings
+from tests.api.test_ehr_ingestion_tasks_api import EHR_PAYLOAD_1, ingest_ehr_and_wait
+from tests.api.test_ehr_query_api import select_no_contexts
+from tests.fakes import FakeLLMClient
+from tests.synthetic_ehr import generate_ehr_payload
+
+
+@pytest.mark.asyncio
+async def test_context_items_are_cached_until_the_patient_is_reingested(
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+
+    app.dependency_overrides[get_llm_client] = lambda: FakeLLMClient(
+        structured_response=select_no_contexts
+    )
+    try:
+        # The whole patient is read by queries the types router does not narrow
+        await query_whole_patient(client, patient_id)
+        await query_whole_patient(client, patient_id)
+
+        assert await get_cache_stats(client) == {
+            "size": 1,
+            "hits": 1,
+            "misses": 1,
+            "evictions": 0,
+            "invalidations": 1,
+        }
+
+        updated_payload = {
+            **EHR_PAYLOAD_1,
+            "recent_visits": EHR_PAYLOAD_1["recent_visits"][:1],
+        }
+        await ingest_ehr_and_wait(client, updated_payload)
+
+        await query_whole_patient(client, patient_id)
+    finally:
+        app.dependency_overrides.clear()
+
+    stats = await get_cache_stats(client)
+    assert (stats["misses"], stats["invalidations"]) == (2, 2)
+
+
+@pytest.mark.asyncio
+async def test_context_items_cache_is_invalidated_by_other_processes(
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+
+    app.dependency_overrides[get_llm_client] = lambda: FakeLLMClient(
+        structured_response=select_no_contexts
+    )
+    try:
+        await query_whole_patient(client, patient_id)
+    finally:
+        app.dependency_overrides.clear()
+
+    stats = await get_cache_stats(client)
+    assert stats["size"] == 1
+    invalidations = stats["invalidations"]
+
+    conn = await asyncpg.connect(get_app_settings().database_url)
+    try:
+        await conn.execute(
+            "SELECT pg_notify('ehr_patient_context_changed', $1)",
+            f"another-process:{patient_id}",
+        )
+    finally:
+        await conn.close()
+
+    async with asyncio.timeout(5):
+        while (await get_cache_stats(client))["invalidations"] == invalidations:
+            await asyncio.sleep(0.05)
+
+    assert (await get_cache_stats(client))["size"] == 0
+
+
+@pytest.mark.asyncio
+async def test_context_items_cache_listener_reconnects(
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+
+    async def cache_patient() -> None:
+        app.dependency_overrides[get_llm_client] = lambda: FakeLLMClient(
+            structured_response=select_no_contexts
+        )
+        try:
+            await query_whole_patient(client, patient_id)
+        finally:
+            app.dependency_overrides.clear()
+        assert (await get_cache_stats(client))["size"] == 1
+
+    async def wait_until_uncached() -> None:
+        async with asyncio.timeout(5):
+            while (await get_cache_stats(client))["size"] != 0:
+                await asyncio.sleep(0.05)
+
+    await cache_patient()
+
+    conn = await asyncpg.connect(get_app_settings().database_url)
+    try:
+        terminated = await conn.fetchval("""
+            SELECT count(pg_terminate_backend(pid))
+                FROM pg_stat_activity
+            WHERE
+                datname = current_database()
+                AND query LIKE 'LISTEN %'
+            """)
+        assert terminated == 1
+
+        # Notifications may have been missed while disconnected
+        await wait_until_uncached()
+
+        # and once reconnected they are received again
+        await cache_patient()
+        await conn.execute(
+            "SELECT pg_notify('ehr_patient_context_changed', $1)",
+            f"another-process:{patient_id}",
+        )
+        await wait_until_uncached()
+    finally:
+        await conn.close()
+
+
+@pytest.mark.asyncio
+async def test_ingestions_maintain_the_patient_snapshot(
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+    pool: asyncpg.Pool = app.state.pool
+
+    async def get_snapshot() -> Any:
+        return await pool.fetchrow(
+            "SELECT version, item_count FROM ehr_patient_context_snapshot "
+            "WHERE patient_id = $1",
+            patient_id,
+        )
+
+    async def list_items() -> list[dict[str, Any]]:
+        response = await client.get(
+            "/api/ehr-context-items", params={"patient_id": patient_id}
+        )
+        assert response.status_code == HTTPStatus.OK
+        return sorted(response.json()["items"], key=lambda item: item["id"])
+
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    snapshot = await get_snapshot()
+    assert snapshot["version"] == 1
+    items = await list_items()
+    assert snapshot["item_count"] == len(items)
+
+    # Nothing changed, nothing is written
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    assert await get_snapshot() == snapshot
+
+    updated_payload = {
+        **EHR_PAYLOAD_1,
+        "recent_visits": EHR_PAYLOAD_1["recent_visits"][:1],
+    }
+    await ingest_ehr_and_wait(client, updated_payload)
+    assert tuple(await get_snapshot()) == (2, len(items) - 1)
+
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    assert tuple(await get_snapshot()) == (3, len(items))
+    from_snapshot = await list_items()
+
+    # As for patients ingested before snapshots: read from their rows, and
+    # given a snapshot by their next ingestion even if nothing changed
+    await pool.execute(
+        "DELETE FROM ehr_patient_context_snapshot WHERE patient_id = $1",
+        patient_id,
+    )
+    app.state.ehr_contexts_cache.invalidate(patient_id)
+    assert await list_items() == from_snapshot
+
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    assert tuple(await get_snapshot()) == (1, len(items))
+
+
+@pytest.mark.asyncio
+async def test_context_items_are_listed_in_keyset_pages(
+    client: AsyncClient,
+) -> None:
+    payload = generate_ehr_payload("PAGED", seed=1, visits=8, lab_results=40)
+    patient_id = payload["patient_id"]
+    await ingest_ehr_and_wait(client, payload)
+
+    everything = await client.get(
+        "/api/ehr-context-items", params={"patient_id": patient_id}
+    )
+    total = everything.json()["total"]
+
+    pages = []
+    params: dict[str, Any] = {"patient_id": patient_id, "limit": 7}
+    while True:
+        response = await client.get("/api/ehr-context-items", params=params)
+        assert response.status_code == HTTPStatus.OK
+        page = response.json()
+        assert page["total"] == total
+        pages.append(page["items"])
+        if page["next_cursor"] is None:
+            break
+        params["cursor"] = page["next_cursor"]
+
+    assert len(pages) == -(-total // 7)
+    items = [item for page in pages for item in page]
+    keys = [(item["source"]["recorded_at"] or "", item["id"]) for item in items]
+    assert keys == sorted(keys)
+    # Pages are serialized from the rows, the whole listing from the snapshot
+    assert sorted(items, key=lambda item: item["id"]) == sorted(
+        everything.json()["items"], key=lambda item: item["id"]
+    )
+
+    response = await client.get(
+        "/api/ehr-context-items",
+        params={
+            "patient_id": patient_id,
+            "type": ["lab_result", "visit"],
+            "recorded_from": "2020-01-01",
+            "fields": ["id", "type", "source"],
+        },
+    )
+    assert response.status_code == HTTPStatus.OK
+    page = response.json()
+    expected = [
+        item
+        for item in items
+        if item["type"] in ("lab_result", "visit")
+        and (item["source"]["recorded_at"] or "") >= "2020-01-01"
+    ]
+    assert page["total"] == len(expected)
+    assert page["items"] == [
+        {key: item[key] for key in ("id", "type", "source")} for item in expected[:100]
+    ]
+
+    response = await client.get(
+        "/api/ehr-context-items",
+        params={"patient_id": patient_id, "cursor": "not a cursor"},
+    )
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+async def query_whole_patient(client: AsyncClient, patient_id: str) -> None:
+    response = await client.post(
+        f"/api/ehr-query/{patient_id}/query",
+        json={"query": "¿Ha tenido dolor torácico?"},
+    )
+    assert response.status_code == HTTPStatus.OK
+
+
+async def get_cache_stats(client: AsyncClient) -> dict[str, Any]:
+    response = await client.get("/api/ehr-context-items/cache/stats")
+    assert response.status_code == HTTPStatus.OK
+
+    stats: dict[str, Any] = response.json()
+    return stats
+
+
+@pytest.mark.asyncio
+async def test_context_items_are_only_embedded_for_the_vector_prefilter(
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    response = await client.post(
+        "/api/ehr-ingestion-tasks/bulk",
+        content=json.dumps({**EHR_PAYLOAD_1, "patient_id": "P002"}).encode(),
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == HTTPStatus.OK
+
+    pool: asyncpg.Pool = app.state.pool
+    assert await pool.fetchval("SELECT count(*) FROM ehr_patient_context") == 18
+    assert (
+        await pool.fetchval(
+            "SELECT count(*) FROM ehr_patient_context WHERE embedding IS NOT NULL"
+        )
+        == 0
+    )
+    assert (
+        await pool.fetchval(
+            "SELECT count(*) FROM ehr_patient_context_snapshot "
+            "WHERE embeddings IS NOT NULL"
+        )
+        == 0
+    )
@@ -1,9 +1,15 @@
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
 from http import HTTPStatus
 from typing import Any
+from uuid import uuid4
 
 import pytest
+from fastapi import FastAPI
 from httpx import AsyncClient
 
+from app.core.app_settings import get_app_settings
 
 EHR_PAYLOAD_1: dict[str, Any] = {
     "patient_id": "P001",
@@ -200,11 +206,10 @@ async def test_ehr_contexts_created_as_expected(
     client: AsyncClient,
 ) -> None:
     # 1. Ingest EHR
-    ingest_response = await client.post(
-        "/api/ehr-ingestion-tasks",
-        json=EHR_PAYLOAD_1,
-    )
-    assert ingest_response.status_code == HTTPStatus.CREATED
+    task = await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    assert task["status"] == "succeeded"
+    assert task["started_at"] is not None
+    assert task["finished_at"] is not None
 
     patient_id = EHR_PAYLOAD_1["patient_id"]
 
@@ -259,6 +264,45 @@ async def test_ehr_contexts_created_as_expected(
         assert_item_present(items, expected_lab_result)
 
 
+async def ingest_ehr_and_wait(
+    client: AsyncClient,
+    payload: dict[str, Any],
+    timeout_seconds: float = 10,
+) -> dict[str, Any]:
+    response = await client.post("/api/ehr-ingestion-tasks", json=payload)
+    assert response.status_code == HTTPStatus.ACCEPTED
+
+    return await wait_for_task(client, response.json()["id"], timeout_seconds)
+
+
+async def wait_for_task(
+    client: AsyncClient,
+    task_id: str,
+    timeout_seconds: float = 10,
+) -> dict[str, Any]:
+    async with asyncio.timeout(timeout_seconds):
+        while True:
+            response = await client.get(f"/api/ehr-ingestion-tasks/{task_id}")
+            assert response.status_code == HTTPStatus.OK
+
+            task: dict[str, Any] = response.json()
+            if task["status"] in ("succeeded", "failed"):
+                return task
+
+            await asyncio.sleep(0.05)
+
+
+async def list_items_by_content(
+    client: AsyncClient, patient_id: str
+) -> dict[str, dict[str, Any]]:
+    response = await client.get(
+        "/api/ehr-context-items", params={"patient_id": patient_id}
+    )
+    assert response.status_code == HTTPStatus.OK
+
+    return {item["content"]: item for item in response.json()["items"]}
+
+
 def count_by_type(items: list[dict[str, Any]]) -> dict[str, int]:
     counts: dict[str, int] = {}
     for item in items:
@@ -281,3 +325,299 @@ def assert_item_present(
         if item == expected:
             return
     raise AssertionError(f"Expected item not found:\n{expected}")
+
+
+@pytest.mark.asyncio
+async def test_ehr_reingestion_only_writes_changed_contexts(
+    client: AsyncClient,
+) -> None:
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    before = await list_items_by_content(client, EHR_PAYLOAD_1["patient_id"])
+
+    updated_lab_result = {
+        **EHR_PAYLOAD_1["lab_results"][0],
+        "results": {**EHR_PAYLOAD_1["lab_results"][0]["results"], "hba1c": "6.9%"},
+    }
+    updated_payload = {
+        **EHR_PAYLOAD_1,
+        "medical_history": {
+            **EHR_PAYLOAD_1["medical_history"],
+            "allergies": ["Penicilina", "Sulfas"],
+        },
+        "recent_visits": EHR_PAYLOAD_1["recent_visits"][:1],
+        "lab_results": [updated_lab_result],
+    }
+
+    task = await ingest_ehr_and_wait(client, updated_payload)
+    assert task["status"] == "succeeded"
+
+    after = await list_items_by_content(client, EHR_PAYLOAD_1["patient_id"])
+
+    # Unchanged items keep their ids and creation time
+    unchanged = set(before) & set(after)
+    assert len(unchanged) == 7
+    for content in unchanged:
+        assert after[content] == before[content]
+
+    # The changed lab result is updated in place
+    old_lab_content = EXPECTED_LAB_RESULTS[0]["content"]
+    new_lab_content = old_lab_content.replace("7.2%", "6.9%")
+    assert old_lab_content not in after
+    assert after[new_lab_content]["id"] == before[old_lab_content]["id"]
+    assert after[new_lab_content]["data"]["results"]["hba1c"] == "6.9%"
+
+    # The removed visit is deleted and the new allergy inserted
+    assert EXPECTED_VISITS[1]["content"] not in after
+    assert after["Alergia a Sulfas"]["id"] not in {
+        item["id"] for item in before.values()
+    }
+    assert len(after) == 9
+
+
+async def insert_task(
+    app: FastAPI,
+    payload: str,
+    status: str = "pending",
+    attempts: int = 0,
+    claimed_at: datetime | None = None,
+) -> str:
+    """Queues a task as a worker would have left it, and wakes the workers."""
+    task_id = uuid4()
+    await app.state.pool.execute(
+        """
+        INSERT INTO ehr_ingestion_task (
+            id, patient_id, status, payload, attempts, created_at, claimed_at
+        )
+        VALUES ($1, $2, $3, $4, $5, now(), $6)
+        """,
+        task_id,
+        EHR_PAYLOAD_1["patient_id"],
+        status,
+        payload,
+        attempts,
+        claimed_at,
+    )
+    app.state.ehr_ingestion_workers.notify()
+    return str(task_id)
+
+
+@pytest.mark.asyncio
+async def test_ehr_ingestion_tasks_with_an_expired_lease_are_claimed_again(
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    expired = datetime.now(timezone.utc) - timedelta(hours=1)
+    settings = get_app_settings()
+
+    # Left running by a worker that crashed, with attempts left or not
+    abandoned_task_id = await insert_task(
+        app,
+        json.dumps(EHR_PAYLOAD_1),
+        status="running",
+        attempts=settings.ingestion_task_max_attempts,
+        claimed_at=expired,
+    )
+    retried_task_id = await insert_task(
+        app,
+        json.dumps(EHR_PAYLOAD_1),
+        status="running",
+        attempts=1,
+        claimed_at=expired,
+    )
+    # Still within its lease
+    running_task_id = await insert_task(
+        app,
+        json.dumps(EHR_PAYLOAD_1),
+        status="running",
+        attempts=1,
+        claimed_at=datetime.now(timezone.utc),
+    )
+
+    task = await wait_for_task(client, retried_task_id)
+    assert task["status"] == "succeeded"
+    assert task["attempts"] == 2
+
+    task = await wait_for_task(client, abandoned_task_id)
+    assert task["status"] == "failed"
+    assert task["error"] == (
+        f"Abandoned after {settings.ingestion_task_max_attempts} attempts"
+    )
+
+    response = await client.get(f"/api/ehr-ingestion-tasks/{running_task_id}")
+    assert response.json()["status"] == "running"
+
+
+@pytest.mark.asyncio
+async def test_ehr_ingestion_tasks_with_invalid_payloads_fail(
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    task_id = await insert_task(app, json.dumps({"patient_id": "P001"}))
+
+    task = await wait_for_task(client, task_id)
+    assert task["status"] == "failed"
+    assert task["error"].startswith("ValidationError: ")
+
+    # The worker is still running tasks
+    task = await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    assert task["status"] == "succeeded"
+
+
+@pytest.mark.asyncio
+async def test_ehr_ingestion_task_not_found(
+    client: AsyncClient,
+) -> None:
+    response = await client.get(f"/api/ehr-ingestion-tasks/{uuid4()}")
+
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.asyncio
+async def test_ehr_ingestion_task_stats(
+    client: AsyncClient,
+) -> None:
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+
+    response = await client.get("/api/ehr-ingestion-tasks/stats")
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.json() == {
+        "pending": 0,
+        "running": 0,
+        "succeeded": 1,
+        "failed": 0,
+        "oldest_pending_created_at": None,
+    }
+
+
+@pytest.mark.asyncio
+async def test_bulk_ingestion_reports_per_record_results(
+    client: AsyncClient,
+) -> None:
+    invalid_payload = {**EHR_PAYLOAD_1, "patient_id": "P002", "demographics": {}}
+    updated_payload = {
+        **EHR_PAYLOAD_1,
+        "recent_visits": EHR_PAYLOAD_1["recent_visits"][:1],
+    }
+    lines = [
+        json.dumps(EHR_PAYLOAD_1),
+        "",
+        json.dumps(invalid_payload),
+        "{not json",
+        json.dumps(updated_payload),
+    ]
+
+    response = await client.post(
+        "/api/ehr-ingestion-tasks/bulk",
+        content="\n".join(lines).encode(),
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+
+    assert response.status_code == HTTPStatus.OK
+
+    result = response.json()
+    assert result["received"] == 4
+    assert result["ingested"] == 2
+    assert result["failed"] == 2
+    assert [(e["line"], e["patient_id"]) for e in result["errors"]] == [
+        (3, "P002"),
+        (4, None),
+    ]
+
+    # The second record for the same patient replaces the first one
+    assert result["context_items"] == 8
+
+    response = await client.get(
+        "/api/ehr-context-items",
+        params={"patient_id": EHR_PAYLOAD_1["patient_id"]},
+    )
+    items = [normalize_item(item) for item in response.json()["items"]]
+
+    assert len(items) == 8
+    assert count_by_type(items)["visit"] == 1
+    assert_item_present(items, EXPECTED_VISITS[0])
+
+    response = await client.get(
+        "/api/ehr-context-items",
+        params={"patient_id": "P002"},
+    )
+    assert response.json()["total"] == 0
+
+
+@pytest.mark.asyncio
+async def test_bulk_reingestion_only_writes_changed_contexts(
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+
+    async def ingest_bulk(payload: dict[str, Any]) -> None:
+        response = await client.post(
+            "/api/ehr-ingestion-tasks/bulk",
+            content=json.dumps(payload).encode(),
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        assert response.status_code == HTTPStatus.OK
+        assert response.json()["ingested"] == 1
+
+    async def get_snapshot_version() -> int:
+        version: int = await app.state.pool.fetchval(
+            "SELECT version FROM ehr_patient_context_snapshot WHERE patient_id = $1",
+            patient_id,
+        )
+        return version
+
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    before = await list_items_by_content(client, patient_id)
+    version = await get_snapshot_version()
+
+    # An unchanged record writes nothing, so answers cached for the version
+    # are still served
+    await ingest_bulk(EHR_PAYLOAD_1)
+    assert await list_items_by_content(client, patient_id) == before
+    assert await get_snapshot_version() == version
+
+    await ingest_bulk(
+        {**EHR_PAYLOAD_1, "recent_visits": EHR_PAYLOAD_1["recent_visits"][:1]}
+    )
+    after = await list_items_by_content(client, patient_id)
+
+    # Unchanged items keep their ids and creation time
+    assert len(after) == 8
+    for content, item in after.items():
+        assert item == before[content]
+    assert EXPECTED_VISITS[1]["content"] not in after
+    assert await get_snapshot_version() == version + 1
+
+
+@pytest.mark.asyncio
+async def test_bulk_and_task_ingestions_of_a_patient_do_not_conflict(
+    client: AsyncClient,
+) -> None:
+    updated_payload = {
+        **EHR_PAYLOAD_1,
+        "recent_visits": EHR_PAYLOAD_1["recent_visits"][:1],
+    }
+
+    async def ingest_bulk() -> dict[str, Any]:
+        response = await client.post(
+            "/api/ehr-ingestion-tasks/bulk",
+            content=json.dumps(EHR_PAYLOAD_1).encode(),
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        assert response.status_code == HTTPStatus.OK
+        result: dict[str, Any] = response.json()
+        return result
+
+    for _ in range(5):
+        result, task = await asyncio.gather(
+            ingest_bulk(), ingest_ehr_and_wait(client, updated_payload)
+        )
+
+        assert result["ingested"] == 1
+        assert result["errors"] == []
+        assert task["status"] == "succeeded"
+
+        # Whichever wrote last, the patient has the items of one of the records
+        items = await list_items_by_content(client, EHR_PAYLOAD_1["patient_id"])
+        assert len(items) in (8, 9)
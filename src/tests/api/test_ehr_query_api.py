@@ -0,0 +1,938 @@
+import asyncio
+import json
+import re
+from contextlib import asynccontextmanager
+from http import HTTPStatus
+from typing import Any, AsyncIterator, Type
+
+import asyncpg
+import pytest
+from fastapi import Depends, FastAPI
+from httpx import AsyncClient, Response
+
+from app.api.dependencies import (
+    get_db_pool,
+    get_ehr_contexts_repository_factory,
+    get_llm_client,
+    get_llm_rate_limiter,
+    get_llm_response_cache,
+    get_openai_llm_client,
+)
+from app.core.app_settings import get_app_settings
+from app.domain.ehr_ingestion.ehr_contexts_repository import (
+    EhrContextsRepository,
+    EhrContextsRepositoryFactory,
+)
+from app.domain.ehr_query.ehr_answer_cache import EHRAnswerCache
+from app.domain.ehr_query.ehr_prompt_utils import PROMPT_FRAGMENT_VERSION
+from app.domain.ehr_query.ehr_query_models import (
+    EHRAnswerWithContextAliases,
+    EHRBatchContextAliases,
+    EHRContextAliases,
+    EHRQuestionContextAliases,
+)
+from app.domain.llm.llm_rate_limiter import LLMRateLimiter
+from app.domain.llm.llm_response_cache import InMemoryLLMResponseCache
+from app.domain.llm.token_counter import count_tokens
+from app.infrastructure.ehr_query.postgres_ehr_answer_store import (
+    PostgresEHRAnswerStore,
+)
+from app.infrastructure.llm.postgres_llm_response_cache import (
+    PostgresLLMResponseCache,
+)
+from tests.api.test_ehr_ingestion_tasks_api import (
+    EHR_PAYLOAD_1,
+    EXPECTED_ALLERGIES,
+    EXPECTED_CHRONIC_CONDITIONS,
+    EXPECTED_LAB_RESULTS,
+    EXPECTED_MEDICATIONS,
+    EXPECTED_VISITS,
+    ingest_ehr_and_wait,
+)
+from tests.api.test_metrics_api import parse_metrics
+from tests.fakes import FakeLLMClient
+from tests.synthetic_ehr import generate_ehr_payload
+
+
+def select_no_contexts(prompt: str, response_model: Type[Any]) -> Any:
+    return EHRContextAliases(ids=[])
+
+
+@pytest.mark.asyncio
+async def test_concurrent_queries_only_hold_a_connection_for_the_read(
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+
+    pool: asyncpg.Pool = app.state.pool
+    # More concurrent queries than pooled connections: if a query kept its
+    # connection while waiting on the LLM, the barrier below would never fill.
+    concurrent_queries = pool.get_max_size() + 5
+
+    barrier = asyncio.Barrier(concurrent_queries)
+    idle_connections_during_llm_calls: list[int] = []
+
+    async def wait_for_all_queries() -> None:
+        if len(idle_connections_during_llm_calls) < concurrent_queries:
+            await asyncio.wait_for(barrier.wait(), timeout=10)
+        idle_connections_during_llm_calls.append(pool.get_idle_size())
+
+    acquisitions = 0
+
+    def counting_repository_factory(
+        pool: asyncpg.Pool = Depends(get_db_pool),
+    ) -> EhrContextsRepositoryFactory:
+        factory = get_ehr_contexts_repository_factory(pool=pool)
+
+        @asynccontextmanager
+        async def counted() -> AsyncIterator[EhrContextsRepository]:
+            nonlocal acquisitions
+            acquisitions += 1
+            async with factory() as repository:
+                yield repository
+
+        return counted
+
+    llm_client = FakeLLMClient(
+        structured_response=select_no_contexts,
+        delay_seconds=0.05,
+        before_response=wait_for_all_queries,
+    )
+    app.dependency_overrides[get_llm_client] = lambda: llm_client
+    app.dependency_overrides[get_ehr_contexts_repository_factory] = (
+        counting_repository_factory
+    )
+
+    try:
+        responses = await asyncio.gather(
+            *(
+                client.post(
+                    f"/api/ehr-query/{EHR_PAYLOAD_1['patient_id']}/query",
+                    json={"query": "¿Cuál es la medicación actual del paciente?"},
+                )
+                for _ in range(concurrent_queries)
+            )
+        )
+    finally:
+        app.dependency_overrides.clear()
+
+    assert all(response.status_code == HTTPStatus.OK for response in responses)
+    assert acquisitions == concurrent_queries
+    assert len(llm_client.calls) == 2 * concurrent_queries
+    assert all(
+        idle == pool.get_size() for idle in idle_connections_during_llm_calls
+    ), "No connection should be checked out while waiting on the LLM"
+
+
+@pytest.mark.asyncio
+async def test_query_only_reads_the_context_types_the_question_is_about(
+    app: FastAPI,
+    client: AsyncClient,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+    monkeypatch.setattr(get_app_settings(), "query_type_routing", True)
+
+    llm_client = FakeLLMClient(structured_response=select_no_contexts)
+    app.dependency_overrides[get_llm_client] = lambda: llm_client
+
+    try:
+        # Not cached yet: only the routed types are read from the database
+        response = await client.post(
+            f"/api/ehr-query/{patient_id}/query",
+            json={"query": "¿Tiene alguna alergia que deba considerar?"},
+        )
+        assert response.status_code == HTTPStatus.OK
+        selection_tokens, answer_tokens = response.headers["X-Prompt-Tokens"].split(
+            ", "
+        )
+        assert int(selection_tokens) > 0 and int(answer_tokens) > 0
+
+        # Matches no keyword, every type is sent, and the whole patient cached
+        response = await client.post(
+            f"/api/ehr-query/{patient_id}/query",
+            json={"query": "¿Ha tenido dolor torácico?"},
+        )
+        assert response.status_code == HTTPStatus.OK
+
+        # Cached: the routed types are filtered in memory
+        response = await client.post(
+            f"/api/ehr-query/{patient_id}/query",
+            json={"query": "¿Tiene alguna alergia que deba considerar?"},
+        )
+        assert response.status_code == HTTPStatus.OK
+    finally:
+        app.dependency_overrides.clear()
+
+    routed_prompts = [llm_client.calls[0], llm_client.calls[4]]
+    for prompt in routed_prompts:
+        types = set(re.findall(r"- id: \S+ \| (\w+)", prompt))
+        assert types == {"allergy", "demographics"}
+
+    unrouted_types = set(re.findall(r"- id: \S+ \| (\w+)", llm_client.calls[2]))
+    assert {"medication", "visit", "lab_result"} <= unrouted_types
+
+    response = await client.get("/api/ehr-query/routing/stats")
+    assert response.status_code == HTTPStatus.OK
+
+    stats = response.json()
+    allergy_and_demographics = len(EXPECTED_ALLERGIES) + 1
+    total = allergy_and_demographics + sum(
+        len(expected)
+        for expected in (
+            EXPECTED_CHRONIC_CONDITIONS,
+            EXPECTED_MEDICATIONS,
+            EXPECTED_VISITS,
+            EXPECTED_LAB_RESULTS,
+        )
+    )
+    assert stats == {
+        "questions": 3,
+        "narrowed": 2,
+        "narrowed_by_classifier": 0,
+        "types_skipped": 2 * 4,
+        "items_kept": 2 * allergy_and_demographics,
+        # Counted whether the patient was cached or not
+        "items_skipped": 2 * (total - allergy_and_demographics),
+    }
+
+
+@pytest.mark.asyncio
+async def test_query_prompts_are_built_from_the_stored_fragments(
+    app: FastAPI,
+    client: AsyncClient,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+    # Routed questions read the items' rows rather than the patient's snapshot
+    monkeypatch.setattr(get_app_settings(), "query_type_routing", True)
+
+    pool: asyncpg.Pool = app.state.pool
+    rows = await pool.fetch(
+        """
+        SELECT id, type, prompt_fragment, prompt_tokens, prompt_fragment_version
+        FROM ehr_patient_context
+        WHERE patient_id = $1
+        ORDER BY id
+        """,
+        patient_id,
+    )
+    for row in rows:
+        assert row["prompt_fragment"].startswith(row["type"])
+        assert row["prompt_tokens"] == count_tokens(row["prompt_fragment"])
+        assert row["prompt_fragment_version"] == PROMPT_FRAGMENT_VERSION
+
+    # Both read for a question about allergies
+    stored = next(row for row in rows if row["type"] == "allergy")
+    stale = next(row for row in rows if row["type"] == "demographics")
+    await pool.execute(
+        "UPDATE ehr_patient_context SET prompt_fragment = 'allergy: almacenado' "
+        "WHERE id = $1",
+        stored["id"],
+    )
+    # Rendered by an older renderer: rendered again rather than used
+    await pool.execute(
+        "UPDATE ehr_patient_context "
+        "SET prompt_fragment = 'demographics: obsoleto', prompt_fragment_version = 0 "
+        "WHERE id = $1",
+        stale["id"],
+    )
+
+    llm_client = FakeLLMClient(structured_response=select_no_contexts)
+    app.dependency_overrides[get_llm_client] = lambda: llm_client
+
+    try:
+        response = await client.post(
+            f"/api/ehr-query/{patient_id}/query",
+            json={"query": "¿Tiene alguna alergia que deba considerar?"},
+        )
+    finally:
+        app.dependency_overrides.clear()
+
+    assert response.status_code == HTTPStatus.OK
+
+    selection_prompt = llm_client.calls[0]
+    assert "| allergy: almacenado\n" in selection_prompt
+    assert "obsoleto" not in selection_prompt
+    assert f"| {stale['prompt_fragment']}\n" in selection_prompt
+
+
+@pytest.mark.asyncio
+async def test_lexical_prefilter_keeps_the_items_matching_the_question(
+    app: FastAPI,
+    client: AsyncClient,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+
+    settings = get_app_settings()
+    monkeypatch.setattr(settings, "query_type_routing", False)
+    monkeypatch.setattr(settings, "query_prefilter", "lexical")
+    monkeypatch.setattr(settings, "query_prefilter_top_k", 2)
+    monkeypatch.setattr(settings, "query_prefilter_bypass_max_items", 0)
+
+    llm_client = FakeLLMClient(structured_response=select_no_contexts)
+    app.dependency_overrides[get_llm_client] = lambda: llm_client
+
+    async def list_candidates(question: str) -> list[str]:
+        response = await client.post(
+            f"/api/ehr-query/{patient_id}/query", json={"query": question}
+        )
+        assert response.status_code == HTTPStatus.OK
+        return re.findall(r"- id: \S+ \| (.+)", llm_client.calls[-2])
+
+    try:
+        # "mareo" matches the visit "por mareos" once stemmed. The other slot
+        # goes to an undated item, not to the other visit.
+        listed = await list_candidates("¿Ha tenido algún mareo?")
+        assert len(listed) == 2
+        assert any("mareos" in line for line in listed)
+        assert not any("Control rutinario" in line for line in listed)
+
+        # Patients of up to BYPASS_MAX_ITEMS items are not filtered
+        monkeypatch.setattr(settings, "query_prefilter_bypass_max_items", 9)
+        listed = await list_candidates("¿Ha tenido algún mareo?")
+        assert len(listed) == 9
+    finally:
+        app.dependency_overrides.clear()
+
+
+@pytest.fixture()
+def vector_prefilter(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Enables the vector prefilter, before the app starts when requested
+    ahead of it: the embedding client is only created for it."""
+    settings = get_app_settings()
+    monkeypatch.setattr(settings, "query_prefilter", "vector")
+    monkeypatch.setattr(settings, "query_prefilter_top_k", 3)
+    monkeypatch.setattr(settings, "query_prefilter_bypass_max_items", 0)
+
+
+@pytest.mark.asyncio
+async def test_vector_prefilter_keeps_the_items_closest_to_the_question(
+    vector_prefilter: None,
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+
+    # Items are embedded at ingestion
+    embedded = await app.state.pool.fetchval(
+        "SELECT count(*) FROM ehr_patient_context WHERE embedding IS NOT NULL"
+    )
+    assert embedded == 9
+
+    llm_client = FakeLLMClient(structured_response=select_no_contexts)
+    app.dependency_overrides[get_llm_client] = lambda: llm_client
+
+    try:
+        response = await client.post(
+            f"/api/ehr-query/{patient_id}/query",
+            json={"query": "¿Es alérgico a la penicilina?"},
+        )
+    finally:
+        app.dependency_overrides.clear()
+
+    assert response.status_code == HTTPStatus.OK
+    assert "prefilter;dur=" in response.headers["Server-Timing"]
+
+    # Only the top 3 of the 9 items are listed, the allergy among them
+    listed = re.findall(r"- id: \S+ \| (.+)", llm_client.calls[0])
+    assert len(listed) == 3
+    assert any("Penicilina" in line for line in listed)
+
+
+@pytest.mark.asyncio
+async def test_query_can_select_and_answer_in_a_single_call(
+    app: FastAPI,
+    client: AsyncClient,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+
+    def select_and_answer(prompt: str, response_model: Type[Any]) -> Any:
+        if response_model is EHRAnswerWithContextAliases:
+            # 999 is listed in no prompt
+            return EHRAnswerWithContextAliases(
+                answer="Alergia a penicilina.", ids=[1, 999]
+            )
+        return EHRContextAliases(ids=[1])
+
+    llm_client = FakeLLMClient(structured_response=select_and_answer)
+    app.dependency_overrides[get_llm_client] = lambda: llm_client
+
+    async def query(mode: str | None = None) -> Response:
+        return await client.post(
+            f"/api/ehr-query/{patient_id}/query",
+            params={"mode": mode} if mode else {},
+            json={"query": "¿Tiene alguna alergia que deba considerar?"},
+        )
+
+    try:
+        single_call = await query("single_call")
+        two_calls = await query("two_calls")
+
+        # In auto mode, depending on the size of the single call's prompt
+        monkeypatch.setattr(get_app_settings(), "query_mode", "auto")
+        auto_small = await query()
+        monkeypatch.setattr(get_app_settings(), "query_single_call_max_tokens", 10)
+        auto_large = await query()
+
+        invalid = await query("three_calls")
+    finally:
+        app.dependency_overrides.clear()
+
+    assert single_call.status_code == HTTPStatus.OK
+    assert single_call.json()["answer"] == "Alergia a penicilina."
+    # The out of range alias is rejected, the other resolved
+    (reference,) = single_call.json()["references"]
+    assert f"- id: 1 | {reference['type']}" in llm_client.calls[0]
+    assert 'en "ids"' in llm_client.calls[0]
+    assert "," not in single_call.headers["X-Prompt-Tokens"]
+
+    assert two_calls.status_code == HTTPStatus.OK
+    assert two_calls.json()["answer"] == "Respuesta de prueba."
+    assert two_calls.json()["references"] == single_call.json()["references"]
+    assert len(two_calls.headers["X-Prompt-Tokens"].split(", ")) == 2
+
+    assert auto_small.json() == single_call.json()
+    assert auto_large.json() == two_calls.json()
+    assert len(llm_client.calls) == 1 + 2 + 1 + 2
+
+    assert invalid.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.asyncio
+async def test_query_skips_the_selection_of_few_enough_candidates(
+    app: FastAPI,
+    client: AsyncClient,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+
+    llm_client = FakeLLMClient(structured_response=select_no_contexts)
+    app.dependency_overrides[get_llm_client] = lambda: llm_client
+
+    async def query() -> Response:
+        return await client.post(
+            f"/api/ehr-query/{patient_id}/query",
+            json={"query": "¿Tiene alguna alergia que deba considerar?"},
+        )
+
+    async def get_selection_metrics() -> dict[str, float]:
+        metrics = parse_metrics((await client.get("/metrics")).text)
+        return {
+            decision: metrics.get(
+                f'ehr_query_context_selections_total{{decision="{decision}"}}', 0
+            )
+            for decision in ["selected", "skipped"]
+        }
+
+    settings = get_app_settings()
+    monkeypatch.setattr(settings, "query_type_routing", True)
+    before = await get_selection_metrics()
+    try:
+        monkeypatch.setattr(settings, "query_skip_selection_below_tokens", 100_000)
+        skipped = await query()
+        skipped_calls = list(llm_client.calls)
+
+        monkeypatch.setattr(settings, "query_skip_selection_below_tokens", 10)
+        selected = await query()
+    finally:
+        app.dependency_overrides.clear()
+    after = await get_selection_metrics()
+
+    assert skipped.status_code == HTTPStatus.OK
+    # Only the answer call, given every routed item
+    (answer_prompt,) = skipped_calls
+    references = skipped.json()["references"]
+    assert {reference["type"] for reference in references} == {
+        "allergy",
+        "demographics",
+    }
+    for reference in references:
+        assert reference["content"] in answer_prompt
+
+    decision, tokens = skipped.headers["X-Context-Selection"].split(";")
+    assert decision == "skipped"
+    assert 10 < int(tokens.removeprefix("tokens=")) < 100_000
+
+    assert selected.status_code == HTTPStatus.OK
+    assert selected.json()["references"] == []
+    assert len(llm_client.calls) == 1 + 2
+    assert selected.headers["X-Context-Selection"] == f"selected;{tokens}"
+
+    assert after["skipped"] - before["skipped"] == 1
+    assert after["selected"] - before["selected"] == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["memory", "postgres"])
+async def test_repeated_queries_are_answered_from_the_llm_cache(
+    app: FastAPI,
+    client: AsyncClient,
+    backend: str,
+) -> None:
+    # As the app sets it up with LLM_CACHE=memory or postgres
+    app.state.llm_response_cache = (
+        PostgresLLMResponseCache(pool=app.state.pool, max_entries=100, ttl_seconds=60)
+        if backend == "postgres"
+        else InMemoryLLMResponseCache(max_entries=100, ttl_seconds=60)
+    )
+
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+
+    llm_client = FakeLLMClient(structured_response=select_no_contexts)
+    app.dependency_overrides[get_openai_llm_client] = lambda: llm_client
+
+    async def query(question: str) -> Response:
+        return await client.post(
+            f"/api/ehr-query/{patient_id}/query",
+            json={"query": question},
+        )
+
+    try:
+        first = await query("¿Cuál es la medicación actual del paciente?")
+        repeated = await query("¿Cuál es la medicación actual del paciente?")
+        other = await query("¿Tiene alguna alergia que deba considerar?")
+    finally:
+        app.dependency_overrides.clear()
+
+    assert first.headers["X-LLM-Cache"] == "miss, miss"
+    assert repeated.headers["X-LLM-Cache"] == "hit, hit"
+    assert repeated.json() == first.json()
+    assert other.headers["X-LLM-Cache"] == "miss, miss"
+    assert len(llm_client.calls) == 4
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["memory", "postgres"])
+async def test_repeated_questions_are_answered_from_the_answer_cache(
+    app: FastAPI,
+    client: AsyncClient,
+    monkeypatch: pytest.MonkeyPatch,
+    backend: str,
+) -> None:
+    pool: asyncpg.Pool = app.state.pool
+    store = (
+        PostgresEHRAnswerStore(pool=pool, max_entries=100, ttl_seconds=60)
+        if backend == "postgres"
+        else None
+    )
+
+    def use_answer_cache() -> EHRAnswerCache:
+        # As the app sets it up with ANSWER_CACHE=memory or postgres
+        cache = EHRAnswerCache(max_entries=100, ttl_seconds=60, store=store)
+        app.state.ehr_contexts_cache.add_invalidation_listener(cache.invalidate)
+        app.state.ehr_answer_cache = cache
+        return cache
+
+    async def get_cache_metrics() -> dict[tuple[str, str], float]:
+        metrics = parse_metrics((await client.get("/metrics")).text)
+        return {
+            (tier, result): metrics.get(
+                "ehr_answer_cache_requests_total"
+                f'{{tier="{tier}",result="{result}"}}',
+                0,
+            )
+            for tier in ["memory", "store"]
+            for result in ["hit", "miss"]
+        }
+
+    use_answer_cache()
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+
+    llm_client = FakeLLMClient(structured_response=select_no_contexts)
+    app.dependency_overrides[get_llm_client] = lambda: llm_client
+
+    async def query(question: str) -> Response:
+        response = await client.post(
+            f"/api/ehr-query/{patient_id}/query", json={"query": question}
+        )
+        assert response.status_code == HTTPStatus.OK
+        return response
+
+    before = await get_cache_metrics()
+    try:
+        first = await query("¿Tiene alguna alergia que deba considerar?")
+        assert len(llm_client.calls) == 2
+
+        # The same question once normalized, and nothing changed since
+        repeated = await query("tiene alguna ALERGIA, que deba considerar")
+        await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+        after_unchanged_ingestion = await query(
+            "¿Tiene alguna alergia que deba considerar?"
+        )
+        assert repeated.json() == after_unchanged_ingestion.json() == first.json()
+        assert len(llm_client.calls) == 2
+
+        if backend == "postgres":
+            # Another process, or this one restarted
+            use_answer_cache()
+            await query("¿Tiene alguna alergia que deba considerar?")
+            assert len(llm_client.calls) == 2
+
+        # A new version of the patient's contexts
+        await ingest_ehr_and_wait(
+            client,
+            {**EHR_PAYLOAD_1, "recent_visits": EHR_PAYLOAD_1["recent_visits"][:1]},
+        )
+        await query("¿Tiene alguna alergia que deba considerar?")
+        assert len(llm_client.calls) == 4
+        await query("¿Tiene alguna alergia que deba considerar?")
+        assert len(llm_client.calls) == 4
+
+        # Answers are not shared by configurations that shape the prompts
+        monkeypatch.setattr(get_app_settings(), "query_prefilter", "lexical")
+        await query("¿Tiene alguna alergia que deba considerar?")
+        assert len(llm_client.calls) == 6
+        await query("¿Tiene alguna alergia que deba considerar?")
+        assert len(llm_client.calls) == 6
+    finally:
+        app.dependency_overrides.clear()
+
+    after = await get_cache_metrics()
+    counted = {key: after[key] - before[key] for key in after}
+    if backend == "memory":
+        assert counted == {
+            ("memory", "hit"): 4,
+            ("memory", "miss"): 3,
+            ("store", "hit"): 0,
+            ("store", "miss"): 0,
+        }
+    else:
+        assert counted == {
+            ("memory", "hit"): 4,
+            ("memory", "miss"): 4,
+            ("store", "hit"): 1,
+            ("store", "miss"): 3,
+        }
+
+    if backend == "postgres":
+        # The answers of the previous version were deleted with the new one
+        versions = await pool.fetch(
+            "SELECT context_version FROM ehr_query_answer_cache WHERE patient_id = $1",
+            patient_id,
+        )
+        assert [row["context_version"] for row in versions] == [2, 2]
+
+
+@pytest.mark.asyncio
+async def test_answers_started_before_an_invalidation_are_not_cached(
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    cache = EHRAnswerCache(max_entries=100, ttl_seconds=60)
+    app.state.ehr_contexts_cache.add_invalidation_listener(cache.invalidate)
+    app.state.ehr_answer_cache = cache
+
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+
+    # As if another process ingested the patient while the LLM answered: the
+    # contexts read before may be older than the version the answer is keyed by
+    invalidated = False
+
+    async def invalidate_once() -> None:
+        nonlocal invalidated
+        if not invalidated:
+            invalidated = True
+            app.state.ehr_contexts_cache.invalidate(patient_id)
+
+    llm_client = FakeLLMClient(
+        structured_response=select_no_contexts, before_response=invalidate_once
+    )
+    app.dependency_overrides[get_llm_client] = lambda: llm_client
+
+    try:
+        for _ in range(3):
+            response = await client.post(
+                f"/api/ehr-query/{patient_id}/query",
+                json={"query": "¿Tiene alguna alergia que deba considerar?"},
+            )
+            assert response.status_code == HTTPStatus.OK
+    finally:
+        app.dependency_overrides.clear()
+
+    # Answered twice, then from the cache
+    assert len(llm_client.calls) == 4
+
+
+@pytest.mark.asyncio
+async def test_answers_are_keyed_by_the_version_of_the_items_they_were_built_from(
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    pool: asyncpg.Pool = app.state.pool
+    cache = EHRAnswerCache(max_entries=100, ttl_seconds=60)
+    app.state.ehr_contexts_cache.add_invalidation_listener(cache.invalidate)
+    app.state.ehr_answer_cache = cache
+
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+
+    llm_client = FakeLLMClient(structured_response=select_no_contexts)
+    app.dependency_overrides[get_llm_client] = lambda: llm_client
+
+    async def query() -> None:
+        response = await client.post(
+            f"/api/ehr-query/{patient_id}/query",
+            json={"query": "¿Tiene alguna alergia que deba considerar?"},
+        )
+        assert response.status_code == HTTPStatus.OK
+
+    try:
+        await query()
+        assert len(llm_client.calls) == 2
+
+        # As if another process re-ingested the patient and its notification
+        # had not arrived yet: the contexts cache is stale
+        await pool.execute(
+            """
+            UPDATE ehr_patient_context_snapshot
+                SET version = version + 1
+            WHERE patient_id = $1
+            """,
+            patient_id,
+        )
+
+        # Answered from the stale items, under their version
+        await query()
+        assert len(llm_client.calls) == 2
+
+        # Once notified, answered again from the new version, not from an answer
+        # of the stale items cached under it
+        app.state.ehr_contexts_cache.invalidate(patient_id)
+        await query()
+        assert len(llm_client.calls) == 4
+    finally:
+        app.dependency_overrides.clear()
+
+
+@pytest.mark.asyncio
+async def test_llm_calls_past_the_concurrency_limit_queue(
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+
+    in_flight = 0
+    max_in_flight = 0
+
+    async def track_in_flight() -> None:
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.05)
+        in_flight -= 1
+
+    llm_client = FakeLLMClient(
+        structured_response=select_no_contexts, before_response=track_in_flight
+    )
+    llm_rate_limiter = LLMRateLimiter(max_concurrency=1)
+    app.dependency_overrides[get_openai_llm_client] = lambda: llm_client
+    app.dependency_overrides[get_llm_rate_limiter] = lambda: llm_rate_limiter
+    app.dependency_overrides[get_llm_response_cache] = lambda: None
+
+    try:
+        responses = await asyncio.gather(
+            *(
+                client.post(
+                    f"/api/ehr-query/{patient_id}/query",
+                    json={"query": f"¿Qué medicamentos toma? ({i})"},
+                )
+                for i in range(3)
+            )
+        )
+        stats_response = await client.get("/api/ehr-query/llm/stats")
+    finally:
+        app.dependency_overrides.clear()
+
+    # Queued calls wait their turn instead of failing
+    assert all(response.status_code == HTTPStatus.OK for response in responses)
+    assert max_in_flight == 1
+
+    stats = stats_response.json()
+    assert stats["requests"] == 6
+    assert stats["queued"] >= 2
+    assert stats["wait_seconds_max"] >= 0.05
+    assert stats["waiting"] == stats["in_flight"] == 0
+
+
+def parse_sse_events(body: str) -> list[tuple[str, Any]]:
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+@pytest.mark.asyncio
+async def test_query_stream_sends_references_then_answer_chunks(
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+
+    def select_medications(prompt: str, response_model: Type[Any]) -> Any:
+        aliases = re.findall(r"- id: (\d+) \| medication", prompt)
+        # An alias of no listed context is ignored
+        return EHRContextAliases(ids=[*map(int, aliases), 999])
+
+    answer = "El paciente toma Metformina 850mg dos veces al día."
+    llm_client = FakeLLMClient(
+        structured_response=select_medications,
+        answer=answer,
+        chunk_delay_seconds=0.01,
+    )
+    app.dependency_overrides[get_llm_client] = lambda: llm_client
+
+    try:
+        response = await client.post(
+            f"/api/ehr-query/{patient_id}/query/stream",
+            json={"query": "¿Cuál es la medicación actual del paciente?"},
+        )
+    finally:
+        app.dependency_overrides.clear()
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["content-type"].startswith("text/event-stream")
+
+    events = parse_sse_events(response.text)
+    names = [name for name, _ in events]
+    assert names[0] == "references"
+    assert names[-1] == "done"
+    assert set(names[1:-1]) == {"answer_delta"}
+    assert len(names[1:-1]) == len(answer.split())
+
+    references = events[0][1]["references"]
+    assert len(references) == len(EXPECTED_MEDICATIONS)
+    assert all(reference["type"] == "medication" for reference in references)
+    assert "".join(data["delta"] for _, data in events[1:-1]) == answer
+
+
+@pytest.mark.asyncio
+async def test_batch_query_selects_once_for_all_questions(
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+
+    queries = [
+        "¿Cuál es la medicación actual del paciente?",
+        "¿Tiene alguna alergia que deba considerar?",
+        "¿Qué enfermedades crónicas tiene?",
+    ]
+
+    def select_by_type(prompt: str, response_model: Type[Any]) -> Any:
+        assert response_model is EHRBatchContextAliases
+
+        def aliases(type: str) -> list[int]:
+            return [
+                int(alias) for alias in re.findall(rf"- id: (\d+) \| {type}", prompt)
+            ]
+
+        return EHRBatchContextAliases(
+            selections=[
+                EHRQuestionContextAliases(question=1, ids=aliases("medication")),
+                EHRQuestionContextAliases(question=2, ids=aliases("allergy")),
+                EHRQuestionContextAliases(question=3, ids=aliases("chronic_condition")),
+            ]
+        )
+
+    def answer(prompt: str) -> str:
+        if queries[2] in prompt:
+            raise TimeoutError("LLM timed out")
+        return "Respuesta de prueba."
+
+    llm_client = FakeLLMClient(structured_response=select_by_type, answer=answer)
+    app.dependency_overrides[get_llm_client] = lambda: llm_client
+
+    try:
+        response = await client.post(
+            f"/api/ehr-query/{patient_id}/batch-query",
+            json={"queries": queries},
+        )
+    finally:
+        app.dependency_overrides.clear()
+
+    assert response.status_code == HTTPStatus.OK
+
+    # One selection call for the batch, then one answer per question
+    assert len(llm_client.calls) == 1 + len(queries)
+    assert all(query in llm_client.calls[0] for query in queries)
+
+    medication, allergy, chronic_condition = response.json()["results"]
+
+    assert medication["query"] == queries[0]
+    assert medication["answer"] == "Respuesta de prueba."
+    assert medication["error"] is None
+    assert {reference["type"] for reference in medication["references"]} == {
+        "medication"
+    }
+    assert len(medication["references"]) == len(EXPECTED_MEDICATIONS)
+
+    assert len(allergy["references"]) == len(EXPECTED_ALLERGIES)
+
+    assert chronic_condition["answer"] is None
+    assert chronic_condition["error"] == "Answer generation failed"
+
+
+@pytest.mark.asyncio
+async def test_patients_query_streams_one_result_per_patient(
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    payloads = [
+        generate_ehr_payload(f"F{i:06d}", seed=i, visits=2, lab_results=2)
+        for i in range(5)
+    ]
+    for payload in payloads:
+        await ingest_ehr_and_wait(client, payload)
+
+    def select_allergies(prompt: str, response_model: Type[Any]) -> Any:
+        aliases = re.findall(r"- id: (\d+) \| allergy", prompt)
+        return EHRContextAliases(ids=[int(alias) for alias in aliases])
+
+    llm_client = FakeLLMClient(structured_response=select_allergies, delay_seconds=0.01)
+    app.dependency_overrides[get_llm_client] = lambda: llm_client
+
+    patient_ids = [payload["patient_id"] for payload in payloads]
+    try:
+        response = await client.post(
+            "/api/ehr-query/patients-query",
+            json={
+                "query": "¿Tiene alguna alergia que deba considerar?",
+                # Repeated ids are queried once
+                "patient_ids": [*patient_ids, patient_ids[0]],
+            },
+        )
+    finally:
+        app.dependency_overrides.clear()
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(result["patient_id"] for result in results) == patient_ids
+    assert len(llm_client.calls) == 2 * len(patient_ids)
+
+    for result in results:
+        assert result["error"] is None
+        assert result["answer"] == "Respuesta de prueba."
+        assert [reference["type"] for reference in result["references"]] == ["allergy"]
+        assert all(
+            reference["patient_id"] == result["patient_id"]
+            for reference in result["references"]
+        )
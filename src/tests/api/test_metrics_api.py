@@ -0,0 +1,84 @@
+import re
+from http import HTTPStatus
+from typing import Any, Type
+
+import pytest
+from fastapi import FastAPI
+from httpx import AsyncClient
+
+from app.api.dependencies import get_openai_llm_client
+from app.domain.ehr_query.ehr_query_models import EHRContextAliases
+from app.domain.llm.llm_response_cache import InMemoryLLMResponseCache
+from tests.api.test_ehr_ingestion_tasks_api import EHR_PAYLOAD_1, ingest_ehr_and_wait
+from tests.fakes import FakeLLMClient
+
+
+def select_first_context(prompt: str, response_model: Type[Any]) -> Any:
+    return EHRContextAliases(ids=[1])
+
+
+def parse_metrics(body: str) -> dict[str, float]:
+    return {
+        sample: float(value)
+        for sample, value in (
+            line.rsplit(" ", 1) for line in body.splitlines() if line[:1] != "#"
+        )
+    }
+
+
+@pytest.mark.asyncio
+async def test_query_reports_stage_timings_and_metrics(
+    app: FastAPI,
+    client: AsyncClient,
+) -> None:
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+
+    app.state.llm_response_cache = InMemoryLLMResponseCache(
+        max_entries=100, ttl_seconds=60
+    )
+    llm_client = FakeLLMClient(structured_response=select_first_context)
+    app.dependency_overrides[get_openai_llm_client] = lambda: llm_client
+
+    try:
+        response = await client.post(
+            f"/api/ehr-query/{patient_id}/query",
+            json={"query": "¿Ha tenido dolor torácico?"},
+        )
+    finally:
+        app.dependency_overrides.clear()
+
+    assert response.status_code == HTTPStatus.OK
+
+    server_timing = dict(
+        re.findall(r"(\w+);dur=([\d.]+)", response.headers["Server-Timing"])
+    )
+    assert list(server_timing) == [
+        "routing",
+        "db_pool_acquire",
+        "db_read",
+        "selection_prompt",
+        "llm_selection",
+        "answer_prompt",
+        "llm_answer",
+    ]
+
+    response = await client.get("/metrics")
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+
+    metrics = parse_metrics(response.text)
+    for stage in [*server_timing, "ingest_build_items", "ingest_write"]:
+        assert metrics[f'ehr_stage_duration_seconds_count{{stage="{stage}"}}'] >= 1
+        assert (
+            metrics[f'ehr_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}}']
+            == metrics[f'ehr_stage_duration_seconds_count{{stage="{stage}"}}']
+        )
+
+    assert metrics['ehr_db_pool_connections{state="in_use"}'] >= 0
+    assert metrics["ehr_db_pool_max_connections"] > 0
+    assert metrics['ehr_contexts_cache_requests_total{result="miss"}'] == 1
+    assert metrics['ehr_llm_cache_requests_total{result="miss"}'] >= 2
+    assert metrics["ehr_llm_requests_total"] == 2
+    assert metrics['ehr_llm_tokens_total{kind="prompt"}'] > 0
+    assert metrics['ehr_llm_tokens_total{kind="output"}'] > 0
@@ -0,0 +1 @@
+# This file marks the app directory as a Python package.
@@ -0,0 +1,33 @@
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable
+
+import pytest
+
+BenchmarkRecorder = Callable[..., None]
+
+
+@pytest.fixture()
+def record_benchmark(request: pytest.FixtureRequest) -> BenchmarkRecorder:
+    """Prints a benchmark measurement and appends it as a JSON line to
+    $BENCHMARK_RESULTS_DIR/<test module>.jsonl (default: benchmark-results/)."""
+
+    results_dir = Path(os.getenv("BENCHMARK_RESULTS_DIR", "benchmark-results"))
+    results_file = results_dir / f"{request.path.stem}.jsonl"
+
+    def record(name: str, **measurements: Any) -> None:
+        result = {
+            "benchmark": name,
+            "test": request.node.name,
+            "recorded_at": datetime.now(timezone.utc).isoformat(),
+            **measurements,
+        }
+        print(json.dumps(result, ensure_ascii=False))
+
+        results_dir.mkdir(parents=True, exist_ok=True)
+        with results_file.open("a", encoding="utf-8") as f:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+    return record
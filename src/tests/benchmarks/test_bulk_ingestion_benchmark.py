@@ -0,0 +1,121 @@
+import json
+import time
+from typing import AsyncIterator, cast
+
+import asyncpg
+import pytest
+from fastapi import FastAPI
+
+from app.domain.ehr_ingestion.ehr_contexts_repository import EhrContextsRepository
+from app.domain.ehr_ingestion.ehr_contexts_service import EHRContextsService
+from app.domain.ehr_ingestion.ehr_models import ElectronicPatientRecord
+from tests.benchmarks.conftest import BenchmarkRecorder
+from tests.synthetic_ehr import generate_ehr_payload
+
+PATIENTS = 500
+VISITS = 20
+LAB_RESULTS = 20
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_bulk_copy_ingestion_against_executemany(
+    app: FastAPI,
+    record_benchmark: BenchmarkRecorder,
+) -> None:
+    payloads = [
+        generate_ehr_payload(
+            f"B{i:06d}", seed=i, visits=VISITS, lab_results=LAB_RESULTS
+        )
+        for i in range(PATIENTS)
+    ]
+
+    pool: asyncpg.Pool = app.state.pool
+    async with pool.acquire() as conn:
+        service = EHRContextsService(
+            EhrContextsRepository(conn=cast(asyncpg.Connection, conn))
+        )
+
+        started = time.perf_counter()
+        for payload in payloads:
+            await service.ingest_ehr(ElectronicPatientRecord.model_validate(payload))
+        executemany_seconds = time.perf_counter() - started
+
+        rows = await conn.fetchval("SELECT count(*) FROM ehr_patient_context")
+        # Otherwise the bulk ingestion finds every item unchanged
+        await conn.execute("TRUNCATE ehr_patient_context, ehr_patient_context_snapshot")
+
+        async def ndjson_lines() -> AsyncIterator[bytes]:
+            for payload in payloads:
+                yield json.dumps(payload).encode()
+
+        started = time.perf_counter()
+        result = await service.ingest_ehr_ndjson(ndjson_lines(), batch_size=500)
+        copy_seconds = time.perf_counter() - started
+
+    assert result.ingested == PATIENTS
+    assert result.context_items == rows
+
+    record_benchmark(
+        "executemany_ingestion",
+        patients=PATIENTS,
+        rows=rows,
+        seconds=executemany_seconds,
+        rows_per_second=rows / executemany_seconds,
+    )
+    record_benchmark(
+        "bulk_copy_ingestion",
+        patients=PATIENTS,
+        rows=rows,
+        seconds=copy_seconds,
+        rows_per_second=rows / copy_seconds,
+    )
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_copy_many_against_insert_many(
+    app: FastAPI,
+    record_benchmark: BenchmarkRecorder,
+) -> None:
+    # Write path only: items are decomposed up front so that the comparison is
+    # not dominated by validation.
+    items = [
+        item
+        for i in range(PATIENTS)
+        for item in EHRContextsService.build_ehr_context_items(
+            ElectronicPatientRecord.model_validate(
+                generate_ehr_payload(
+                    f"W{i:06d}", seed=i, visits=VISITS, lab_results=LAB_RESULTS
+                )
+            )
+        )
+    ]
+
+    pool: asyncpg.Pool = app.state.pool
+    async with pool.acquire() as conn:
+        repository = EhrContextsRepository(conn=cast(asyncpg.Connection, conn))
+
+        started = time.perf_counter()
+        await repository.insert_many(items)
+        insert_many_seconds = time.perf_counter() - started
+
+        await conn.execute("TRUNCATE ehr_patient_context")
+
+        started = time.perf_counter()
+        async with conn.transaction():
+            await repository.copy_many(items)
+        copy_many_seconds = time.perf_counter() - started
+
+    record_benchmark(
+        "insert_many",
+        rows=len(items),
+        seconds=insert_many_seconds,
+        rows_per_second=len(items) / insert_many_seconds,
+    )
+    record_benchmark(
+        "copy_many",
+        rows=len(items),
+        seconds=copy_many_seconds,
+        rows_per_second=len(items) / copy_many_seconds,
+    )
@@ -0,0 +1,83 @@
+import time
+from statistics import median
+from typing import Any, Type
+
+import pytest
+from fastapi import FastAPI
+from httpx import AsyncClient
+
+from app.api.dependencies import get_llm_client
+from app.core.timing import record_timing_spans, timed
+from app.domain.ehr_query.ehr_query_models import EHRContextAliases
+from tests.api.test_ehr_ingestion_tasks_api import EHR_PAYLOAD_1, ingest_ehr_and_wait
+from tests.benchmarks.conftest import BenchmarkRecorder
+from tests.fakes import FakeLLMClient
+
+SPANS = 100_000
+QUERIES = 50
+
+
+def select_first_context(prompt: str, response_model: Type[Any]) -> Any:
+    return EHRContextAliases(ids=[1])
+
+
+def span_overhead_seconds() -> float:
+    """Cost of timing an empty block as a stage, recorded for a Server-Timing
+    header, over the bare block."""
+    started = time.perf_counter()
+    for _ in range(SPANS):
+        pass
+    bare = time.perf_counter() - started
+
+    with record_timing_spans():
+        started = time.perf_counter()
+        for _ in range(SPANS):
+            with timed("benchmark"):
+                pass
+        instrumented = time.perf_counter() - started
+
+    return (instrumented - bare) / SPANS
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_instrumentation_overhead_per_query(
+    app: FastAPI,
+    client: AsyncClient,
+    record_benchmark: BenchmarkRecorder,
+) -> None:
+    await ingest_ehr_and_wait(client, EHR_PAYLOAD_1)
+    patient_id = EHR_PAYLOAD_1["patient_id"]
+
+    # An instant LLM leaves only the app's own work in the query latency, the
+    # worst case for the relative cost of the instrumentation
+    app.dependency_overrides[get_llm_client] = lambda: FakeLLMClient(
+        structured_response=select_first_context
+    )
+    try:
+        latencies = []
+        for i in range(QUERIES):
+            started = time.perf_counter()
+            response = await client.post(
+                f"/api/ehr-query/{patient_id}/query",
+                json={"query": f"¿Ha tenido dolor torácico? ({i})"},
+            )
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200
+    finally:
+        app.dependency_overrides.clear()
+
+    spans_per_query = response.headers["Server-Timing"].count("dur=")
+    per_span_seconds = span_overhead_seconds()
+    query_seconds = median(latencies)
+    overhead_ratio = spans_per_query * per_span_seconds / query_seconds
+
+    record_benchmark(
+        "instrumentation_overhead",
+        per_span_microseconds=per_span_seconds * 1e6,
+        spans_per_query=spans_per_query,
+        query_median_seconds=query_seconds,
+        overhead_ratio=overhead_ratio,
+    )
+
+    assert overhead_ratio < 0.01
@@ -0,0 +1,101 @@
+from dataclasses import dataclass
+from statistics import mean
+from typing import Callable
+
+import pytest
+
+from app.domain.ehr_ingestion.ehr_context_models import EHRContextItem, EHRContextType
+from app.domain.ehr_ingestion.ehr_contexts_service import EHRContextsService
+from app.domain.ehr_ingestion.ehr_models import ElectronicPatientRecord
+from app.domain.ehr_query.ehr_lexical_ranker import LexicalEHRContextsPrefilter
+from tests.benchmarks.conftest import BenchmarkRecorder
+from tests.synthetic_ehr import generate_ehr_payload
+
+TOP_KS = [10, 20, 40]
+
+
+@dataclass
+class LabelledQuestion:
+    question: str
+    is_relevant: Callable[[EHRContextItem], bool]
+
+
+def of_type(type: EHRContextType) -> Callable[[EHRContextItem], bool]:
+    return lambda item: item.type == type
+
+
+def containing(text: str) -> Callable[[EHRContextItem], bool]:
+    return lambda item: text in item.content
+
+
+LABELLED_QUESTIONS = [
+    LabelledQuestion(
+        "¿Tiene alguna alergia que deba considerar?",
+        of_type(EHRContextType.ALLERGY),
+    ),
+    LabelledQuestion(
+        "¿Cuál es la medicación actual del paciente?",
+        of_type(EHRContextType.MEDICATION),
+    ),
+    LabelledQuestion(
+        "¿Qué enfermedades crónicas tiene?",
+        of_type(EHRContextType.CHRONIC_CONDITION),
+    ),
+    LabelledQuestion(
+        "¿Cuál es su tipo sanguíneo y edad?",
+        of_type(EHRContextType.DEMOGRAPHICS),
+    ),
+    LabelledQuestion(
+        "¿Cómo ha evolucionado su hemoglobina en los hemogramas?",
+        containing("Hemograma"),
+    ),
+    LabelledQuestion(
+        "¿Qué valores tuvo en el perfil lipídico?",
+        containing("Perfil lipídico"),
+    ),
+    LabelledQuestion(
+        "¿Ha consultado por mareos?",
+        containing("mareos"),
+    ),
+    LabelledQuestion(
+        "¿Ha tenido dolor torácico?",
+        containing("Dolor torácico"),
+    ),
+]
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_lexical_prefilter_recall(record_benchmark: BenchmarkRecorder) -> None:
+    # Offline, no database or LLM involved: recall of the relevant items among
+    # the candidates the prefilter keeps for the LLM selection step.
+    items = EHRContextsService.build_ehr_context_items(
+        ElectronicPatientRecord.model_validate(
+            generate_ehr_payload("R000001", seed=1, visits=60, lab_results=60)
+        )
+    )
+
+    for top_k in TOP_KS:
+        prefilter = LexicalEHRContextsPrefilter(top_k=top_k, bypass_max_items=0)
+
+        recalls = {}
+        for labelled in LABELLED_QUESTIONS:
+            relevant = {item.id for item in items if labelled.is_relevant(item)}
+            assert relevant, f"No relevant items for: {labelled.question}"
+
+            kept = {
+                item.id for item in await prefilter.narrow(labelled.question, items)
+            }
+            recalls[labelled.question] = len(relevant & kept) / len(relevant)
+
+        record_benchmark(
+            "lexical_prefilter_recall",
+            items=len(items),
+            top_k=top_k,
+            mean_recall=mean(recalls.values()),
+            min_recall=min(recalls.values()),
+            recall_by_question=recalls,
+        )
+
+        if top_k == max(TOP_KS):
+            assert mean(recalls.values()) >= 0.9
@@ -0,0 +1,94 @@
+import json
+import time
+from typing import Any, AsyncIterator, Type, cast
+
+import asyncpg
+import pytest
+from fastapi import FastAPI
+from httpx import AsyncClient
+
+from app.api.dependencies import get_llm_client
+from app.core.app_settings import get_app_settings
+from app.domain.ehr_ingestion.ehr_contexts_repository import EhrContextsRepository
+from app.domain.ehr_ingestion.ehr_contexts_service import EHRContextsService
+from app.domain.ehr_query.ehr_query_models import EHRContextAliases
+from tests.benchmarks.conftest import BenchmarkRecorder
+from tests.fakes import FakeLLMClient
+from tests.synthetic_ehr import generate_ehr_payload
+
+PATIENTS = 100
+CONCURRENCIES = [1, 8, 32]
+
+# Injected per LLM call; each patient makes two (selection and answer)
+LLM_LATENCY_SECONDS = 0.1
+
+
+def select_first_context(prompt: str, response_model: Type[Any]) -> Any:
+    return EHRContextAliases(ids=[1])
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_patients_query_throughput_by_concurrency(
+    app: FastAPI,
+    client: AsyncClient,
+    monkeypatch: pytest.MonkeyPatch,
+    record_benchmark: BenchmarkRecorder,
+) -> None:
+    payloads = [
+        generate_ehr_payload(f"Q{i:06d}", seed=i, visits=10, lab_results=10)
+        for i in range(PATIENTS)
+    ]
+
+    async def ndjson_lines() -> AsyncIterator[bytes]:
+        for payload in payloads:
+            yield json.dumps(payload).encode()
+
+    pool: asyncpg.Pool = app.state.pool
+    async with pool.acquire() as conn:
+        service = EHRContextsService(
+            EhrContextsRepository(conn=cast(asyncpg.Connection, conn))
+        )
+        await service.ingest_ehr_ndjson(ndjson_lines(), batch_size=PATIENTS)
+
+    app.dependency_overrides[get_llm_client] = lambda: FakeLLMClient(
+        structured_response=select_first_context,
+        delay_seconds=LLM_LATENCY_SECONDS,
+    )
+    try:
+        for concurrency in CONCURRENCIES:
+            monkeypatch.setattr(
+                get_app_settings(), "query_patients_concurrency", concurrency
+            )
+            # Each run reads from the database, not from the contexts cache
+            for payload in payloads:
+                app.state.ehr_contexts_cache.invalidate(payload["patient_id"])
+
+            started = time.perf_counter()
+            results = []
+            async with client.stream(
+                "POST",
+                "/api/ehr-query/patients-query",
+                json={
+                    "query": "¿Qué medicamentos toma actualmente?",
+                    "patient_ids": [payload["patient_id"] for payload in payloads],
+                },
+                timeout=None,
+            ) as response:
+                async for line in response.aiter_lines():
+                    results.append(json.loads(line))
+            seconds = time.perf_counter() - started
+
+            assert len(results) == PATIENTS
+            assert all(result["error"] is None for result in results)
+
+            record_benchmark(
+                "patients_query",
+                patients=PATIENTS,
+                concurrency=concurrency,
+                llm_latency_seconds=LLM_LATENCY_SECONDS,
+                seconds=seconds,
+                patients_per_second=PATIENTS / seconds,
+            )
+    finally:
+        app.dependency_overrides.clear()
@@ -0,0 +1,85 @@
+import gc
+import time
+from statistics import median
+from typing import Callable
+
+import pytest
+
+from app.domain.ehr_ingestion.ehr_context_models import EHRContextItem
+from app.domain.ehr_ingestion.ehr_contexts_service import EHRContextsService
+from app.domain.ehr_ingestion.ehr_models import ElectronicPatientRecord
+from app.domain.ehr_query.ehr_prompt_utils import (
+    Prompt,
+    build_ehr_contexts_selection_prompt,
+    build_grounded_query_output_prompt,
+)
+from tests.benchmarks.conftest import BenchmarkRecorder
+from tests.synthetic_ehr import generate_ehr_payload
+
+HISTORY_SIZE = 500
+SELECTED_ITEMS = 50
+TOKEN_BUDGET = 8000
+ITEM_MAX_TOKENS = 200
+RUNS = 7
+
+QUESTION = "¿Cómo ha evolucionado su hemoglobina glicosilada?"
+
+
+def median_seconds(run: Callable[[], Prompt]) -> tuple[float, Prompt]:
+    """Median duration of RUNS calls, and the prompt of the last one."""
+    durations = []
+    for _ in range(RUNS):
+        gc.collect()
+        started = time.perf_counter()
+        prompt = run()
+        durations.append(time.perf_counter() - started)
+
+    return median(durations), prompt
+
+
+@pytest.mark.benchmark
+def test_prompts_from_stored_fragments(
+    record_benchmark: BenchmarkRecorder,
+) -> None:
+    stored = EHRContextsService.build_ehr_context_items(
+        ElectronicPatientRecord.model_validate(
+            generate_ehr_payload(
+                "P000001", seed=5, visits=HISTORY_SIZE, lab_results=HISTORY_SIZE
+            )
+        )
+    )
+    # As read back from rows ingested before fragments were stored
+    rendered = [item.model_copy(update={"prompt_fragment": None}) for item in stored]
+    selected = slice(0, SELECTED_ITEMS)
+
+    stages: dict[str, Callable[[list[EHRContextItem]], Prompt]] = {
+        "selection_prompt": lambda items: build_ehr_contexts_selection_prompt(
+            QUESTION, items, token_budget=None, item_max_tokens=ITEM_MAX_TOKENS
+        ),
+        "budgeted_selection_prompt": lambda items: build_ehr_contexts_selection_prompt(
+            QUESTION, items, token_budget=TOKEN_BUDGET, item_max_tokens=ITEM_MAX_TOKENS
+        ),
+        "answer_prompt": lambda items: build_grounded_query_output_prompt(
+            QUESTION, items[selected]
+        ),
+    }
+    for stage, build in stages.items():
+        before_seconds, before = median_seconds(lambda: build(rendered))
+        after_seconds, after = median_seconds(lambda: build(stored))
+
+        # The same prompt, and the summed token counts are the counts of it
+        assert after.text == before.text
+        assert after.tokens == before.tokens
+        assert [item.id for item in after.ehr_context_items] == [
+            item.id for item in before.ehr_context_items
+        ]
+
+        record_benchmark(
+            stage,
+            items=len(stored),
+            prompt_tokens=after.tokens,
+            milliseconds_before=before_seconds * 1000,
+            milliseconds_after=after_seconds * 1000,
+            speedup=before_seconds / after_seconds,
+        )
+        assert after_seconds < before_seconds
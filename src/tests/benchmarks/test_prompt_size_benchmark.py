@@ -0,0 +1,122 @@
+from statistics import mean
+
+import pytest
+
+from app.domain.ehr_ingestion.ehr_context_models import EHRContextItem
+from app.domain.ehr_ingestion.ehr_contexts_service import EHRContextsService
+from app.domain.ehr_ingestion.ehr_models import ElectronicPatientRecord
+from app.domain.ehr_query.ehr_prompt_utils import (
+    build_ehr_contexts_selection_prompt,
+    build_grounded_query_output_prompt,
+)
+from app.domain.llm.token_counter import count_tokens
+from tests.benchmarks.conftest import BenchmarkRecorder
+from tests.benchmarks.test_lexical_prefilter_recall import LABELLED_QUESTIONS
+from tests.synthetic_ehr import generate_ehr_payload
+
+HISTORY_SIZES = [10, 100, 300]
+TOKEN_BUDGET = 8000
+
+
+def render_legacy_contexts(items: list[EHRContextItem], answer: bool) -> str:
+    # The item rendering of the prompts before they were compacted: full UUIDs,
+    # dict reprs, and in the answer prompt the data twice
+    lines = []
+    for item in items:
+        if answer:
+            lines.append(f"- id: {item.id}\n")
+            lines.append(f"\ttipo: {item.type}\n")
+            lines.append(f"\tcontenido: {item.content}")
+            lines.append(f"\tdatos: {item.data}")
+            lines.append(f"\tfuente/referencia: {item.data}")
+        else:
+            lines.append("")
+            lines.append(f"- id: {item.id}")
+            lines.append(f"\ttipo: {item.type}")
+            lines.append(f"\tcontenido: {item.content}")
+            lines.append(f"\tdatos: {item.data}")
+    return "\n".join(lines)
+
+
+@pytest.mark.benchmark
+def test_compact_prompts_size_and_selected_items_kept(
+    record_benchmark: BenchmarkRecorder,
+) -> None:
+    for size in HISTORY_SIZES:
+        items = EHRContextsService.build_ehr_context_items(
+            ElectronicPatientRecord.model_validate(
+                generate_ehr_payload("P000001", seed=3, visits=size, lab_results=size)
+            )
+        )
+
+        selection_reductions = []
+        answer_reductions = []
+        answer_contexts_reductions = []
+        selected_kept = []
+        budgeted_tokens = []
+        for labelled in LABELLED_QUESTIONS:
+            # Stands in for the LLM selection step
+            selected = [item for item in items if labelled.is_relevant(item)]
+            if not selected:
+                # Small histories may have nothing the question is about
+                continue
+
+            selection_prompt = build_ehr_contexts_selection_prompt(
+                labelled.question, items
+            )
+            selection_header = selection_prompt.text.split("Contextos:")[0]
+            selection_reductions.append(
+                1
+                - count_tokens(selection_prompt.text)
+                / count_tokens(
+                    selection_header + render_legacy_contexts(items, answer=False)
+                )
+            )
+
+            answer_prompt = build_grounded_query_output_prompt(
+                labelled.question, selected
+            )
+            answer_header = answer_prompt.text.split("Información del paciente:")[0]
+            legacy_answer_contexts = count_tokens(
+                render_legacy_contexts(selected, answer=True)
+            )
+            answer_contexts = count_tokens(answer_prompt.text) - count_tokens(
+                answer_header
+            )
+            answer_reductions.append(
+                1
+                - count_tokens(answer_prompt.text)
+                / (count_tokens(answer_header) + legacy_answer_contexts)
+            )
+            answer_contexts_reductions.append(
+                1 - answer_contexts / legacy_answer_contexts
+            )
+
+            # No item the selection chose is dropped from the answer prompt
+            assert all(item.content in answer_prompt.text for item in selected)
+
+            budgeted = build_ehr_contexts_selection_prompt(
+                labelled.question, items, token_budget=TOKEN_BUDGET
+            )
+            assert budgeted.tokens <= TOKEN_BUDGET
+            budgeted_tokens.append(budgeted.tokens)
+            kept = {item.id for item in budgeted.ehr_context_items}
+            selected_kept.append(
+                sum(item.id in kept for item in selected) / len(selected)
+            )
+
+        record_benchmark(
+            "compact_prompts",
+            items=len(items),
+            selection_prompt_tokens=count_tokens(selection_prompt.text),
+            selection_tokens_saved=mean(selection_reductions),
+            answer_tokens_saved=mean(answer_reductions),
+            answer_context_tokens_saved=mean(answer_contexts_reductions),
+            budget=TOKEN_BUDGET,
+            budgeted_selection_tokens=max(budgeted_tokens),
+            selected_items_within_budget=mean(selected_kept),
+        )
+
+        assert mean(selection_reductions) > 0.3
+        # The answer prompt is mostly its fixed instructions and examples
+        assert mean(answer_contexts_reductions) > 0.5
@@ -0,0 +1,118 @@
+import asyncio
+import time
+from http import HTTPStatus
+from statistics import median
+from typing import Type, TypeVar, cast, override
+
+import pytest
+from fastapi import FastAPI
+from httpx import AsyncClient
+from pydantic import BaseModel
+
+from app.api.dependencies import get_llm_client
+from app.domain.ehr_query.ehr_query_models import (
+    EHRAnswerWithContextAliases,
+    EHRContextAliases,
+)
+from app.domain.llm.llm_client import LLMClient
+from app.domain.llm.token_counter import count_tokens
+from tests.api.test_ehr_ingestion_tasks_api import ingest_ehr_and_wait
+from tests.benchmarks.conftest import BenchmarkRecorder
+from tests.synthetic_ehr import generate_ehr_payload
+from tools.fake_openai_server import ALIAS_PATTERN, FakeOpenAIConfig
+
+# Visits and lab results of each patient
+HISTORY_SIZES = [5, 50]
+MODES = ["two_calls", "single_call"]
+RUNS = 5
+
+QUESTION = "¿Cómo ha evolucionado su hemoglobina glicosilada?"
+
+# The stand-in server's defaults: a fixed time to first token, then the output
+# at a fixed rate
+LLM_CONFIG = FakeOpenAIConfig(latency="fixed")
+
+T = TypeVar("T")
+
+
+class StandInLLMClient(LLMClient):
+    """Responds as tools.fake_openai_server does, without the HTTP round-trip:
+    after the time to first token and the generation of the output."""
+
+    def __init__(self, config: FakeOpenAIConfig) -> None:
+        self._config = config
+        self.calls = 0
+
+    @override
+    async def run_structured(self, *, prompt: str, response_model: Type[T]) -> T:
+        aliases = [int(alias) for alias in ALIAS_PATTERN.findall(prompt)][:3]
+        response: BaseModel = (
+            EHRAnswerWithContextAliases(answer=self._config.answer, ids=aliases)
+            if response_model is EHRAnswerWithContextAliases
+            else EHRContextAliases(ids=aliases)
+        )
+        await self._respond(response.model_dump_json())
+        return cast(T, response)
+
+    @override
+    async def run(self, *, prompt: str) -> str:
+        await self._respond(self._config.answer)
+        return self._config.answer
+
+    async def _respond(self, output: str) -> None:
+        self.calls += 1
+        await asyncio.sleep(
+            self._config.latency_ms / 1000
+            + count_tokens(output) / self._config.tokens_per_second
+        )
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_query_latency_by_mode(
+    app: FastAPI,
+    client: AsyncClient,
+    record_benchmark: BenchmarkRecorder,
+) -> None:
+    llm_client = StandInLLMClient(LLM_CONFIG)
+    app.dependency_overrides[get_llm_client] = lambda: llm_client
+
+    try:
+        for size in HISTORY_SIZES:
+            patient_id = f"MODES{size:04d}"
+            await ingest_ehr_and_wait(
+                client,
+                generate_ehr_payload(
+                    patient_id, seed=size, visits=size, lab_results=size
+                ),
+            )
+
+            latencies = {}
+            for mode in MODES:
+                durations = []
+                llm_client.calls = 0
+                for _ in range(RUNS):
+                    started = time.perf_counter()
+                    response = await client.post(
+                        f"/api/ehr-query/{patient_id}/query",
+                        params={"mode": mode},
+                        json={"query": QUESTION},
+                    )
+                    durations.append(time.perf_counter() - started)
+                    assert response.status_code == HTTPStatus.OK
+                    assert response.json()["references"]
+
+                latencies[mode] = median(durations)
+                prompt_tokens = response.headers["X-Prompt-Tokens"].split(", ")
+                record_benchmark(
+                    mode,
+                    history_size=size,
+                    llm_calls_per_query=llm_client.calls / RUNS,
+                    prompt_tokens=sum(map(int, prompt_tokens)),
+                    median_milliseconds=latencies[mode] * 1000,
+                )
+
+            # One time to first token less, the output is about the same
+            assert latencies["single_call"] < latencies["two_calls"]
+    finally:
+        app.dependency_overrides.clear()
@@ -0,0 +1,112 @@
+import time
+from statistics import median
+from typing import Awaitable, Callable, cast
+
+import asyncpg
+import pytest
+from fastapi import FastAPI
+
+from app.domain.ehr_ingestion.ehr_contexts_repository import EhrContextsRepository
+from app.domain.ehr_ingestion.ehr_contexts_service import EHRContextsService
+from app.domain.ehr_ingestion.ehr_models import ElectronicPatientRecord
+from app.domain.ehr_query.ehr_prompt_utils import (
+    build_ehr_contexts_selection_prompt,
+    build_grounded_query_output_prompt,
+)
+from app.infrastructure.llm.hashing_embedding_client import HashingEmbeddingClient
+from tests.benchmarks.conftest import BenchmarkRecorder
+from tests.synthetic_ehr import generate_ehr_payload_of_size
+
+ITEM_COUNTS = [10, 100, 1_000, 10_000]
+RUNS = 5
+
+QUESTION = "¿Cuál es la medicación actual del paciente?"
+
+
+async def median_seconds(run: Callable[[int], Awaitable[object]]) -> float:
+    """Median duration of RUNS calls, each given its run number."""
+    durations = []
+    for i in range(RUNS):
+        started = time.perf_counter()
+        await run(i)
+        durations.append(time.perf_counter() - started)
+
+    return median(durations)
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_repository_and_prompt_builders_by_patient_size(
+    app: FastAPI,
+    record_benchmark: BenchmarkRecorder,
+) -> None:
+    pool: asyncpg.Pool = app.state.pool
+
+    for count in ITEM_COUNTS:
+        payloads = [
+            generate_ehr_payload_of_size(f"S{count}-{i}", count, seed=i)
+            for i in range(RUNS)
+        ]
+        records = [ElectronicPatientRecord.model_validate(p) for p in payloads]
+
+        def record(operation: str, seconds: float) -> None:
+            record_benchmark(
+                operation,
+                items=count,
+                seconds=seconds,
+                items_per_second=count / seconds,
+            )
+
+        async with pool.acquire() as conn:
+            repository = EhrContextsRepository(conn=cast(asyncpg.Connection, conn))
+            service = EHRContextsService(
+                repository, embedding_client=HashingEmbeddingClient()
+            )
+
+            # A new patient each run: decomposition, embeddings and inserts
+            async def ingest(i: int) -> object:
+                return await service.ingest_ehr(records[i])
+
+            record("ingest_ehr", await median_seconds(ingest))
+
+            items_by_run = [
+                EHRContextsService.build_ehr_context_items(
+                    ElectronicPatientRecord.model_validate(
+                        {**payload, "patient_id": f"I{count}-{i}"}
+                    )
+                )
+                for i, payload in enumerate(payloads)
+            ]
+
+            async def insert_many(i: int) -> None:
+                await repository.insert_many(items_by_run[i])
+
+            record("insert_many", await median_seconds(insert_many))
+
+            async def list_by_patient(i: int) -> object:
+                return await repository.list_by_patient(records[i].patient_id)
+
+            record("list_by_patient", await median_seconds(list_by_patient))
+
+            rows = await conn.fetch(
+                "SELECT * FROM ehr_patient_context WHERE patient_id = $1",
+                records[0].patient_id,
+            )
+            assert len(rows) == count
+
+        async def row_to_context_item(i: int) -> object:
+            return [EhrContextsRepository._row_to_context_item(row) for row in rows]
+
+        record("row_to_context_item", await median_seconds(row_to_context_item))
+
+        items = items_by_run[0]
+
+        async def selection_prompt(i: int) -> object:
+            return build_ehr_contexts_selection_prompt(QUESTION, items)
+
+        record("selection_prompt", await median_seconds(selection_prompt))
+
+        async def answer_prompt(i: int) -> object:
+            return build_grounded_query_output_prompt(QUESTION, items)
+
+        record("answer_prompt", await median_seconds(answer_prompt))
@@ -0,0 +1,154 @@
+import gc
+import json
+import time
+from statistics import median
+from typing import Any, Awaitable, Callable, Sequence, cast
+
+import asyncpg
+import pytest
+from fastapi import FastAPI
+from pydantic import BaseModel, TypeAdapter
+
+from app.api.api_response_models import orjson_response
+from app.core.app_settings import get_app_settings
+from app.domain.ehr_ingestion.ehr_context_models import (
+    EHRContextItem,
+    EHRContextItemsFilter,
+    EHRContextSource,
+)
+from app.domain.ehr_ingestion.ehr_contexts_repository import EhrContextsRepository
+from app.domain.ehr_ingestion.ehr_contexts_service import EHRContextsService
+from app.domain.ehr_ingestion.ehr_models import ElectronicPatientRecord
+from tests.benchmarks.conftest import BenchmarkRecorder
+from tests.synthetic_ehr import generate_ehr_payload_of_size
+
+ITEMS = 10_000
+RUNS = 5
+
+PATIENT_ID = "ROWS"
+
+
+class SequenceResponse(BaseModel):
+    """The listing response before, with a Sequence of items."""
+
+    items: Sequence[EHRContextItem]
+    total: int
+
+
+def validated_row_to_context_item(row: asyncpg.Record) -> EHRContextItem:
+    """How rows were decoded before: JSONB parsed by hand and every model
+    validated."""
+    data = row["data"]
+    if isinstance(data, str):
+        data = json.loads(data)
+
+    return EHRContextItem(
+        id=row["id"],
+        patient_id=row["patient_id"],
+        type=row["type"],
+        content=row["content"],
+        data=data,
+        source=EHRContextSource(
+            type=row["source_type"],
+            recorded_at=row["source_recorded_at"],
+            recorded_by=row["source_recorded_by"],
+        ),
+        created_at=row["created_at"],
+        item_key=row["item_key"],
+        content_hash=row["content_hash"],
+        embedding=row["embedding"],
+    )
+
+
+async def median_seconds(run: Callable[[], Awaitable[Any]]) -> tuple[float, Any]:
+    """Median duration of RUNS calls, and the result of the last one."""
+    durations = []
+    for _ in range(RUNS):
+        # Garbage left by the previous run would otherwise be collected during
+        # the next one
+        gc.collect()
+        started = time.perf_counter()
+        result = await run()
+        durations.append(time.perf_counter() - started)
+
+    return median(durations), result
+
+
+def by_id(items: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    return sorted(items, key=lambda item: item["id"])
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_row_decoding_of_a_large_patient(
+    app: FastAPI,
+    record_benchmark: BenchmarkRecorder,
+) -> None:
+    pool: asyncpg.Pool = app.state.pool
+    record = ElectronicPatientRecord.model_validate(
+        generate_ehr_payload_of_size(PATIENT_ID, ITEMS)
+    )
+
+    # A plain connection returns JSONB as text, as before the pool's codec
+    plain_conn = await asyncpg.connect(get_app_settings().database_url)
+
+    try:
+        async with pool.acquire() as conn:
+            repository = EhrContextsRepository(conn=cast(asyncpg.Connection, conn))
+            await EHRContextsService(repository).ingest_ehr(record)
+
+            # Reading a patient's models, as queries and the contexts cache do
+            async def read_models_before() -> list[EHRContextItem]:
+                rows = await plain_conn.fetch(
+                    "SELECT * FROM ehr_patient_context WHERE patient_id = $1",
+                    PATIENT_ID,
+                )
+                return [validated_row_to_context_item(row) for row in rows]
+
+            # The columns read before: prompt fragments did not exist yet, both
+            # sides leave them None
+            async def read_models_after() -> list[EHRContextItem]:
+                return await repository.list_by_patient(PATIENT_ID, embeddings=True)
+
+            # Listing the patient in one page, up to the response body
+            async def listing_before() -> bytes:
+                items = await read_models_before()
+                # FastAPI validates the returned model against the response_model
+                adapter = TypeAdapter(SequenceResponse)
+                return adapter.dump_json(
+                    adapter.validate_python(SequenceResponse(items=items, total=ITEMS))
+                )
+
+            async def listing_after() -> bytes:
+                items, _ = await repository.list_page_by_patient(
+                    PATIENT_ID, filter=EHRContextItemsFilter(), limit=ITEMS
+                )
+                return bytes(orjson_response({"items": items, "total": ITEMS}).body)
+
+            stages = {
+                "read_models": (read_models_before, read_models_after),
+                "listing_response": (listing_before, listing_after),
+            }
+            for stage, (before, after) in stages.items():
+                before_seconds, before_result = await median_seconds(before)
+                after_seconds, after_result = await median_seconds(after)
+
+                if stage == "read_models":
+                    assert sorted(before_result, key=lambda item: item.id) == sorted(
+                        after_result, key=lambda item: item.id
+                    )
+                else:
+                    assert by_id(json.loads(before_result)["items"]) == by_id(
+                        json.loads(after_result)["items"]
+                    )
+
+                record_benchmark(
+                    stage,
+                    items=ITEMS,
+                    rows_per_second_before=ITEMS / before_seconds,
+                    rows_per_second_after=ITEMS / after_seconds,
+                    speedup=before_seconds / after_seconds,
+                )
+                assert after_seconds < before_seconds
+    finally:
+        await plain_conn.close()
@@ -0,0 +1,67 @@
+import json
+import re
+
+import pytest
+
+from app.domain.ehr_ingestion.ehr_contexts_service import EHRContextsService
+from app.domain.ehr_ingestion.ehr_models import ElectronicPatientRecord
+from app.domain.ehr_query.ehr_prompt_utils import build_ehr_contexts_selection_prompt
+from app.domain.ehr_query.ehr_query_models import EHRContextAliases
+from app.domain.llm.token_counter import count_tokens
+from tests.benchmarks.conftest import BenchmarkRecorder
+from tests.benchmarks.test_lexical_prefilter_recall import LABELLED_QUESTIONS
+from tests.synthetic_ehr import generate_ehr_payload
+
+HISTORY_SIZES = [10, 50, 200]
+
+# Output tokens are generated one at a time, so their count drives latency far
+# more than input tokens. The rate is an assumption for a small hosted model:
+# it turns token savings into indicative time savings, not a measured latency.
+ASSUMED_OUTPUT_TOKENS_PER_SECOND = 80
+
+
+@pytest.mark.benchmark
+def test_selection_aliases_token_savings(record_benchmark: BenchmarkRecorder) -> None:
+    for size in HISTORY_SIZES:
+        items = EHRContextsService.build_ehr_context_items(
+            ElectronicPatientRecord.model_validate(
+                generate_ehr_payload("A000001", seed=5, visits=size, lab_results=size)
+            )
+        )
+
+        for labelled in LABELLED_QUESTIONS:
+            prompt = build_ehr_contexts_selection_prompt(labelled.question, items)
+            selected = [
+                (alias, item)
+                for alias, item in enumerate(prompt.ehr_context_items, 1)
+                if labelled.is_relevant(item)
+            ]
+
+            # The same prompt and output, listing the items by UUID
+            uuid_prompt = re.sub(
+                r"^- id: (\d+) \|",
+                lambda match: f"- id: {items[int(match[1]) - 1].id} |",
+                prompt.text,
+                flags=re.MULTILINE,
+            )
+            uuid_output = json.dumps({"ids": [str(item.id) for _, item in selected]})
+            alias_output = EHRContextAliases(
+                ids=[alias for alias, _ in selected]
+            ).model_dump_json()
+
+            output_tokens_saved = count_tokens(uuid_output) - count_tokens(alias_output)
+            record_benchmark(
+                "selection_aliases",
+                items=len(items),
+                question=labelled.question,
+                selected=len(selected),
+                input_tokens_uuid=count_tokens(uuid_prompt),
+                input_tokens_alias=prompt.tokens,
+                output_tokens_uuid=count_tokens(uuid_output),
+                output_tokens_alias=count_tokens(alias_output),
+                estimated_seconds_saved=output_tokens_saved
+                / ASSUMED_OUTPUT_TOKENS_PER_SECOND,
+            )
+
+            assert count_tokens(alias_output) <= count_tokens(uuid_output)
+            assert prompt.tokens < count_tokens(uuid_prompt)
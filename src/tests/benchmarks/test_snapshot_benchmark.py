@@ -0,0 +1,159 @@
+import gc
+import time
+from statistics import median
+from typing import Any, Awaitable, Callable, cast
+
+import asyncpg
+import orjson
+import pytest
+from fastapi import FastAPI
+
+from app.api.api_response_models import (
+    PaginatedResourcesResponse,
+    model_json_response,
+)
+from app.domain.ehr_ingestion.ehr_context_models import EHRContextItem
+from app.domain.ehr_ingestion.ehr_contexts_repository import EhrContextsRepository
+from app.domain.ehr_ingestion.ehr_contexts_service import EHRContextsService
+from app.domain.ehr_ingestion.ehr_models import ElectronicPatientRecord
+from app.infrastructure.llm.hashing_embedding_client import HashingEmbeddingClient
+from tests.benchmarks.conftest import BenchmarkRecorder
+from tests.synthetic_ehr import generate_ehr_payload_of_size
+
+PATIENT_SIZES = [5_000, 20_000]
+RUNS = 5
+
+
+async def median_seconds(run: Callable[[], Awaitable[Any]]) -> tuple[float, Any]:
+    """Median duration of RUNS calls, and the result of the last one."""
+    durations = []
+    for _ in range(RUNS):
+        gc.collect()
+        started = time.perf_counter()
+        result = await run()
+        durations.append(time.perf_counter() - started)
+
+    return median(durations), result
+
+
+def comparable(item: EHRContextItem) -> tuple[Any, ...]:
+    # Snapshots leave out the ingestion bookkeeping fields
+    return item.model_dump_json(), item.embedding, item.prompt_fragment
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_snapshot_reads_of_large_patients(
+    app: FastAPI,
+    record_benchmark: BenchmarkRecorder,
+) -> None:
+    pool: asyncpg.Pool = app.state.pool
+
+    async with pool.acquire() as conn:
+        repository = EhrContextsRepository(conn=cast(asyncpg.Connection, conn))
+        service = EHRContextsService(
+            repository, embedding_client=HashingEmbeddingClient()
+        )
+
+        for size in PATIENT_SIZES:
+            patient_id = f"SNAPSHOT{size}"
+            await service.ingest_ehr(
+                ElectronicPatientRecord.model_validate(
+                    generate_ehr_payload_of_size(patient_id, size)
+                )
+            )
+
+            # What the database sends: one row per item, or the snapshot row
+            async def fetch_before() -> int:
+                rows = await conn.fetch(
+                    "SELECT * FROM ehr_patient_context WHERE patient_id = $1",
+                    patient_id,
+                )
+                return len(rows)
+
+            async def fetch_after() -> int:
+                row = await conn.fetchrow(
+                    "SELECT * FROM ehr_patient_context_snapshot WHERE patient_id = $1",
+                    patient_id,
+                )
+                assert row is not None
+                return int(row["item_count"])
+
+            # Reading the patient's models, as queries and the contexts cache do
+            async def read_models_before() -> list[EHRContextItem]:
+                return await repository.list_by_patient(
+                    patient_id, embeddings=True, prompt_fragments=True
+                )
+
+            async def read_models_after() -> list[EHRContextItem]:
+                snapshot = await repository.get_snapshot(patient_id)
+                assert snapshot is not None
+                return snapshot.items
+
+            # The whole listing up to the response body, on a cache miss
+            async def listing_before() -> bytes:
+                items = await repository.list_by_patient(patient_id)
+                return bytes(
+                    model_json_response(
+                        PaginatedResourcesResponse[EHRContextItem].model_construct(
+                            items=items, total=len(items)
+                        )
+                    ).body
+                )
+
+            async def listing_after() -> bytes:
+                serialized = await repository.get_serialized_snapshot_items(patient_id)
+                assert serialized is not None
+                return b'{"items":%s,"total":%d,"next_cursor":null}' % serialized
+
+            stages = {
+                "fetch": (fetch_before, fetch_after),
+                "read_models": (read_models_before, read_models_after),
+                "listing_response": (listing_before, listing_after),
+            }
+            for stage, (before, after) in stages.items():
+                before_seconds, before_result = await median_seconds(before)
+                after_seconds, after_result = await median_seconds(after)
+
+                if stage == "fetch":
+                    assert before_result == after_result == size
+                elif stage == "read_models":
+                    assert sorted(map(comparable, before_result)) == sorted(
+                        map(comparable, after_result)
+                    )
+                else:
+                    assert orjson.loads(before_result) == orjson.loads(after_result)
+
+                record_benchmark(
+                    stage,
+                    items=size,
+                    milliseconds_before=before_seconds * 1000,
+                    milliseconds_after=after_seconds * 1000,
+                    speedup=before_seconds / after_seconds,
+                )
+                # Building the models dominates reading them either way, both
+                # take about as long: only recorded
+                if stage != "read_models":
+                    assert after_seconds < before_seconds
+
+            sizes = await conn.fetchrow(
+                """
+                SELECT
+                    pg_column_size(items) + pg_column_size(prompt_fragments)
+                        + coalesce(pg_column_size(embeddings), 0),
+                    octet_length(items) + octet_length(prompt_fragments)
+                        + coalesce(octet_length(embeddings), 0)
+                FROM ehr_patient_context_snapshot
+                WHERE patient_id = $1
+                """,
+                patient_id,
+            )
+            assert sizes is not None
+            stored_bytes, raw_bytes = sizes
+            record_benchmark(
+                "snapshot_size",
+                items=size,
+                stored_bytes=stored_bytes,
+                raw_bytes=raw_bytes,
+                compression_ratio=raw_bytes / stored_bytes,
+            )
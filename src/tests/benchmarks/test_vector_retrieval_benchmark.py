@@ -0,0 +1,84 @@
+import time
+from statistics import mean, median
+
+import pytest
+
+from app.domain.ehr_ingestion.ehr_contexts_service import EHRContextsService
+from app.domain.ehr_ingestion.ehr_models import ElectronicPatientRecord
+from app.domain.ehr_query.ehr_contexts_prefilter import EHRContextsPrefilter
+from app.domain.ehr_query.ehr_lexical_ranker import (
+    LexicalEHRContextsPrefilter,
+    ehr_context_item_search_text,
+)
+from app.domain.ehr_query.ehr_vector_retriever import VectorEHRContextsPrefilter
+from app.domain.llm.embedding_client import encode_embedding
+from app.infrastructure.llm.hashing_embedding_client import HashingEmbeddingClient
+from tests.benchmarks.conftest import BenchmarkRecorder
+from tests.benchmarks.test_lexical_prefilter_recall import LABELLED_QUESTIONS
+from tests.synthetic_ehr import generate_ehr_payload
+
+CONTEXT_COUNTS = [100, 1_000, 5_000, 10_000]
+TOP_K = 40
+RUNS = 20
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_vector_retrieval_latency_by_context_count(
+    record_benchmark: BenchmarkRecorder,
+) -> None:
+    embedding_client = HashingEmbeddingClient()
+    prefilters: dict[str, EHRContextsPrefilter] = {
+        "vector": VectorEHRContextsPrefilter(
+            embedding_client, top_k=TOP_K, bypass_max_items=0
+        ),
+        "lexical": LexicalEHRContextsPrefilter(top_k=TOP_K, bypass_max_items=0),
+    }
+    question = LABELLED_QUESTIONS[0].question
+
+    for count in CONTEXT_COUNTS:
+        items = EHRContextsService.build_ehr_context_items(
+            ElectronicPatientRecord.model_validate(
+                generate_ehr_payload(
+                    "V000001", seed=1, visits=count // 2, lab_results=count // 2
+                )
+            )
+        )
+
+        # As stored at ingestion
+        embeddings = await embedding_client.embed(
+            [ehr_context_item_search_text(item) for item in items]
+        )
+        for item, embedding in zip(items, embeddings):
+            item.embedding = encode_embedding(embedding)
+
+        for name, prefilter in prefilters.items():
+            durations = []
+            for _ in range(RUNS):
+                started = time.perf_counter()
+                await prefilter.narrow(question, items)
+                durations.append(time.perf_counter() - started)
+
+            recalls = []
+            for labelled in LABELLED_QUESTIONS:
+                relevant = {item.id for item in items if labelled.is_relevant(item)}
+                kept = {
+                    item.id for item in await prefilter.narrow(labelled.question, items)
+                }
+                recalls.append(
+                    len(relevant & kept) / min(len(relevant), TOP_K)
+                    if relevant
+                    else 1.0
+                )
+
+            record_benchmark(
+                f"{name}_retrieval",
+                items=len(items),
+                top_k=TOP_K,
+                p50_ms=median(durations) * 1000,
+                max_ms=max(durations) * 1000,
+                mean_recall_at_k=mean(recalls),
+            )
+
+            if name == "vector":
+                assert median(durations) < 0.1
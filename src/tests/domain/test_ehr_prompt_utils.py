@@ -0,0 +1,94 @@
+from datetime import date
+
+from app.domain.ehr_ingestion.ehr_context_models import EHRContextItem, EHRContextType
+from app.domain.ehr_ingestion.ehr_contexts_service import EHRContextsService
+from app.domain.ehr_ingestion.ehr_models import ElectronicPatientRecord
+from app.domain.ehr_query.ehr_prompt_utils import (
+    _fit_to_token_budget,
+    build_ehr_contexts_selection_prompt,
+    build_grounded_query_output_prompt,
+)
+from tests.api.test_ehr_ingestion_tasks_api import EHR_PAYLOAD_1
+
+QUESTION = "¿Es alérgico a la penicilina?"
+
+
+def build_items() -> list[EHRContextItem]:
+    return EHRContextsService.build_ehr_context_items(
+        ElectronicPatientRecord.model_validate(EHR_PAYLOAD_1)
+    )
+
+
+def test_fit_to_token_budget_keeps_the_best_matches_in_their_order() -> None:
+    items = build_items()
+
+    # Everything fits
+    assert _fit_to_token_budget(
+        QUESTION, items, item_tokens=[1] * len(items), token_budget=len(items)
+    ) == list(range(len(items)))
+
+    # The allergy is the only match, the other slot goes to an undated item
+    # ahead of the dated ones
+    kept = _fit_to_token_budget(
+        QUESTION, items, item_tokens=[1] * len(items), token_budget=2
+    )
+    assert len(kept) == 2
+    assert kept == sorted(kept)
+    assert items[kept[0]].type == EHRContextType.DEMOGRAPHICS
+    assert items[kept[1]].type == EHRContextType.ALLERGY
+
+    # Among items that match nothing, the most recent ones
+    dated = [item for item in items if item.source.recorded_at is not None]
+    kept = _fit_to_token_budget(
+        "¿Qué más?", dated, item_tokens=[1] * len(dated), token_budget=2
+    )
+    assert [dated[i].source.recorded_at for i in kept] == [
+        date(2024, 10, 15),
+        date(2024, 10, 10),
+    ]
+
+
+def test_fit_to_token_budget_skips_items_larger_than_what_is_left() -> None:
+    items = build_items()
+    allergy = next(i for i, item in enumerate(items) if item.type == "allergy")
+
+    item_tokens = [1] * len(items)
+    item_tokens[allergy] = 10
+
+    kept = _fit_to_token_budget(QUESTION, items, item_tokens, token_budget=5)
+    assert allergy not in kept
+    assert len(kept) == 5
+
+
+def test_selection_prompt_stays_within_its_token_budget() -> None:
+    items = build_items()
+    header_tokens = build_ehr_contexts_selection_prompt(QUESTION, []).tokens
+
+    prompt = build_ehr_contexts_selection_prompt(
+        QUESTION, items, token_budget=header_tokens + 40
+    )
+
+    assert prompt.tokens <= header_tokens + 40
+    assert 0 < len(prompt.ehr_context_items) < len(items)
+    assert any(item.type == "allergy" for item in prompt.ehr_context_items)
+    # Aliases are only given to the listed items
+    assert prompt.text.count("- id: ") == len(prompt.ehr_context_items)
+
+
+def test_only_the_selection_prompt_truncates_items() -> None:
+    items = build_items()
+    visit = next(item for item in items if item.type == "visit")
+    assert visit.prompt_fragment is not None
+    full_line = visit.prompt_fragment.text
+
+    selection_prompt = build_ehr_contexts_selection_prompt(
+        QUESTION, items, item_max_tokens=8
+    )
+    assert full_line not in selection_prompt.text
+    assert f"| {full_line[:10]}" in selection_prompt.text
+    assert "…" in selection_prompt.text
+
+    # Every item the selection chose reaches the answer whole
+    answer_prompt = build_grounded_query_output_prompt(QUESTION, [visit])
+    assert f"- {full_line}" in answer_prompt.text
+    assert answer_prompt.ehr_context_items == [visit]
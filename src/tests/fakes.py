@@ -0,0 +1,71 @@
+import asyncio
+import re
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Type,
+    TypeVar,
+    cast,
+    override,
+)
+
+from app.domain.llm.llm_client import LLMClient
+
+T = TypeVar("T")
+
+
+class FakeLLMClient(LLMClient):
+    """Offline stand-in for a real LLM with a configurable response latency.
+    The answer can depend on the prompt (and raise to simulate a failure).
+    Streamed answers come word by word, chunk_delay_seconds apart."""
+
+    def __init__(
+        self,
+        *,
+        structured_response: Callable[[str, Type[Any]], Any],
+        answer: str | Callable[[str], str] = "Respuesta de prueba.",
+        delay_seconds: float = 0.0,
+        before_response: Callable[[], Awaitable[None]] | None = None,
+        chunk_delay_seconds: float = 0.0,
+    ) -> None:
+        self._structured_response = structured_response
+        self._answer = answer
+        self._delay_seconds = delay_seconds
+        self._before_response = before_response
+        self._chunk_delay_seconds = chunk_delay_seconds
+        self.calls: list[str] = []
+
+    async def _respond(self, prompt: str) -> None:
+        self.calls.append(prompt)
+        if self._before_response is not None:
+            await self._before_response()
+        await asyncio.sleep(self._delay_seconds)
+
+    @override
+    async def run_structured(
+        self,
+        *,
+        prompt: str,
+        response_model: Type[T],
+    ) -> T:
+        await self._respond(prompt)
+        return cast(T, self._structured_response(prompt, response_model))
+
+    @override
+    async def run(self, *, prompt: str) -> str:
+        await self._respond(prompt)
+        return self._answer_to(prompt)
+
+    @override
+    async def stream(self, *, prompt: str) -> AsyncIterator[str]:
+        await self._respond(prompt)
+        for chunk in re.findall(r"\S+\s*", self._answer_to(prompt)):
+            await asyncio.sleep(self._chunk_delay_seconds)
+            yield chunk
+
+    def _answer_to(self, prompt: str) -> str:
+        if isinstance(self._answer, str):
+            return self._answer
+        return self._answer(prompt)
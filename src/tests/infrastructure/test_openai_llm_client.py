@@ -0,0 +1,107 @@
+from typing import Any, AsyncIterator
+
+import pytest
+from openai.types.responses import (
+    Response,
+    ResponseError,
+    ResponseErrorEvent,
+    ResponseFailedEvent,
+    ResponseIncompleteEvent,
+    ResponseStreamEvent,
+    ResponseTextDeltaEvent,
+)
+from openai.types.responses.response import IncompleteDetails
+
+from app.infrastructure.llm.openai_llm_client import OpenAILLMClient
+
+
+def failed_response(**fields: Any) -> Response:
+    return Response.model_validate(
+        {
+            "id": "resp_1",
+            "object": "response",
+            "created_at": 0,
+            "model": "gpt-4.1-mini",
+            "output": [],
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": [],
+            **fields,
+        }
+    )
+
+
+def text_delta(delta: str) -> ResponseTextDeltaEvent:
+    return ResponseTextDeltaEvent(
+        type="response.output_text.delta",
+        item_id="msg_1",
+        output_index=0,
+        content_index=0,
+        delta=delta,
+        logprobs=[],
+        sequence_number=1,
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "failure, message",
+    [
+        (
+            ResponseErrorEvent(
+                type="error",
+                code="server_error",
+                message="Upstream closed",
+                param=None,
+                sequence_number=2,
+            ),
+            "LLM stream failed: Upstream closed",
+        ),
+        (
+            ResponseFailedEvent(
+                type="response.failed",
+                response=failed_response(
+                    status="failed",
+                    error=ResponseError(code="server_error", message="Overloaded"),
+                ),
+                sequence_number=2,
+            ),
+            "LLM response failed: Overloaded",
+        ),
+        (
+            ResponseIncompleteEvent(
+                type="response.incomplete",
+                response=failed_response(
+                    status="incomplete",
+                    incomplete_details=IncompleteDetails(reason="max_output_tokens"),
+                ),
+                sequence_number=2,
+            ),
+            "LLM response incomplete: max_output_tokens",
+        ),
+    ],
+)
+async def test_stream_raises_on_failures_after_the_response_started(
+    monkeypatch: pytest.MonkeyPatch, failure: ResponseStreamEvent, message: str
+) -> None:
+    client = OpenAILLMClient(api_key="test-key")
+
+    async def create(**kwargs: Any) -> AsyncIterator[ResponseStreamEvent]:
+        async def events() -> AsyncIterator[ResponseStreamEvent]:
+            yield text_delta("Sin ")
+            yield failure
+            yield text_delta("alergias.")
+
+        return events()
+
+    monkeypatch.setattr(client._client.responses, "create", create)
+
+    deltas = []
+    try:
+        with pytest.raises(RuntimeError, match=message):
+            async for delta in client.stream(prompt="¿Alergias?"):
+                deltas.append(delta)
+    finally:
+        await client.close()
+
+    assert deltas == ["Sin "]
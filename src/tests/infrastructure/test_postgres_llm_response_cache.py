@@ -0,0 +1,43 @@
+import pytest
+from fastapi import FastAPI
+
+from app.infrastructure.llm.postgres_llm_response_cache import (
+    PostgresLLMResponseCache,
+)
+
+
+@pytest.mark.asyncio
+async def test_writes_prune_the_oldest_entries_past_max_entries(app: FastAPI) -> None:
+    cache = PostgresLLMResponseCache(
+        pool=app.state.pool, max_entries=3, ttl_seconds=60, prune_interval_seconds=0
+    )
+
+    for i in range(5):
+        await cache.set(f"key-{i}", f"value-{i}")
+
+    assert [await cache.get(f"key-{i}") for i in range(5)] == [
+        None,
+        None,
+        "value-2",
+        "value-3",
+        "value-4",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_writes_only_prune_once_per_interval(app: FastAPI) -> None:
+    cache = PostgresLLMResponseCache(
+        pool=app.state.pool, max_entries=1, ttl_seconds=60, prune_interval_seconds=60
+    )
+
+    for i in range(3):
+        await cache.set(f"key-{i}", f"value-{i}")
+
+    count = await app.state.pool.fetchval("SELECT count(*) FROM llm_response_cache")
+    assert count == 3
+
+    await cache.prune()
+
+    assert await cache.get("key-2") == "value-2"
+    count = await app.state.pool.fetchval("SELECT count(*) FROM llm_response_cache")
+    assert count == 1
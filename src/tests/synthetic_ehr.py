@@ -0,0 +1,211 @@
+import random
+from datetime import date, timedelta
+from typing import Any
+
+CHRONIC_CONDITIONS = [
+    "Diabetes Tipo 2",
+    "Hipertensión",
+    "Asma",
+    "Hipotiroidismo",
+    "Dislipidemia",
+    "EPOC",
+    "Insuficiencia renal crónica",
+    "Fibrilación auricular",
+    "Artrosis",
+    "Depresión",
+]
+
+ALLERGIES = [
+    "Penicilina",
+    "Sulfas",
+    "Ibuprofeno",
+    "Látex",
+    "Mariscos",
+    "Aspirina",
+    "Polen",
+    "Yodo",
+]
+
+# Name, possible doses, possible frequencies
+MEDICATIONS = [
+    ("Metformina", ["500mg", "850mg", "1000mg"], ["1x/día", "2x/día"]),
+    ("Losartán", ["25mg", "50mg", "100mg"], ["1x/día"]),
+    ("Atorvastatina", ["10mg", "20mg", "40mg"], ["1x/día"]),
+    ("Levotiroxina", ["50mcg", "75mcg", "100mcg"], ["1x/día"]),
+    ("Salbutamol", ["100mcg"], ["a demanda", "cada 6 horas"]),
+    ("Omeprazol", ["20mg", "40mg"], ["1x/día"]),
+    ("Enalapril", ["5mg", "10mg", "20mg"], ["1x/día", "2x/día"]),
+    ("Amlodipino", ["5mg", "10mg"], ["1x/día"]),
+    ("Insulina glargina", ["10UI", "20UI", "30UI"], ["1x/día"]),
+    ("Sertralina", ["50mg", "100mg"], ["1x/día"]),
+    ("Apixabán", ["2.5mg", "5mg"], ["2x/día"]),
+    ("Paracetamol", ["500mg", "1g"], ["cada 8 horas", "a demanda"]),
+]
+
+# Reason and notes, which may include vitals sampled per visit
+VISIT_REASONS = [
+    ("Control rutinario", "Paciente estable. Se mantiene tratamiento."),
+    ("Consulta por mareos", "Paciente reporta mareos ocasionales. ECG normal."),
+    ("Dolor torácico", "Dolor atípico. Se solicitan estudios."),
+    ("Control de glucosa", "Glucosa en ayunas: {glucose} mg/dL. Se ajusta dosis."),
+    ("Control de presión arterial", "TA {systolic}/{diastolic} mmHg en consulta."),
+    ("Cuadro respiratorio", "Tos y congestión de {days} días. Sin fiebre."),
+    ("Dolor articular", "Dolor en rodillas. Se indica analgesia y reposo relativo."),
+    ("Renovación de recetas", "Sin cambios en el tratamiento crónico."),
+]
+
+DOCTORS = [
+    "Dra. Martínez",
+    "Dr. Gómez",
+    "Dra. López",
+    "Dr. Fernández",
+    "Dra. Ruiz",
+    "Dr. Herrera",
+]
+
+# Analyte: low and high of the sampled values, unit and decimals
+LAB_TESTS: dict[str, dict[str, tuple[float, float, str, int]]] = {
+    "Panel metabólico": {
+        "glucose": (70, 220, "mg/dL", 0),
+        "hba1c": (4.8, 10.5, "%", 1),
+        "creatinine": (0.6, 2.4, "mg/dL", 1),
+    },
+    "Perfil lipídico": {
+        "ldl": (60, 210, "mg/dL", 0),
+        "hdl": (30, 80, "mg/dL", 0),
+        "triglycerides": (70, 400, "mg/dL", 0),
+    },
+    "Hemograma": {
+        "hemoglobin": (9.5, 17.0, "g/dL", 1),
+        "leukocytes": (3500, 14000, "/uL", 0),
+        "platelets": (120000, 420000, "/uL", 0),
+    },
+    "Función tiroidea": {
+        "tsh": (0.3, 9.0, "mUI/L", 2),
+        "t4_free": (0.7, 2.0, "ng/dL", 2),
+    },
+}
+
+# Items of a record besides its visits, lab results and medications: the
+# demographics, CHRONIC_CONDITIONS_PER_RECORD conditions and one allergy
+FIXED_ITEMS = 4
+CHRONIC_CONDITIONS_PER_RECORD = 2
+
+
+def _lab_value(
+    rng: random.Random, low: float, high: float, unit: str, decimals: int
+) -> str:
+    value = round(rng.uniform(low, high), decimals)
+    return f"{value:.{decimals}f}{'' if unit.startswith(('%', '/')) else ' '}{unit}"
+
+
+def _medications(rng: random.Random, count: int) -> list[dict[str, str]]:
+    # Distinct drugs first, then repeats at another dose (e.g. a past
+    # adjustment), as long histories have
+    names = rng.sample(range(len(MEDICATIONS)), min(count, len(MEDICATIONS)))
+    names += rng.choices(range(len(MEDICATIONS)), k=count - len(names))
+
+    medications = []
+    for index in names:
+        name, doses, frequencies = MEDICATIONS[index]
+        medications.append(
+            {
+                "name": name,
+                "dose": rng.choice(doses),
+                "frequency": rng.choice(frequencies),
+            }
+        )
+    return medications
+
+
+def _visit_notes(rng: random.Random, notes: str) -> str:
+    return notes.format(
+        glucose=rng.randint(90, 220),
+        systolic=rng.randint(110, 170),
+        diastolic=rng.randint(65, 105),
+        days=rng.randint(2, 10),
+    )
+
+
+def generate_ehr_payload(
+    patient_id: str,
+    *,
+    seed: int = 0,
+    visits: int = 2,
+    lab_results: int = 1,
+    medications: int = 2,
+) -> dict[str, Any]:
+    """Returns a JSON ready ElectronicPatientRecord payload. The same seed always
+    produces the same payload.
+
+    Visits, lab results and medications come in the given counts, with dates
+    over the last ten years and sampled values (glucose, vitals, analytes), so
+    that long histories are not made of identical items.
+    """
+
+    rng = random.Random(f"{seed}:{patient_id}")
+    start = date(2024, 12, 31)
+
+    def past_date() -> str:
+        return (start - timedelta(days=rng.randint(0, 3650))).isoformat()
+
+    return {
+        "patient_id": patient_id,
+        "demographics": {
+            "name": f"Paciente {patient_id}",
+            "age": rng.randint(18, 90),
+            "gender": rng.choice(["M", "F"]),
+            "blood_type": rng.choice(["O+", "O-", "A+", "A-", "B+", "AB+"]),
+        },
+        "medical_history": {
+            "chronic_conditions": rng.sample(
+                CHRONIC_CONDITIONS, CHRONIC_CONDITIONS_PER_RECORD
+            ),
+            "allergies": rng.sample(ALLERGIES, 1),
+            "current_medications": _medications(rng, medications),
+        },
+        "recent_visits": [
+            {
+                "date": past_date(),
+                "reason": reason,
+                "notes": _visit_notes(rng, notes),
+                "doctor": rng.choice(DOCTORS),
+            }
+            for reason, notes in (rng.choice(VISIT_REASONS) for _ in range(visits))
+        ],
+        "lab_results": [
+            {
+                "date": past_date(),
+                "test": test,
+                "results": {
+                    analyte: _lab_value(rng, *reference)
+                    for analyte, reference in LAB_TESTS[test].items()
+                },
+            }
+            for test in (rng.choice(list(LAB_TESTS)) for _ in range(lab_results))
+        ],
+    }
+
+
+def generate_ehr_payload_of_size(
+    patient_id: str, items: int, *, seed: int = 0
+) -> dict[str, Any]:
+    """A payload decomposing into exactly the given number of context items
+    (at least FIXED_ITEMS + 1), most of them visits and lab results as in long
+    real histories, with about one medication per ten items."""
+
+    variable = items - FIXED_ITEMS
+    if variable < 1:
+        raise ValueError(f"A record has at least {FIXED_ITEMS + 1} items")
+
+    medications = max(1, variable // 10)
+    visits = (variable - medications) // 2
+    lab_results = variable - medications - visits
+
+    return generate_ehr_payload(
+        patient_id,
+        seed=seed,
+        visits=visits,
+        lab_results=lab_results,
+        medications=medications,
+    )
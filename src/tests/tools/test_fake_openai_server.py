@@ -0,0 +1,91 @@
+import json
+from http import HTTPStatus
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+
+from app.domain.ehr_query.ehr_query_models import EHRContextAliases
+from tools.fake_openai_server import FakeOpenAIConfig, create_fake_openai_app
+
+SELECTION_PROMPT = """Contextos:
+- id: 1 | demographics (patient, 2024-01-01): Paciente, 40 años
+- id: 2 | allergy (patient, 2024-01-01): Penicilina
+- id: 3 | medication (patient, 2024-01-01): Metformina 850 mg
+- id: 4 | visit (doctor, 2024-02-01): Control
+"""
+
+
+def fake_openai_client(config: FakeOpenAIConfig) -> AsyncClient:
+    return AsyncClient(
+        transport=ASGITransport(app=create_fake_openai_app(config)),
+        base_url="http://fake-openai",
+    )
+
+
+@pytest.mark.asyncio
+async def test_structured_responses_select_aliases_listed_in_the_prompt() -> None:
+    config = FakeOpenAIConfig(latency="fixed", latency_ms=0, seed=1)
+    async with fake_openai_client(config) as client:
+        response = await client.post(
+            "/v1/responses",
+            json={
+                "model": "gpt-4.1-mini",
+                "input": SELECTION_PROMPT,
+                "text": {
+                    "format": {
+                        "type": "json_schema",
+                        "name": "EHRContextAliases",
+                        "schema": EHRContextAliases.model_json_schema(),
+                        "strict": True,
+                    }
+                },
+            },
+        )
+
+    assert response.status_code == HTTPStatus.OK
+    body = response.json()
+    assert body["status"] == "completed"
+
+    output_text = body["output"][0]["content"][0]["text"]
+    aliases = EHRContextAliases.model_validate_json(output_text)
+    assert len(aliases.ids) == 3
+    assert set(aliases.ids) <= {1, 2, 3, 4}
+
+
+@pytest.mark.asyncio
+async def test_streamed_responses_send_text_deltas_then_completed() -> None:
+    config = FakeOpenAIConfig(
+        latency="fixed", latency_ms=0, tokens_per_second=0, answer="Sin alergias."
+    )
+    async with fake_openai_client(config) as client:
+        response = await client.post(
+            "/v1/responses",
+            json={"model": "gpt-4.1-mini", "input": "¿Alergias?", "stream": True},
+        )
+
+    assert response.status_code == HTTPStatus.OK
+    events = [
+        json.loads(line.removeprefix("data: "))
+        for line in response.text.splitlines()
+        if line.startswith("data: ")
+    ]
+    assert [event["type"] for event in events] == [
+        "response.created",
+        "response.output_text.delta",
+        "response.output_text.delta",
+        "response.completed",
+    ]
+    assert "".join(event["delta"] for event in events[1:-1]) == "Sin alergias."
+    assert events[-1]["response"]["usage"]["output_tokens"] > 0
+
+
+@pytest.mark.asyncio
+async def test_injected_errors_use_the_configured_status() -> None:
+    config = FakeOpenAIConfig(error_rate=1.0, error_status=HTTPStatus.TOO_MANY_REQUESTS)
+    async with fake_openai_client(config) as client:
+        response = await client.post(
+            "/v1/responses", json={"model": "gpt-4.1-mini", "input": "Hola"}
+        )
+
+    assert response.status_code == HTTPStatus.TOO_MANY_REQUESTS
+    assert response.json()["error"]["message"] == "Injected error"
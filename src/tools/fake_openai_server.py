@@ -0,0 +1,278 @@
+"""Local stand-in for the OpenAI Responses API, to load-test the query path
+without paying for (or being throttled by) the real API.
+
+Serves POST /v1/responses, which backs both responses.create (plain or
+streamed) and responses.parse (JSON schema text format). Responses take a
+sampled time to first token, then generate output at a fixed token rate, and
+a share of them can fail with an injected error. Structured outputs are built
+from the requested schema; lists of integers pick aliases listed in the prompt.
+
+Point the app at it with OPENAI_BASE_URL=http://localhost:8100/v1:
+
+    python -m tools.fake_openai_server --port 8100 --latency lognormal
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Literal, Optional
+from uuid import uuid4
+
+import uvicorn
+from fastapi import Body, FastAPI
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from app.api.sse import SSE_MEDIA_TYPE
+from app.domain.llm.token_counter import count_tokens
+
+ALIAS_PATTERN = re.compile(r"^- id: (\d+) \|", re.MULTILINE)
+
+# Aliases picked for each list of ids in a structured output
+SELECTED_ALIASES = 3
+
+DEFAULT_ANSWER = (
+    "Según el historial clínico, el paciente mantiene su tratamiento actual y no"
+    " se registran cambios relevantes en las últimas visitas."
+)
+
+LatencyDistribution = Literal["fixed", "uniform", "lognormal"]
+
+
+@dataclass(frozen=True)
+class FakeOpenAIConfig:
+    # Time to first token: its median, and its spread (sigma of a lognormal, or
+    # +/- fraction of the median for uniform)
+    latency: LatencyDistribution = "lognormal"
+    latency_ms: float = 300
+    latency_spread: float = 0.5
+    # Output generation rate, after the first token (0 generates instantly)
+    tokens_per_second: float = 100
+    # Share of requests failing with error_status
+    error_rate: float = 0.0
+    error_status: int = 429
+    answer: str = DEFAULT_ANSWER
+    seed: Optional[int] = None
+
+
+class _FakeResponder:
+    def __init__(self, config: FakeOpenAIConfig) -> None:
+        self._config = config
+        self._rng = random.Random(config.seed)
+
+    def fails(self) -> bool:
+        return self._rng.random() < self._config.error_rate
+
+    def first_token_seconds(self) -> float:
+        config = self._config
+        median = config.latency_ms / 1000
+        if config.latency == "fixed":
+            return median
+        if config.latency == "uniform":
+            spread = median * config.latency_spread
+            return max(0.0, self._rng.uniform(median - spread, median + spread))
+        return self._rng.lognormvariate(0, config.latency_spread) * median
+
+    def generation_seconds(self, tokens: int) -> float:
+        if self._config.tokens_per_second <= 0:
+            return 0.0
+        return tokens / self._config.tokens_per_second
+
+    def structured_output(self, schema: dict[str, Any], prompt: str) -> str:
+        aliases = [int(alias) for alias in ALIAS_PATTERN.findall(prompt)]
+        instance = self._instance(schema, schema.get("$defs", {}), aliases)
+        return json.dumps(instance, ensure_ascii=False)
+
+    def _instance(
+        self, schema: dict[str, Any], defs: dict[str, Any], aliases: list[int]
+    ) -> Any:
+        if "$ref" in schema:
+            return self._instance(defs[schema["$ref"].split("/")[-1]], defs, aliases)
+        if "anyOf" in schema:
+            return self._instance(schema["anyOf"][0], defs, aliases)
+
+        match schema.get("type"):
+            case "object":
+                return {
+                    name: self._instance(property, defs, aliases)
+                    for name, property in schema.get("properties", {}).items()
+                }
+            case "array":
+                items = schema.get("items", {})
+                if items.get("type") == "integer":
+                    return sorted(
+                        self._rng.sample(aliases, min(SELECTED_ALIASES, len(aliases)))
+                    )
+                return [self._instance(items, defs, aliases)]
+            case "integer":
+                return 1
+            case "number":
+                return 0.0
+            case "boolean":
+                return False
+            case "null":
+                return None
+            case _:
+                return self._config.answer
+
+
+def _prompt_text(input: Any) -> str:
+    if isinstance(input, str):
+        return input
+    return json.dumps(input, ensure_ascii=False)
+
+
+def _response_object(
+    model: str,
+    text: str,
+    input_tokens: int,
+    output_tokens: int,
+    status: str = "completed",
+) -> dict[str, Any]:
+    output = []
+    if status == "completed":
+        output.append(
+            {
+                "type": "message",
+                "id": f"msg_{uuid4().hex}",
+                "status": "completed",
+                "role": "assistant",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }
+        )
+
+    return {
+        "id": f"resp_{uuid4().hex}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "status": status,
+        "model": model,
+        "output": output,
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": [],
+        "error": None,
+        "incomplete_details": None,
+        "instructions": None,
+        "metadata": {},
+        "usage": {
+            "input_tokens": input_tokens,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": output_tokens,
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": input_tokens + output_tokens,
+        },
+    }
+
+
+def create_fake_openai_app(config: FakeOpenAIConfig) -> FastAPI:
+    app = FastAPI(title="fake-openai-responses-api")
+    responder = _FakeResponder(config)
+
+    @app.post("/v1/responses")
+    async def create_response(request: dict[str, Any] = Body(...)) -> Response:
+        if responder.fails():
+            return JSONResponse(
+                status_code=config.error_status,
+                content={
+                    "error": {
+                        "message": "Injected error",
+                        "type": "fake_error",
+                        "code": str(config.error_status),
+                    }
+                },
+            )
+
+        model = request.get("model", "fake-model")
+        prompt = _prompt_text(request.get("input", ""))
+        text_format = request.get("text", {}).get("format", {})
+        text = (
+            responder.structured_output(text_format["schema"], prompt)
+            if text_format.get("type") == "json_schema"
+            else config.answer
+        )
+        input_tokens = count_tokens(prompt)
+
+        await asyncio.sleep(responder.first_token_seconds())
+
+        if not request.get("stream"):
+            output_tokens = count_tokens(text)
+            await asyncio.sleep(responder.generation_seconds(output_tokens))
+            return JSONResponse(
+                _response_object(model, text, input_tokens, output_tokens)
+            )
+
+        async def events() -> AsyncIterator[bytes]:
+            sequence_number = 0
+
+            def event(type: str, **data: Any) -> bytes:
+                nonlocal sequence_number
+                sequence_number += 1
+                payload = json.dumps(
+                    {"type": type, "sequence_number": sequence_number, **data},
+                    ensure_ascii=False,
+                )
+                return f"event: {type}\ndata: {payload}\n\n".encode()
+
+            yield event(
+                "response.created",
+                response=_response_object(model, "", input_tokens, 0, "in_progress"),
+            )
+
+            item_id = f"msg_{uuid4().hex}"
+            output_tokens = 0
+            for chunk in re.findall(r"\S+\s*", text):
+                chunk_tokens = count_tokens(chunk)
+                await asyncio.sleep(responder.generation_seconds(chunk_tokens))
+                output_tokens += chunk_tokens
+                yield event(
+                    "response.output_text.delta",
+                    item_id=item_id,
+                    output_index=0,
+                    content_index=0,
+                    delta=chunk,
+                    logprobs=[],
+                )
+
+            yield event(
+                "response.completed",
+                response=_response_object(model, text, input_tokens, output_tokens),
+            )
+
+        return StreamingResponse(events(), media_type=SSE_MEDIA_TYPE)
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument(
+        "--latency", choices=["fixed", "uniform", "lognormal"], default="lognormal"
+    )
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--latency-spread", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    config = FakeOpenAIConfig(
+        latency=args.latency,
+        latency_ms=args.latency_ms,
+        latency_spread=args.latency_spread,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        seed=args.seed,
+    )
+    uvicorn.run(create_fake_openai_app(config), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
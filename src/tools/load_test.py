@@ -0,0 +1,251 @@
+"""Open-loop load driver for a running instance of the app.
+
+Sends requests of one scenario (ingestion, listing or query) at a target rate
+for a fixed duration, whatever the latency of the previous ones, so that slow
+responses show up as latency instead of lowering the offered load. Reports
+p50/p95/p99 latency and throughput, and appends the run as a JSON line to
+benchmark-results/load-test.jsonl so that runs can be compared (--compare).
+
+With the app running against the local stand-in of the OpenAI API:
+
+    python -m tools.fake_openai_server --port 8100
+    OPENAI_BASE_URL=http://localhost:8100/v1 python run.py
+    python -m tools.load_test query --rps 20 --duration 30 --label baseline
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Literal, Optional
+
+import httpx
+
+from tests.synthetic_ehr import generate_ehr_payload
+
+Scenario = Literal["ingestion", "listing", "query"]
+
+RESULTS_FILE = Path("benchmark-results") / "load-test.jsonl"
+
+QUESTIONS = [
+    "¿Qué medicamentos toma actualmente el paciente?",
+    "¿Tiene alguna alergia que deba considerar?",
+    "¿Cuáles son sus enfermedades crónicas?",
+    "¿Cuál fue el último resultado de glucosa?",
+    "¿Cuál fue el motivo de su última visita?",
+    "Dame un resumen general del historial del paciente.",
+]
+
+
+@dataclass(frozen=True)
+class LoadTestResult:
+    scenario: Scenario
+    label: str
+    target_rps: float
+    duration_seconds: float
+    requests: int
+    errors: int
+    # Successful responses per second, over the time until the last completed
+    throughput_rps: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+    recorded_at: str
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """Nearest-rank percentile of values sorted in ascending order."""
+    if not sorted_values:
+        return math.nan
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+async def seed_patients(client: httpx.AsyncClient, patients: int) -> list[str]:
+    """Ingests the patients listed and queried by the other scenarios, through
+    the bulk endpoint, which returns once they are stored."""
+    payloads = [
+        generate_ehr_payload(f"LT{i:06d}", seed=i, visits=20, lab_results=20)
+        for i in range(patients)
+    ]
+    response = await client.post(
+        "/api/ehr-ingestion-tasks/bulk",
+        content="\n".join(json.dumps(payload) for payload in payloads),
+        headers={"Content-Type": "application/x-ndjson"},
+        timeout=None,
+    )
+    response.raise_for_status()
+
+    return [payload["patient_id"] for payload in payloads]
+
+
+def scenario_request(
+    scenario: Scenario,
+    client: httpx.AsyncClient,
+    patient_ids: list[str],
+    rng: random.Random,
+) -> Callable[[int], Awaitable[httpx.Response]]:
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+
+    async def ingestion(i: int) -> httpx.Response:
+        # Measures accepting the task; the ingestion itself runs in the workers
+        return await client.post(
+            "/api/ehr-ingestion-tasks",
+            json=generate_ehr_payload(f"LT{run_id}-{i:06d}", seed=i),
+        )
+
+    async def listing(i: int) -> httpx.Response:
+        return await client.get(
+            "/api/ehr-context-items", params={"patient_id": rng.choice(patient_ids)}
+        )
+
+    async def query(i: int) -> httpx.Response:
+        return await client.post(
+            f"/api/ehr-query/{rng.choice(patient_ids)}/query",
+            json={"query": rng.choice(QUESTIONS)},
+        )
+
+    return {"ingestion": ingestion, "listing": listing, "query": query}[scenario]
+
+
+async def run_load_test(
+    base_url: str,
+    scenario: Scenario,
+    rps: float,
+    duration_seconds: float,
+    patients: int,
+    label: str,
+    seed: Optional[int] = None,
+) -> LoadTestResult:
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=120
+    ) as client:
+        patient_ids = (
+            await seed_patients(client, patients) if scenario != "ingestion" else []
+        )
+        send = scenario_request(scenario, client, patient_ids, random.Random(seed))
+
+        latencies: list[float] = []
+        errors = 0
+
+        async def timed(i: int) -> None:
+            nonlocal errors
+            started = time.perf_counter()
+            try:
+                response = await send(i)
+                ok = response.is_success
+            except httpx.HTTPError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+        # Open loop: request i starts at i / rps, whatever happened before
+        requests = int(rps * duration_seconds)
+        started = time.perf_counter()
+        tasks = []
+        for i in range(requests):
+            await asyncio.sleep(max(0.0, started + i / rps - time.perf_counter()))
+            tasks.append(asyncio.create_task(timed(i)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return LoadTestResult(
+        scenario=scenario,
+        label=label,
+        target_rps=rps,
+        duration_seconds=duration_seconds,
+        requests=requests,
+        errors=errors,
+        throughput_rps=len(latencies) / elapsed,
+        p50_ms=percentile(latencies, 50) * 1000,
+        p95_ms=percentile(latencies, 95) * 1000,
+        p99_ms=percentile(latencies, 99) * 1000,
+        max_ms=percentile(latencies, 100) * 1000,
+        recorded_at=datetime.now(timezone.utc).isoformat(),
+    )
+
+
+def save_result(result: LoadTestResult, results_file: Path = RESULTS_FILE) -> None:
+    results_file.parent.mkdir(parents=True, exist_ok=True)
+    with results_file.open("a", encoding="utf-8") as f:
+        f.write(json.dumps(asdict(result), ensure_ascii=False) + "\n")
+
+
+def print_comparison(scenario: Scenario, results_file: Path = RESULTS_FILE) -> None:
+    """Prints the saved runs of the scenario, oldest first."""
+    columns = [
+        "label",
+        "target_rps",
+        "requests",
+        "errors",
+        "throughput_rps",
+        "p50_ms",
+        "p95_ms",
+        "p99_ms",
+    ]
+    print(" ".join(f"{column:>14}" for column in columns))
+
+    if not results_file.exists():
+        return
+    for line in results_file.read_text(encoding="utf-8").splitlines():
+        run: dict[str, Any] = json.loads(line)
+        if run["scenario"] != scenario:
+            continue
+        print(
+            " ".join(
+                (
+                    f"{run[column]:>14.1f}"
+                    if isinstance(run[column], float)
+                    else f"{run[column]:>14}"
+                )
+                for column in columns
+            )
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenario", choices=["ingestion", "listing", "query"])
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--rps", type=float, default=10)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument(
+        "--patients", type=int, default=50, help="Patients seeded for listing/query"
+    )
+    parser.add_argument("--label", default="", help="Names the run in comparisons")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument(
+        "--compare", action="store_true", help="Print the saved runs of the scenario"
+    )
+    args = parser.parse_args()
+
+    if not args.compare:
+        result = asyncio.run(
+            run_load_test(
+                base_url=args.base_url,
+                scenario=args.scenario,
+                rps=args.rps,
+                duration_seconds=args.duration,
+                patients=args.patients,
+                label=args.label,
+                seed=args.seed,
+            )
+        )
+        save_result(result)
+        print(json.dumps(asdict(result), ensure_ascii=False))
+
+    print_comparison(args.scenario)
+
+
+if __name__ == "__main__":
+    main()